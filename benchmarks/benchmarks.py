@@ -0,0 +1,81 @@
+# asv benchmarks, these wrap the same decks and entry points as
+# python -m gefry3.bench so results from either can be compared.
+
+import os
+import tempfile
+import warnings
+
+import numpy as np
+
+import gefry3
+from gefry3.bench import write_synthetic_deck
+
+EXAMPLE_DECK = os.path.join(os.path.dirname(__file__), "..", "examples", "g3_deck.yml")
+
+def _read(fname, problem_type="Simple_Problem"):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return gefry3.read_input_problem(fname, problem_type=problem_type)
+
+class Deck(object):
+    params = (["example", "100x10", "1000x100", "10000x1000"], ["shapely", "numpy", "shapely2"])
+    param_names = ["deck", "engine"]
+    timeout = 600
+
+    def setup_cache(self):
+        d = tempfile.mkdtemp()
+        decks = {"example": EXAMPLE_DECK}
+
+        for size in self.params[0][1:]:
+            n_solids, n_detectors = (int(x) for x in size.split("x"))
+            decks[size] = os.path.join(d, "{}.yml".format(size))
+            write_synthetic_deck(decks[size], n_solids, n_detectors)
+
+        return decks
+
+    def setup(self, decks, deck, engine):
+        self.fname = decks[deck]
+        self.problem = _read(self.fname)
+        self.problem.domain.engine = engine
+        self.perturbable = _read(self.fname, "Perturbable_XS_Problem")
+        self.perturbable.domain.engine = engine
+
+        rng = np.random.RandomState(0)
+        x0, y0, x1, y1 = self.problem.domain.bbox.bounds
+        self.R = rng.uniform([x0, y0], [x1, y1], size=(100, 2))
+        self.b = self.problem.detectors[0].R
+
+    def time_read_input_problem(self, decks, deck, engine):
+        _read(self.fname)
+
+    def time_domain_init(self, decks, deck, engine):
+        D = gefry3.Domain._from_dict(self.problem.domain._as_dict())
+        D.empty
+        D.index
+
+    def time_construct_path(self, decks, deck, engine):
+        self.problem.domain.construct_path(self.R[0], self.b)
+
+    def time_is_intersect(self, decks, deck, engine):
+        self.problem.domain.is_intersect(self.R[0], self.b)
+
+    def time_call(self, decks, deck, engine):
+        self.problem(self.R[0], 1e9)
+
+    def time_evaluate_batch(self, decks, deck, engine):
+        self.problem.evaluate_batch(self.R, 1e9)
+
+    def time_compute_jacobian(self, decks, deck, engine):
+        self.problem.compute_jacobian(self.R[0], 1e9)
+
+    def time_perturbable_call(self, decks, deck, engine):
+        P = self.perturbable
+        P._last_paths = (None, None)
+        P(self.R[0], 1e9, P.interstitial_material, P.materials)
+
+    def time_write_input(self, decks, deck, engine):
+        with tempfile.NamedTemporaryFile(suffix=".yml") as f:
+            gefry3.write_input(f.name, self.problem)
+
+    def track_path_error(self, decks, deck, engine):
+        return gefry3.bench.check_accuracy(self.problem)["max_abs_path_error"]
@@ -1,9 +1,23 @@
 from gefry3.problem import *
 from gefry3.classes import *
+from gefry3.tables import *
+from gefry3.parallel import *
+from gefry3.compiled import *
+from gefry3.profiling import *
+from gefry3.likelihood import *
+from gefry3.surrogate import *
+from gefry3.quadtree import *
+from gefry3.precision import *
+from gefry3.placement import *
 
-import warnings
+import importlib
 
-try:
-    from gefry3 import plots
-except ImportError as e:
-    warnings.warn("Exception raised importing plots package, skipped (you probably need to install matplotlib and/or seaborn)", ImportWarning)
+# Optional subsystems are only imported when first used, so importing gefry3
+# doesn't drag in matplotlib and friends
+_LAZY_SUBMODULES = ["plots"]
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module("gefry3." + name)
+
+    raise AttributeError("module 'gefry3' has no attribute '{}'".format(name))
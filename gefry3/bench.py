@@ -0,0 +1,274 @@
+"""
+Benchmarks for the main entry points, on the example deck and on
+synthetic decks of any size.
+
+    python -m gefry3.bench --deck examples/g3_deck.yml --sizes 10x10,1000x100 -o bench.json
+
+Every run writes a JSON report with the timings (best of --repeat) and an
+accuracy check of the numpy engine against the shapely reference path, so
+successive reports can be compared to track scaling and catch regressions.
+"""
+
+import numpy as np
+import shapely
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import warnings
+
+from gefry3.problem import read_input_problem, write_input
+
+__all__ = ["synthetic_deck", "write_synthetic_deck", "run_benchmarks", "check_accuracy"]
+
+def synthetic_deck(n_solids, n_detectors, seed=0, size=None, n_materials=5):
+    """
+    A random city: n_solids non-overlapping rectangular buildings, one per
+    cell of a square-ish grid, and n_detectors detectors in the streets.
+    Returns a deck dict in the same format read_input_problem reads.
+    """
+    rng = np.random.RandomState(seed)
+
+    nx = int(np.ceil(np.sqrt(n_solids)))
+    ny = int(np.ceil(n_solids / float(nx)))
+    cell = 20.0
+
+    if size is None:
+        size = (nx * cell, ny * cell)
+
+    cw, ch = size[0] / nx, size[1] / ny
+
+    solids = []
+    rects = []
+    for k in range(n_solids):
+        i, j = k % nx, k // nx
+
+        # Building covers 40-80% of its cell in each direction
+        w, h = rng.uniform(0.4, 0.8, size=2) * [cw, ch]
+        x0 = i * cw + rng.uniform(0, cw - w)
+        y0 = j * ch + rng.uniform(0, ch - h)
+
+        rects.append((x0, y0, x0 + w, y0 + h))
+        solids.append({
+            "material": int(rng.randint(n_materials)),
+            "vertices": np.array([[x0, y0], [x0 + w, y0], [x0 + w, y0 + h], [x0, y0 + h], [x0, y0]]).tolist(),
+        })
+
+    rects = np.array(rects).reshape(-1, 4)
+
+    detectors = []
+    while len(detectors) < n_detectors:
+        R = rng.uniform([0, 0], size, size=(2 * n_detectors, 2))
+        inside = (
+            (R[:, None, 0] >= rects[None, :, 0]) & (R[:, None, 0] <= rects[None, :, 2])
+            & (R[:, None, 1] >= rects[None, :, 1]) & (R[:, None, 1] <= rects[None, :, 3])
+        ).any(axis=1)
+
+        for r in R[~inside][:n_detectors - len(detectors)]:
+            detectors.append({
+                "type": "Point",
+                "R": r.tolist(),
+                "area": 0.005806,
+                "dwell": 5.0,
+                "epsilon": 0.62,
+            })
+
+    materials = {
+        i: {"number_dens": 1.0, "sigma_t": float(rng.uniform(0.04, 0.06))}
+        for i in range(n_materials)
+    }
+
+    source = rng.uniform([0, 0], size)
+
+    return {
+        "problem_type": "Simple_Problem",
+        "data": {
+            "domain": {
+                "bbox": np.array([[0.0, 0.0], [size[0], 0.0], [size[0], size[1]], [0.0, size[1]]]).tolist(),
+                "solids": solids,
+            },
+            "interstitial_material": {"number_dens": 1.0, "sigma_t": 0.00929412},
+            "materials": materials,
+            "detectors": detectors,
+            "source": {"R": source.tolist(), "I0": 3.214e9},
+        },
+    }
+
+def write_synthetic_deck(fname, n_solids, n_detectors, **kwargs):
+    import yaml
+
+    with open(fname, "w") as f:
+        yaml.safe_dump(synthetic_deck(n_solids, n_detectors, **kwargs), f)
+
+def _best_of(fn, repeat, number=1):
+    best = np.inf
+
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - t) / number)
+
+    return best
+
+def _random_sources(problem, n, seed):
+    rng = np.random.RandomState(seed)
+    x0, y0, x1, y1 = problem.domain.bbox.bounds
+
+    return rng.uniform([x0, y0], [x1, y1], size=(n, 2))
+
+def check_accuracy(problem, n_rays=200, seed=0):
+    """
+    Trace n_rays random source -> detector rays with both engines and
+    report the largest path length and relative response differences.
+    """
+    R = _random_sources(problem, n_rays, seed)
+    B = np.array([problem.detectors[i % len(problem.detectors)].R for i in range(n_rays)])
+
+    engine = problem.domain.engine
+    try:
+        problem.domain.engine = "shapely"
+        reference = problem.domain.construct_paths(R, B)
+        problem.domain.engine = "numpy"
+        paths = problem.domain.construct_paths(R, B)
+    finally:
+        problem.domain.engine = engine
+
+    tau_ref = reference.dot(problem.Sigma_T)
+    tau = paths.dot(problem.Sigma_T)
+
+    return {
+        "n_rays": n_rays,
+        "max_abs_path_error": float(np.abs(paths - reference).max()),
+        "max_rel_response_error": float(np.abs(np.expm1(tau_ref - tau)).max()),
+    }
+
+def run_benchmarks(fname, label=None, engines=("shapely", "numpy", "shapely2"), repeat=3, n_sources=100, seed=0):
+    """
+    Time the main entry points on the deck in fname. Returns a list of
+    result dicts, one per (benchmark, engine).
+    """
+    label = fname if label is None else label
+    results = []
+
+    def record(name, seconds, engine=None, calls=1):
+        results.append({
+            "deck": label,
+            "n_solids": len(problem.domain.solids),
+            "n_detectors": len(problem.detectors),
+            "benchmark": name,
+            "engine": engine,
+            "seconds": seconds,
+            "per_call": seconds / calls,
+        })
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+
+        problem = read_input_problem(fname, problem_type="Simple_Problem")
+        record("read_input_problem", _best_of(lambda: read_input_problem(fname, problem_type="Simple_Problem"), repeat))
+
+        perturbable = read_input_problem(fname, problem_type="Perturbable_XS_Problem")
+
+    def build_domain():
+        D = type(problem.domain)._from_dict(problem.domain._as_dict())
+        D.empty
+        D.index
+
+    record("Domain.__init__", _best_of(build_domain, repeat))
+
+    R = _random_sources(problem, n_sources, seed)
+    B = np.array([d.R for d in problem.detectors])
+    r = R[0]
+
+    for engine in engines:
+        problem.domain.engine = engine
+        perturbable.domain.engine = engine
+
+        t = _best_of(lambda: [problem.domain.construct_path(a, B[0]) for a in R], repeat)
+        record("Domain.construct_path", t, engine, n_sources)
+
+        t = _best_of(lambda: [problem.domain.is_intersect(a, B[0]) for a in R], repeat)
+        record("Domain.is_intersect", t, engine, n_sources)
+
+        record("SimpleProblem.__call__", _best_of(lambda: problem(r, 1e9), repeat), engine)
+        record("SimpleProblem.evaluate_batch", _best_of(lambda: problem.evaluate_batch(R, 1e9), repeat), engine, n_sources)
+        record("SimpleProblem.compute_jacobian", _best_of(lambda: problem.compute_jacobian(r, 1e9), repeat), engine)
+
+        # Move the source every call so the path reuse doesn't kick in
+        it = iter(np.tile(R, (repeat + 1, 1)))
+        t = _best_of(lambda: perturbable(next(it), 1e9, perturbable.interstitial_material, perturbable.materials), repeat)
+        record("PerturbableXSProblem.__call__", t, engine)
+
+    with tempfile.TemporaryDirectory() as d:
+        out = os.path.join(d, "deck.yml")
+        record("write_input", _best_of(lambda: write_input(out, problem), repeat))
+
+    return results
+
+def _parse_sizes(sizes):
+    return [tuple(int(x) for x in s.split("x")) for s in sizes.split(",") if s]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m gefry3.bench", description="Benchmark gefry3")
+    parser.add_argument("--deck", action="append", default=[], help="YAML deck to benchmark (repeatable)")
+    parser.add_argument("--sizes", default="10x10,100x10,1000x100", help="synthetic decks as SOLIDSxDETECTORS, comma separated")
+    parser.add_argument("--engines", default="shapely,numpy,shapely2", help="path length engines to time")
+    parser.add_argument("--repeat", type=int, default=3, help="repeats per benchmark (best is reported)")
+    parser.add_argument("--sources", type=int, default=100, help="source positions per batched benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+
+    args = parser.parse_args(argv)
+    engines = [e for e in args.engines.split(",") if e]
+
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "shapely": shapely.__version__,
+        "results": [],
+        "accuracy": [],
+    }
+
+    with tempfile.TemporaryDirectory() as d:
+        decks = [(fname, fname) for fname in args.deck]
+
+        for (n_solids, n_detectors) in _parse_sizes(args.sizes):
+            fname = os.path.join(d, "synthetic_{}x{}.yml".format(n_solids, n_detectors))
+            write_synthetic_deck(fname, n_solids, n_detectors, seed=args.seed)
+            decks.append((fname, "synthetic_{}x{}".format(n_solids, n_detectors)))
+
+        for (fname, label) in decks:
+            print("Benchmarking {}".format(label), file=sys.stderr)
+
+            report["results"] += run_benchmarks(
+                fname,
+                label=label,
+                engines=engines,
+                repeat=args.repeat,
+                n_sources=args.sources,
+                seed=args.seed,
+            )
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                problem = read_input_problem(fname, problem_type="Simple_Problem")
+
+            accuracy = check_accuracy(problem, seed=args.seed)
+            accuracy["deck"] = label
+            report["accuracy"].append(accuracy)
+
+    text = json.dumps(report, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import numpy as np
+from collections import OrderedDict
+
+# Bounded LRU cache of path length vectors, used by Domain when caching is
+# enabled. Entries are keyed on the ray end point (the detector) and the
+# ray start (the source) snapped to a grid of the given resolution; the
+# path vector stored is the one for the snapped source, so results are a
+# deterministic function of the snapped position regardless of which
+# point in the cell was asked for first.
+
+__all__ = ["PathCache"]
+
+# Rough per-entry bookkeeping cost (key tuple, dict slot, array header)
+_ENTRY_OVERHEAD = 256
+
+class PathCache(object):
+    def __init__(self, resolution=1e-3, max_bytes=64 * 2 ** 20):
+        self.resolution = np.float64(resolution)
+        self.max_bytes = int(max_bytes)
+
+        self._entries = OrderedDict()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def snap(self, A):
+        # Quantize source positions to the cache resolution
+        return np.round(np.asarray(A, dtype=np.float64) / self.resolution) * self.resolution
+
+    def keys(self, A, B):
+        q = np.round(np.asarray(A, dtype=np.float64) / self.resolution).astype(np.int64)
+        B = np.asarray(B, dtype=np.float64)
+
+        return list(zip(B[:, 0].tolist(), B[:, 1].tolist(), q[:, 0].tolist(), q[:, 1].tolist()))
+
+    def get(self, key):
+        value = self._entries.get(key)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            return
+
+        value = np.array(value)
+        value.setflags(write=False)
+
+        self._entries[key] = value
+        self.nbytes += value.nbytes + _ENTRY_OVERHEAD
+
+        while self.nbytes > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self.nbytes -= old.nbytes + _ENTRY_OVERHEAD
+            self.evictions += 1
+
+    def apply_edit(self, edit):
+        # Bring the cache in line with a DomainEdit: entries whose ray
+        # touches the edited region are dropped, the rest are renumbered
+        if not self._entries:
+            return
+
+        keys = list(self._entries)
+        k = np.array(keys, dtype=np.float64)
+        touched = edit.touches(k[:, 2:] * self.resolution, k[:, :2])
+
+        entries = OrderedDict()
+        self.nbytes = 0
+
+        for (key, hit) in zip(keys, touched):
+            if hit:
+                self.invalidations += 1
+                continue
+
+            value = edit.remap(self._entries[key])
+            value.setflags(write=False)
+
+            entries[key] = value
+            self.nbytes += value.nbytes + _ENTRY_OVERHEAD
+
+        self._entries = entries
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
@@ -1,16 +1,66 @@
+import shapely
 import shapely.geometry as G
 import shapely.ops as O
 import numpy as np
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from gefry3 import profiling
 from gefry3.classes.meta import Dictable
+from gefry3.classes.raytrace import EdgeTable, chord_lengths, pair_chord_lengths, pair_chord_gradients
+from gefry3.classes.spatial import SolidGrid, segment_box_overlap
+from gefry3.classes.cache import PathCache
 
-__all__ = ["Solid", "Domain"]
+__all__ = ["Solid", "Domain", "DomainEdit", "ENGINES"]
+
+# Path length engines available to Domain. "shapely" intersects GEOS
+# geometry one solid at a time, "numpy" uses the vectorized edge crossing
+# code in gefry3.classes.raytrace. "shapely2" does the same GEOS operations
+# as "shapely" (so gives identical results) but through the shapely 2 array
+# functions, a chunk of rays at a time on a thread pool; GEOS releases the
+# GIL, so the threads actually run in parallel.
+ENGINES = ("shapely", "numpy", "shapely2")
+
+# (ray, solid) pairs handed to a thread at once by the shapely2 engine
+_THREAD_CHUNK = 2 ** 12
+
+# Thread pools for the shapely2 engine, shared by every Domain and keyed on
+# the number of threads. Pools don't survive a fork, children start over.
+_pools = {}
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_pools.clear)
+
+def _thread_pool(threads):
+    if threads not in _pools:
+        _pools[threads] = ThreadPoolExecutor(max_workers=threads)
+
+    return _pools[threads]
+
+def _intersection_lengths(lines, geoms):
+    # Length of each line inside the matching geometry, same as
+    # Solid.find_path_length. The intersects test is much cheaper than the
+    # intersection and rules out most pairs. Geometries aren't prepared,
+    # GEOS builds the prepared index lazily and that isn't thread safe.
+    out = np.zeros(len(lines))
+    hit = shapely.intersects(geoms, lines)
+
+    out[hit] = shapely.length(shapely.intersection(lines[hit], geoms[hit]))
+
+    return out
 
 class Solid(Dictable):
     def __init__(self, vertices):
         self.vertices = vertices
 
-        self.geom = G.Polygon(vertices)
+        self._geom = None
+
+    @property
+    def geom(self):
+        if self._geom is None:
+            self._geom = G.Polygon(self.vertices)
+
+        return self._geom
 
     def find_path_length(self, L): # Length of path along a -> b intersecting the solid
         # L = g.LineString([a, b])
@@ -29,36 +79,485 @@ class Solid(Dictable):
     def _from_dict(cls, data):
         return cls(data["vertices"])
 
+class DomainEdit(object):
+    """
+    Record of a change to a domain: kind is "add", "remove" or "replace"
+    for solid index (or "material" for a change that only affects the
+    cross section of solid index) and box is the bounding box
+    (xmin, ymin, xmax, ymax) of everything that changed. Only rays
+    crossing box can have different path lengths afterwards.
+    """
+
+    KINDS = ("add", "remove", "replace", "material")
+
+    def __init__(self, kind, index, box):
+        if kind not in self.KINDS:
+            raise ValueError("Unknown edit [{}], expected one of {}".format(kind, self.KINDS))
+
+        self.kind = kind
+        self.index = index
+        self.box = np.asarray(box, dtype=np.float64)
+
+    def touches(self, A, B, pad=0.0):
+        # Which segments A -> B cross the edited region, grown by pad
+        A = np.asarray(A, dtype=np.float64)
+        B = np.asarray(B, dtype=np.float64)
+        box = self.box + np.array([-pad, -pad, pad, pad])
+
+        return segment_box_overlap(A, B, box)
+
+    def remap(self, paths):
+        # Move path vectors (along the last axis, in construct_path order)
+        # from the old solid numbering to the new one. Columns for rays
+        # that touch the edit are wrong and need to be recomputed.
+        if self.kind == "add":
+            pad = np.zeros(paths.shape[:-1] + (1,), dtype=paths.dtype)
+            return np.concatenate((paths, pad), axis=-1)
+        elif self.kind == "remove":
+            return np.delete(paths, 1 + self.index, axis=-1)
+        else:
+            return paths
+
 class Domain(Dictable):
-    def __init__(self, bbox, solids):
+    # Storage dtype of construct_paths results (and so of cached paths),
+    # see gefry3.precision. Chords are always computed in float64.
+    dtype = np.dtype(np.float64)
+
+    # Threads used by the shapely2 engine, None for one per CPU
+    threads = None
+
+    def __init__(self, bbox, solids, engine="shapely", union=None, empty=None):
+        # union and empty can be passed in if they're already known (e.g.
+        # from a compiled deck)
         self.solids = solids
+        self.engine = engine
         self.bbox_verts = bbox
-        self.bbox = G.Polygon(bbox)
 
-        # self.all = O.cascaded_union([S.geom for S in self.solids])
-        self.all = O.unary_union([S.geom for S in self.solids])
+        # All the derived geometry is built on first use, see the properties
+        # below. Not every engine or problem needs all of it.
+        self._bbox = None
+        self._all = union
+        self._empty = empty
+        self._edges = None
+        self._bbox_edges = None
+        self._index = None
+        self._geoms = None
 
-        # Check bounding box is a bounding box
-        assert(self.all.difference(self.bbox).is_empty)
+        # Optional PathCache for cached=True lookups, see enable_cache
+        self.cache = None
 
-        self.empty = self.bbox.difference(self.all)
+    @property
+    def bbox(self):
+        if self._bbox is None:
+            self._bbox = G.Polygon(self.bbox_verts)
 
-    def construct_path(self, a, b):
-        L = G.LineString([a, b])
+        return self._bbox
+
+    @property
+    def all(self):
+        if self._all is None:
+            # self.all = O.cascaded_union([S.geom for S in self.solids])
+            self._all = O.unary_union([S.geom for S in self.solids])
+
+            # Check bounding box is a bounding box
+            assert(self._all.difference(self.bbox).is_empty)
+
+        return self._all
+
+    @property
+    def empty(self):
+        if self._empty is None:
+            self._empty = self.bbox.difference(self.all)
+
+        return self._empty
+
+    @property
+    def edges(self):
+        # Flat edge arrays for the numpy engine
+        if self._edges is None:
+            self._edges = EdgeTable([S.vertices for S in self.solids])
+
+        return self._edges
+
+    @property
+    def bbox_edges(self):
+        if self._bbox_edges is None:
+            self._bbox_edges = EdgeTable([self.bbox_verts])
+
+        return self._bbox_edges
+
+    @property
+    def index(self):
+        # Spatial index so rays are only tested against nearby solids
+        if self._index is None:
+            self._index = SolidGrid(self.edges.bounds, extent=self.bbox_edges.bounds[0])
+
+        return self._index
+
+    @property
+    def geoms(self):
+        # Object array of the solid geometries, for the shapely 2 functions
+        if self._geoms is None:
+            self._geoms = np.empty(len(self.solids), dtype=object)
+            self._geoms[:] = [S.geom for S in self.solids]
+
+        return self._geoms
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        if engine not in ENGINES:
+            raise ValueError("Unknown path length engine [{}], expected one of {}".format(engine, ENGINES))
+
+        self._engine = engine
+
+    def enable_cache(self, resolution=1e-3, max_bytes=64 * 2 ** 20):
+        # Cache path vectors for cached=True calls, with sources snapped to
+        # a grid of the given resolution and an LRU byte budget
+        self.cache = PathCache(resolution=resolution, max_bytes=max_bytes)
+
+        return self.cache
+
+    def disable_cache(self):
+        self.cache = None
+
+    # Editing. These keep the derived geometry, the index and the path
+    # cache up to date incrementally instead of starting over, and return a
+    # DomainEdit describing the change. Use the problem level versions
+    # (e.g. SimpleProblem.add_solid) to keep materials and tables in sync.
+
+    def _check_inside(self, solid):
+        if not solid.geom.difference(self.bbox).is_empty:
+            raise ValueError("Solid is not inside the bounding box")
+
+    def _edit_union(self, removed=None, added=None):
+        # Patch the union of all solids locally: only the parts near the
+        # edit are re-unioned, then the interstitial region is rebuilt from
+        # it on demand (a difference against the bbox is cheaper than
+        # patching a polygon with thousands of holes)
+        self._empty = None
+
+        if self._all is None:
+            return
+
+        changed = [S.geom for S in (removed, added) if S is not None]
+        x0, y0, x1, y1 = G.MultiPolygon(changed).bounds
+
+        parts = shapely.get_parts(self._all)
+        b = shapely.bounds(parts)
+        near = (b[:, 0] <= x1) & (b[:, 2] >= x0) & (b[:, 1] <= y1) & (b[:, 3] >= y0)
+
+        local = shapely.union_all(parts[near])
+        if removed is not None:
+            local = local.difference(removed.geom)
+        if added is not None:
+            local = local.union(added.geom)
+
+        self._all = shapely.multipolygons(np.concatenate((parts[~near], shapely.get_parts(local))))
+
+    def _edited(self, kind, index, *solids):
+        box = np.array(G.MultiPolygon([S.geom for S in solids]).bounds)
+        edit = DomainEdit(kind, index, box)
+
+        if self.cache is not None:
+            self.cache.apply_edit(edit)
+
+        return edit
+
+    def add_solid(self, solid):
+        if not isinstance(solid, Solid):
+            solid = Solid(solid)
+
+        self._check_inside(solid)
+        self._edit_union(added=solid)
+
+        if self._edges is not None:
+            self._edges.append(solid.vertices)
+        if self._index is not None:
+            self._index.add(solid.geom.bounds)
+
+        self.solids.append(solid)
+        self._geoms = None
+
+        return self._edited("add", len(self.solids) - 1, solid)
+
+    def remove_solid(self, i):
+        solid = self.solids.pop(i)
+        self._geoms = None
+        self._edit_union(removed=solid)
+
+        if self._edges is not None:
+            self._edges.delete(i)
+        if self._index is not None:
+            self._index.remove(i)
+
+        return self._edited("remove", i, solid)
+
+    def replace_solid(self, i, solid):
+        if not isinstance(solid, Solid):
+            solid = Solid(solid)
+
+        self._check_inside(solid)
+        old = self.solids[i]
+        self._edit_union(removed=old, added=solid)
+
+        if self._edges is not None:
+            self._edges.replace(i, solid.vertices)
+        if self._index is not None:
+            self._index.replace(i, solid.geom.bounds)
+
+        self.solids[i] = solid
+        self._geoms = None
 
-        Li = L.intersection(self.empty)
-        return np.array([Li.length] + [S.find_path_length(L) for S in self.solids])
+        return self._edited("replace", i, old, solid)
+
+    def construct_path(self, a, b, cached=False):
+        if self.engine != "shapely" or (cached and self.cache is not None):
+            return self.construct_paths(a, b, cached=cached)[0]
+
+        prof = profiling.active
+
+        with profiling.phase("construct_path.ray"):
+            L = G.LineString([a, b])
+
+        with profiling.phase("construct_path.empty"):
+            Li = L.intersection(self.empty)
+
+        paths = np.zeros(1 + len(self.solids))
+        paths[0] = Li.length
+
+        with profiling.phase("construct_path.index_query"):
+            candidates = self.index.query(a, b)
+
+        for i in candidates:
+            if prof is None:
+                paths[1 + i] = self.solids[i].find_path_length(L)
+            else:
+                t = time.perf_counter()
+                paths[1 + i] = self.solids[i].find_path_length(L)
+                prof.solid(i, hit=paths[1 + i] > 0, seconds=time.perf_counter() - t)
+
+        if prof is not None:
+            prof.count("rays_cast")
+            prof.count("solids_tested", len(candidates))
+            prof.count("intersections_nonempty", np.count_nonzero(paths[1:]))
+
+        return paths
+
+    def construct_paths(self, A, B, cached=False):
+        # Batched version of construct_path over the rows of A and B,
+        # returns an (N, 1 + n_solids) array.
+        #
+        # With cached=True and a cache enabled, A is snapped to the cache
+        # resolution and rays that have been traced before are looked up.
+        A = np.asarray(A, dtype=np.float64).reshape(-1, 2)
+        B = np.asarray(B, dtype=np.float64).reshape(-1, 2)
+
+        if not cached or self.cache is None:
+            return self._construct_paths(A, B)
+
+        paths = np.empty((A.shape[0], 1 + len(self.solids)), dtype=self.dtype)
+        keys = self.cache.keys(A, B)
+        missing = []
+
+        for (i, key) in enumerate(keys):
+            value = self.cache.get(key)
+
+            if value is None:
+                missing.append(i)
+            else:
+                paths[i] = value
+
+        if missing:
+            paths[missing] = self._construct_paths(self.cache.snap(A[missing]), B[missing])
+
+            for i in missing:
+                self.cache.put(keys[i], paths[i])
+
+        return paths
+
+    def _construct_paths(self, A, B):
+        if self.engine == "shapely":
+            return np.array([self.construct_path(a, b) for (a, b) in zip(A, B)], dtype=self.dtype) \
+                .reshape(-1, 1 + len(self.solids))
+
+        if self.engine == "shapely2":
+            return self._construct_paths_shapely2(A, B)
+
+        paths = np.zeros((A.shape[0], 1 + len(self.solids)), dtype=self.dtype)
+
+        with profiling.phase("construct_path.index_query"):
+            rays, solids = self.index.query_batch(A, B)
+
+        with profiling.phase("construct_path.solids"):
+            chords = pair_chord_lengths(self.edges, A[rays], B[rays], solids)
+            paths[rays, 1 + solids] = chords
+
+        # Whatever isn't inside a solid is interstitial. This assumes the
+        # solids don't overlap, which is true of any sane input deck. The
+        # difference is taken in float64 whatever the storage dtype.
+        with profiling.phase("construct_path.empty"):
+            inside = chord_lengths(self.bbox_edges, A, B)[:, 0]
+            paths[:, 0] = np.maximum(inside - np.bincount(rays, weights=chords, minlength=A.shape[0]), 0.0)
+
+        prof = profiling.active
+        if prof is not None:
+            # The vectorized engine has no per solid timings, just counts
+            prof.count("rays_cast", A.shape[0])
+            prof.count("solids_tested", len(solids))
+            prof.count("intersections_nonempty", np.count_nonzero(chords))
+
+            tested = np.bincount(solids, minlength=len(self.solids))
+            hit = np.bincount(solids[chords > 0], minlength=len(self.solids))
+
+            for i in np.flatnonzero(tested):
+                prof.solid(i, tested=tested[i], hit=hit[i])
+
+        return paths
+
+    def _lengths_shapely2(self, A, B, geoms):
+        # Length of A[i] -> B[i] inside geoms[i], a chunk at a time on the
+        # thread pool
+        lines = shapely.linestrings(np.stack((A, B), axis=1))
+        out = np.zeros(len(lines))
+
+        def work(s):
+            out[s] = _intersection_lengths(lines[s], geoms[s])
+
+        chunks = [slice(i, i + _THREAD_CHUNK) for i in range(0, len(lines), _THREAD_CHUNK)]
+        threads = self.threads or os.cpu_count()
+
+        if len(chunks) > 1 and threads > 1:
+            # list() to wait for them and pass on any exception
+            list(_thread_pool(threads).map(work, chunks))
+        else:
+            for s in chunks:
+                work(s)
+
+        return out
+
+    def _construct_paths_shapely2(self, A, B):
+        paths = np.zeros((A.shape[0], 1 + len(self.solids)), dtype=self.dtype)
+
+        with profiling.phase("construct_path.index_query"):
+            rays, solids = self.index.query_batch(A, B)
+
+        with profiling.phase("construct_path.solids"):
+            chords = self._lengths_shapely2(A[rays], B[rays], self.geoms[solids])
+            paths[rays, 1 + solids] = chords
+
+        with profiling.phase("construct_path.empty"):
+            empty = np.empty(A.shape[0], dtype=object)
+            empty[:] = [self.empty] * A.shape[0]
+            paths[:, 0] = self._lengths_shapely2(A, B, empty)
+
+        prof = profiling.active
+        if prof is not None:
+            prof.count("rays_cast", A.shape[0])
+            prof.count("solids_tested", len(solids))
+            prof.count("intersections_nonempty", np.count_nonzero(chords))
+
+        return paths
+
+    def construct_paths_with_gradient(self, A, B):
+        # construct_paths plus the (N, 1 + n_solids, 2) gradient of every
+        # path length with respect to the ray start A. This always uses the
+        # numpy engine, the shapely engine has no notion of derivatives.
+        A = np.asarray(A, dtype=np.float64).reshape(-1, 2)
+        B = np.asarray(B, dtype=np.float64).reshape(-1, 2)
+
+        paths = np.zeros((A.shape[0], 1 + len(self.solids)))
+        dpaths = np.zeros((A.shape[0], 1 + len(self.solids), 2))
+
+        rays, solids = self.index.query_batch(A, B)
+        paths[rays, 1 + solids], dpaths[rays, 1 + solids] = \
+            pair_chord_gradients(self.edges, A[rays], B[rays], solids)
+
+        inside, dinside = pair_chord_gradients(self.bbox_edges, A, B, np.zeros(A.shape[0], dtype=np.intp))
+
+        paths[:, 0] = np.maximum(inside - paths[:, 1:].sum(axis=1), 0.0)
+        dpaths[:, 0] = dinside - dpaths[:, 1:].sum(axis=1)
+
+        return paths, dpaths
 
     def is_intersect(self, a, b, threshold=0.0):
+        # True if no single solid blocks more than threshold of a -> b
+        if self.engine != "shapely":
+            return bool(self.visibility(a, b, threshold)[0])
+
+        prof = profiling.active
+        if prof is not None:
+            prof.count("visibility_rays")
+
         L = G.LineString([a, b])
 
-        for S in self.solids:
-            dl = S.find_path_length(L)
+        for i in self.index.query(a, b):
+            if prof is not None:
+                prof.count("solids_tested")
+                prof.solid(i)
+
+            S = self.solids[i]
+
+            # intersects is much cheaper than computing the intersection
+            if not S.geom.intersects(L):
+                continue
+
             if S.find_path_length(L) > threshold: # ray intersects at least one geometry object
                 return False                      # for greater than threshold distance
 
         return True
-        
+
+    def visibility(self, A, B, threshold=0.0):
+        """
+        Batched is_intersect over the rows of A and B, returns an (N,)
+        boolean array that is True where no single solid blocks more than
+        threshold of the ray.
+        """
+        A = np.asarray(A, dtype=np.float64).reshape(-1, 2)
+        B = np.asarray(B, dtype=np.float64).reshape(-1, 2)
+
+        if self.engine == "shapely":
+            return np.array([self.is_intersect(a, b, threshold) for (a, b) in zip(A, B)], dtype=bool)
+
+        visible = np.ones(A.shape[0], dtype=bool)
+
+        # Bounding box culling comes from the index, the survivors are
+        # tested in rounds: round k checks the k-th candidate solid of
+        # every ray that isn't blocked yet, so a ray stops being traced as
+        # soon as something blocks it.
+        with profiling.phase("visibility.index_query"):
+            rays, solids = self.index.query_batch(A, B)
+
+        rank = np.arange(len(rays)) - np.searchsorted(rays, rays)
+        tested = 0
+
+        with profiling.phase("visibility.solids"):
+            for k in range(rank.max() + 1 if len(rank) else 0):
+                sel = np.flatnonzero(rank == k)
+                sel = sel[visible[rays[sel]]]
+
+                if len(sel) == 0:
+                    break
+
+                r = rays[sel]
+
+                if self.engine == "shapely2":
+                    chords = self._lengths_shapely2(A[r], B[r], self.geoms[solids[sel]])
+                else:
+                    chords = pair_chord_lengths(self.edges, A[r], B[r], solids[sel])
+                visible[r[chords > threshold]] = False
+
+                tested += len(sel)
+
+        prof = profiling.active
+        if prof is not None:
+            prof.count("visibility_rays", A.shape[0])
+            prof.count("solids_tested", tested)
+
+        return visible
 
     def _as_dict(self):
         solids = [i._as_dict() for i in self.solids]
@@ -69,4 +568,4 @@ class Domain(Dictable):
     def _from_dict(cls, data):
         solids = [Solid._from_dict(i) for i in data["solids"]]
 
-        return cls(data["bbox"], solids)
+        return cls(data["bbox"], solids, union=data.get("union"), empty=data.get("empty"))
@@ -2,20 +2,19 @@ import numpy as np
 from gefry3.classes import *
 from gefry3.classes.meta import Dictable
 
-try:
-    import pyst
-    PYST_AVAIL = True
-except ImportError:
-    PYST_AVAIL = False
+import time
+
+from gefry3 import profiling
 
-from shapely.geometry import MultiPoint, LineString, Polygon
 from functools import partial
 from collections import defaultdict
 
-__all__ = ["Source", "Detector", "detectorRegistry"]
+__all__ = ["Source", "Detector", "OrientedPrismDetector", "DetectorArray", "detectorRegistry"]
 
-if PYST_AVAIL:
-    __all__.append("OrientedPrismDetector")
+# The prism detectors used to need pyst for their solid angles. They use the
+# closed form below now and are always available, pyst is never imported.
+# Kept for code that still checks it.
+PYST_AVAIL = False
 
 class Source(Dictable):
     def __init__(self, R, I0):
@@ -40,11 +39,31 @@ class Detector(Dictable):
         r = np.array(r, dtype=np.float64)
         I = np.float64(I)
 
-        dr = np.linalg.norm(self.R - r)
-        beta = 4 * np.pi * (np.linalg.norm(dr) ** 2)
+        beta = 4 * np.pi * ((self.R - r) ** 2).sum()
 
         return I * self.area * self.dwell * self.epsilon / beta
 
+    def compute_responses(self, I, R):
+        # Vectorized compute_response for intensities I (N,) and source
+        # positions R (N, 2)
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        I = np.asarray(I, dtype=np.float64)
+
+        beta = 4 * np.pi * ((self.R - R) ** 2).sum(axis=1)
+
+        return I * self.area * self.dwell * self.epsilon / beta
+
+    def compute_response_gradients(self, I, R):
+        # Gradient of compute_responses with respect to the source
+        # positions, (N, 2), for fixed I. For the inverse square law
+        # d/dr |R_det - r|^-2 = 2 (R_det - r) / |R_det - r|^4.
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        dR = self.R - R
+
+        response = self.compute_responses(I, R)
+
+        return 2 * response[:, None] * dR / (dR ** 2).sum(axis=1)[:, None]
+
     def _as_dict(self):
         return {
             "R": self.R,
@@ -65,193 +84,486 @@ class Detector(Dictable):
 def vec_2d_to_3d(x, val=0.0):
     return np.hstack((x, np.atleast_1d(val)))
 
-if PYST_AVAIL:
-    class OrientedPrismDetector(Detector):
-        # derives from detector but it's gonna override everything
-
-        def __init__(self, R, L, theta, epsilon, dwell):
-            """
-            R is the coordinate of the center of mass
-            L is [l, w, h] dimensions
-            Theta is rotation in radians ccw from the x-axis.
-
-            Detector will be placed s.t. the COM is coplanar to the source.
-            """
-
-            self.R = np.array(R, dtype=np.float64)
-            self._R3 = vec_2d_to_3d(self.R)
-            self.dims = np.array(L, dtype=np.float64)
-            self.theta = np.float64(theta)
-            self.dwell = np.float64(dwell)
-            self.epsilon = np.float64(epsilon)
-            self.d = np.linalg.norm(self.R)
-
-            l, w, h = self.dims
-
-            self.vertices = np.array([
-                [0, 0, 0],
-                [l, 0, 0],
-                [l, w, 0],
-                [0, w, 0],
-
-                [0, 0, h],
-                [l, 0, h],
-                [l, w, h],
-                [0, w, h],
-            ])
-
-            # Center because I gave the coordinates as corner-relative
-            self.vertices -= self.dims / 2.
-
-            self._rotation_matrix = pyst.RotationMatrix \
-                . rot(self.theta, direction="z")
-
-            self.vertices = self._rotation_matrix(self.vertices)
-            self.vertices += self._R3
-
-            # Hrm... maybe use center = r, they should be the same...
-            self.corner = self.vertices[0]
-            self.center = self.vertices[0] + self._rotation_matrix(self.dims) / 2.
-
-            # Vectors defining the prism
-            self.r_x, self.r_y, self.r_z = self._rotation_matrix(np.diag([l, w, h]))
-
-            # Assuming they are coplanar we can skip the top and bottom to save computation
-            self.facets = [
-                pyst.RectangularFacet(
-                    self.corner,
-                    self.r_x,
-                    self.r_z,
-                    sense=1.0,
-                    name="Front",
-                ),
-                pyst.RectangularFacet(
-                    self.corner + self.r_y,
-                    self.r_x,
-                    self.r_z,
-                    sense=-1.0,
-                    name="Back",
-                ),
-                # pyst.RectangularFacet(corner + self.r_z, self.r_x, self.r_y, sense=1.0, name="Top"),
-                # pyst.RectangularFacet(corner, self.r_x, self.r_y, sense=-1.0, name="Bottom"),
-                pyst.RectangularFacet(
-                    self.corner + self.r_x,
-                    self.r_y,
-                    self.r_z,
-                    sense=1.0,
-                    name="Right",
-                ),
-                pyst.RectangularFacet(
-                    self.corner,
-                    self.r_y,
-                    self.r_z,
-                    sense=-1.0,
-                    name="Left",
-                ),
-            ]
-
-        def omega(self, r):
-            r = np.array(r, dtype=np.float64)
-            r3 = vec_2d_to_3d(r)
-
-            return sum([facet(r3) for facet in self.facets if facet.is_facing(r3)])
-
-        def compute_response(self, I, r):
-            r = np.array(r, dtype=np.float64)
-            I = np.float64(I)
-
-            dr = np.linalg.norm(self.R - r)
-            beta = self.omega(r) / (4. * np.pi)
-
-            return I * beta * self.dwell * self.epsilon
-
-        def _as_dict(self):
-            return {
-                "R": self.R,
-                "lwh": self.dims.tolist(),
-                "theta": self.theta,
-                "epsilon": self.epsilon,
-                "dwell": self.dwell,
-            }
-
-        @classmethod
-        def _from_dict(cls, data):
-            return cls(
-                data["R"],
-                data["lwh"],
-                data["theta"],
-                data["epsilon"],
-                data["dwell"],
-            )
+def rotation_z(theta):
+    # Rotation by theta radians ccw about the z axis
+    c, s = np.cos(theta), np.sin(theta)
+
+    return np.array([
+        [c, -s, 0.0],
+        [s, c, 0.0],
+        [0.0, 0.0, 1.0],
+    ])
+
+def to_detector_frame(R, center, cos, sin):
+    # Source positions R (..., 2) relative to detector centers, in the
+    # frame of detectors rotated by theta (cos, sin), as (x, y) components
+    dx = R[..., 0] - center[..., 0]
+    dy = R[..., 1] - center[..., 1]
+
+    return cos * dx + sin * dy, cos * dy - sin * dx
+
+def _facet_pair_solid_angle(u, d, half_span, half_h):
+    # Solid angle of a vertical rectangle spanning [-half_span, half_span]
+    # horizontally and [-half_h, half_h] vertically, seen from distance d
+    # off its plane, at offset u along it and at mid height. Each quarter
+    # is atan(u c / (d sqrt(u^2 + c^2 + d^2))).
+    def quarter(v):
+        return np.arctan2(v * half_h, d * np.sqrt(v * v + half_h * half_h + d * d))
+
+    return 2 * (quarter(half_span - u) + quarter(half_span + u))
+
+def prism_solid_angles(x, y, half):
+    """
+    Solid angle of a rectangular prism with half dimensions half = (l/2,
+    w/2, h/2) seen from (x, y) in the detector frame, in the plane through
+    its center. Only the side facets facing the point count; from that
+    plane at most one of front/back and one of left/right do, and the top
+    and bottom are edge on. Everything broadcasts.
+    """
+    hl, hw, hh = half[..., 0], half[..., 1], half[..., 2]
+
+    # Front/back facets are normal to y, left/right normal to x
+    dy = np.abs(y) - hw
+    dx = np.abs(x) - hl
+
+    return np.where(dy > 0, _facet_pair_solid_angle(x, dy, hl, hh), 0.0) \
+        + np.where(dx > 0, _facet_pair_solid_angle(y, dx, hw, hh), 0.0)
+
+def _slab(p, d, h):
+    # Parameter interval of the line p + t d inside |.| <= h, rays
+    # parallel to the slab are either inside it for every t or never
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t0 = (-h - p) / d
+        t1 = (h - p) / d
+
+    parallel = d == 0
+    inside = np.abs(p) <= h
+
+    lo = np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(t0, t1))
+    hi = np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(t0, t1))
+
+    return lo, hi
+
+def slab_chord_lengths(px, py, dx, dy, hx, hy):
+    """
+    Length of the segments (px, py) + t (dx, dy), 0 <= t <= 1, inside the
+    boxes |x| <= hx, |y| <= hy. Everything broadcasts.
+    """
+    lo_x, hi_x = _slab(px, dx, hx)
+    lo_y, hi_y = _slab(py, dy, hy)
+
+    t_in = np.maximum(np.maximum(lo_x, lo_y), 0.0)
+    t_out = np.minimum(np.minimum(hi_x, hi_y), 1.0)
+
+    return np.maximum(t_out - t_in, 0.0) * np.sqrt(dx * dx + dy * dy)
+
+def intrinsic_efficiencies(x, y, half, extension, sigma_det, cos, sin):
+    # 1 - exp(-sigma_det L) where L is the chord through the footprint
+    # (half widths half[..., :2]) of the ray from the source at (x, y) in
+    # the detector frame towards the center, extended past it by extension
+    # so it always crosses the whole detector.
+    r = np.sqrt(x * x + y * y)
+
+    # A source sitting on the center looks along the global +x axis
+    at_center = r == 0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = 1.0 + extension / r
+        dx = np.where(at_center, extension * cos, -x * scale)
+        dy = np.where(at_center, -extension * sin, -y * scale)
+
+    L = slab_chord_lengths(x, y, dx, dy, half[..., 0], half[..., 1])
+
+    return 1.0 - np.exp(-sigma_det * L)
+
+class OrientedPrismDetector(Detector):
+    # derives from detector but it's gonna override everything
+
+    def __init__(self, R, L, theta, epsilon, dwell):
+        """
+        R is the coordinate of the center of mass
+        L is [l, w, h] dimensions
+        Theta is rotation in radians ccw from the x-axis.
+
+        Detector will be placed s.t. the COM is coplanar to the source.
+        """
+        self.R = np.array(R, dtype=np.float64)
+        self._R3 = vec_2d_to_3d(self.R)
+        self.dims = np.array(L, dtype=np.float64)
+        self.theta = np.float64(theta)
+        self.dwell = np.float64(dwell)
+        self.epsilon = np.float64(epsilon)
+        self.d = np.linalg.norm(self.R)
+
+        l, w, h = self.dims
+
+        self.vertices = np.array([
+            [0, 0, 0],
+            [l, 0, 0],
+            [l, w, 0],
+            [0, w, 0],
+
+            [0, 0, h],
+            [l, 0, h],
+            [l, w, h],
+            [0, w, h],
+        ])
+
+        # Center because I gave the coordinates as corner-relative
+        self.vertices -= self.dims / 2.
+
+        self._rotation_matrix = rotation_z(self.theta)
+
+        self.vertices = self.vertices.dot(self._rotation_matrix.T)
+        self.vertices += self._R3
+
+        # Hrm... maybe use center = r, they should be the same...
+        self.corner = self.vertices[0]
+        self.center = self.vertices[0] + self._rotation_matrix.dot(self.dims) / 2.
+
+        # Vectors defining the prism
+        self.r_x, self.r_y, self.r_z = np.diag([l, w, h]).dot(self._rotation_matrix.T)
+
+        # What the vectorized solid angle needs: the half dimensions and
+        # the rotation into the detector frame
+        self._half = self.dims / 2.
+        self._cos, self._sin = np.cos(self.theta), np.sin(self.theta)
+
+    def omega(self, r):
+        return self.omegas(r)[0]
+
+    def omegas(self, R):
+        # Solid angle subtended by the detector at each source position in
+        # R (N, 2), the source is in the plane of the detector center
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+
+        with profiling.phase("detector.omega"):
+            x, y = to_detector_frame(R, self.center[:2], self._cos, self._sin)
+
+            return prism_solid_angles(x, y, self._half)
+
+    def compute_response(self, I, r):
+        r = np.array(r, dtype=np.float64)
+        I = np.float64(I)
+
+        dr = np.linalg.norm(self.R - r)
+        beta = self.omega(r) / (4. * np.pi)
+
+        return I * beta * self.dwell * self.epsilon
 
+    def compute_responses(self, I, R):
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        I = np.asarray(I, dtype=np.float64)
 
-    class OrientedPrismDetectorIntrinsic(OrientedPrismDetector):
-
-        def __init__(self, R, L, theta, sigma_det, dwell):
-            # sigma_det is the detection macro cross section, in m^-1
-            super().__init__(R, L, theta, 1.0, dwell)
-
-            self.sigma_det = sigma_det
-            self.profile = Polygon([
-                self.vertices[0, :2],
-                self.vertices[1, :2],
-                self.vertices[2, :2],
-                self.vertices[3, :2]
-            ])
-
-            # Extend an intersecting ray by this much to make sure
-            # it always travels the full extent of the detector
-            self._length_extension = self.dims.max()
-
-        def compute_intrinsic(self, R):
-            # source to detector angle
-            dR = self.center[:2] - R
-            theta = np.arctan2(dR[1], dR[0])
-
-            # extend the ray a bit to make sure it crosses the full
-            # length of the detector
-            extension = self._length_extension * np.array([
-                np.cos(theta),
-                np.sin(theta),
-            ])
-
-            L = LineString([R, self.center[:2] + extension])
-            dL = self.profile.intersection(L)
-
-            return 1.0 - np.exp(-self.sigma_det * dL.length)
-
-        def compute_response(self, I, r):
-            r = np.array(r, dtype=np.float64)
-            I = np.float64(I)
-
-            dr = np.linalg.norm(self.R - r)
-            beta = self.omega(r) / (4. * np.pi)
-
-            return I * beta * self.dwell * self.compute_intrinsic(r)
-
-        def _as_dict(self):
-            return {
-                "R": self.R,
-                "lwh": self.dims.tolist(),
-                "theta": self.theta,
-                "sigma_det": self.sigma_det,
-                "dwell": self.dwell,
-            }
-
-        @classmethod
-        def _from_dict(cls, data):
-            return cls(
-                data["R"],
-                data["lwh"],
-                data["theta"],
-                data["sigma_det"],
-                data["dwell"],
-            ) 
+        return I * self.omegas(R) / (4. * np.pi) * self.dwell * self.epsilon
+
+    def compute_response_gradients(self, I, R, h=1e-6):
+        # The solid angle has no closed form derivative here, use central
+        # differences with a step of h (relative to the distance)
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        I = np.broadcast_to(np.asarray(I, dtype=np.float64), R.shape[:1])
+
+        dr = h * np.maximum(1.0, np.linalg.norm(self.R - R, axis=1))
+        grad = np.empty(R.shape)
+
+        for k in range(2):
+            step = np.zeros(R.shape)
+            step[:, k] = dr
+
+            grad[:, k] = (self.compute_responses(I, R + step) - self.compute_responses(I, R - step)) / (2 * dr)
+
+        return grad
+
+    def _as_dict(self):
+        return {
+            "R": self.R,
+            "lwh": self.dims.tolist(),
+            "theta": self.theta,
+            "epsilon": self.epsilon,
+            "dwell": self.dwell,
+        }
+
+    @classmethod
+    def _from_dict(cls, data):
+        return cls(
+            data["R"],
+            data["lwh"],
+            data["theta"],
+            data["epsilon"],
+            data["dwell"],
+        )
+
+
+class OrientedPrismDetectorIntrinsic(OrientedPrismDetector):
+
+    def __init__(self, R, L, theta, sigma_det, dwell):
+        # sigma_det is the detection macro cross section, in m^-1
+        super().__init__(R, L, theta, 1.0, dwell)
+
+        self.sigma_det = sigma_det
+
+        # Extend an intersecting ray by this much to make sure
+        # it always travels the full extent of the detector
+        self._length_extension = self.dims.max()
+
+    def compute_intrinsic(self, R):
+        return self.compute_intrinsics(R)[0]
+
+    def compute_intrinsics(self, R):
+        # Intrinsic efficiency for sources at R (N, 2)
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        x, y = to_detector_frame(R, self.center[:2], self._cos, self._sin)
+
+        return intrinsic_efficiencies(x, y, self._half, self._length_extension, self.sigma_det, self._cos, self._sin)
+
+    def compute_response(self, I, r):
+        r = np.array(r, dtype=np.float64)
+        I = np.float64(I)
+
+        dr = np.linalg.norm(self.R - r)
+        beta = self.omega(r) / (4. * np.pi)
+
+        return I * beta * self.dwell * self.compute_intrinsic(r)
+
+    def compute_responses(self, I, R):
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        I = np.asarray(I, dtype=np.float64)
+
+        return I * self.omegas(R) / (4. * np.pi) * self.dwell * self.compute_intrinsics(R)
+
+    def _as_dict(self):
+        return {
+            "R": self.R,
+            "lwh": self.dims.tolist(),
+            "theta": self.theta,
+            "sigma_det": self.sigma_det,
+            "dwell": self.dwell,
+        }
+
+    @classmethod
+    def _from_dict(cls, data):
+        return cls(
+            data["R"],
+            data["lwh"],
+            data["theta"],
+            data["sigma_det"],
+            data["dwell"],
+        ) 
 
 detectorRegistry = {
     "Point": Detector,
+    "Oriented_Prism": OrientedPrismDetector,
+    "Oriented_Prism_Intrinsic": OrientedPrismDetectorIntrinsic,
 }
 
-if PYST_AVAIL:
-    detectorRegistry["Oriented_Prism"] = OrientedPrismDetector
-    detectorRegistry["Oriented_Prism_Intrinsic"] = OrientedPrismDetectorIntrinsic
+def _detector_type(detector):
+    # Registry name of a detector, the inverse of detectorRegistry, None
+    # for detector classes that aren't registered
+    for (name, cls) in detectorRegistry.items():
+        if type(detector) is cls:
+            return name
+
+    return None
+
+def _defined_in(detector, method):
+    # Class in the detector's MRO that defines method
+    return next(c for c in type(detector).__mro__ if method in vars(c))
+
+def _follows_compute_response(detector, method):
+    # True unless the detector overrides compute_response further down than
+    # method, in which case the inherited method computes something else
+    return issubclass(_defined_in(detector, method), _defined_in(detector, "compute_response"))
+
+class DetectorArray(Dictable):
+    """
+    A list of detectors stored as contiguous arrays, grouped by type, so
+    the responses of all detectors to many sources are computed at once.
+    All the built in detector types are vectorized. Anything else (any
+    Detector subclass, registered or not) falls back to its own
+    compute_responses, or to compute_response a source at a time if that
+    is all the subclass overrides.
+    """
+
+    # Types handled here rather than by the detectors themselves
+    VECTORIZED = ("Point", "Oriented_Prism", "Oriented_Prism_Intrinsic")
+
+    def __init__(self, detectors):
+        self.detectors = list(detectors)
+        self.types = [_detector_type(d) for d in self.detectors]
+
+        # Detector indices for each type, in order of first appearance
+        self.groups = {}
+        for (i, name) in enumerate(self.types):
+            self.groups.setdefault(name, []).append(i)
+
+        self.groups = {k: np.array(v, dtype=np.intp) for (k, v) in self.groups.items()}
+
+        self.R = np.array([d.R for d in self.detectors], dtype=np.float64).reshape(-1, 2)
+        self.epsilon = np.array([getattr(d, "epsilon", np.nan) for d in self.detectors], dtype=np.float64)
+        self.area = np.array([getattr(d, "area", np.nan) for d in self.detectors], dtype=np.float64)
+        self.dwell = np.array([d.dwell for d in self.detectors], dtype=np.float64)
+
+        # Point detector response per unit intensity is coef / |R_det - r|^2
+        self._point = self.groups.get("Point", np.zeros(0, dtype=np.intp))
+        self._coef = (self.area * self.dwell * self.epsilon / (4 * np.pi))[self._point]
+
+        # Prism detector response per unit intensity is omega * prism_coef,
+        # times the intrinsic efficiency for the intrinsic type
+        self._intrinsic = self.groups.get("Oriented_Prism_Intrinsic", np.zeros(0, dtype=np.intp))
+        self._prism = np.sort(np.concatenate((
+            self.groups.get("Oriented_Prism", np.zeros(0, dtype=np.intp)),
+            self._intrinsic,
+        )))
+        self._prism_coef = (self.dwell * self.epsilon / (4 * np.pi))[self._prism]
+
+        prisms = [self.detectors[i] for i in self._prism]
+        self._frames = (
+            np.array([d.center[:2] for d in prisms]).reshape(-1, 2),
+            np.array([d._cos for d in prisms]),
+            np.array([d._sin for d in prisms]),
+        )
+        self._half = np.array([d._half for d in prisms]).reshape(-1, 3)
+
+        # Intrinsic detectors as columns of the prism arrays
+        self._intrinsic_cols = np.searchsorted(self._prism, self._intrinsic)
+        intrinsic = [self.detectors[i] for i in self._intrinsic]
+        self._extension = np.array([d._length_extension for d in intrinsic])
+        self._sigma_det = np.array([d.sigma_det for d in intrinsic], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.detectors)
+
+    def __getitem__(self, i):
+        return self.detectors[i]
+
+    def __iter__(self):
+        return iter(self.detectors)
+
+    def _other_groups(self):
+        return [(k, v) for (k, v) in self.groups.items() if k not in self.VECTORIZED]
+
+    def _fallback_responses(self, i, I, R):
+        d = self.detectors[i]
+
+        if _follows_compute_response(d, "compute_responses"):
+            return d.compute_responses(I, R)
+
+        return np.array([d.compute_response(a, r) for (a, r) in zip(I, R)], dtype=np.float64)
+
+    def _fallback_gradients(self, i, I, R, h=1e-6):
+        d = self.detectors[i]
+
+        if _follows_compute_response(d, "compute_response_gradients"):
+            return d.compute_response_gradients(I, R)
+
+        # Central differences, like OrientedPrismDetector
+        dr = h * np.maximum(1.0, np.linalg.norm(d.R - R, axis=1))
+        grad = np.empty(R.shape)
+
+        for k in range(2):
+            step = np.zeros(R.shape)
+            step[:, k] = dr
+
+            grad[:, k] = (self._fallback_responses(i, I, R + step) - self._fallback_responses(i, I, R - step)) / (2 * dr)
+
+        return grad
+
+    def prism_responses(self, R):
+        # Unit intensity responses of all the prism detectors (both types)
+        # to sources at R (N, 2), (N, n_prisms)
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        x, y = to_detector_frame(R[:, None], *self._frames)
+
+        with profiling.phase("detector.omega"):
+            responses = self._prism_coef * prism_solid_angles(x, y, self._half)
+
+        if len(self._intrinsic):
+            k = self._intrinsic_cols
+            cos, sin = self._frames[1][k], self._frames[2][k]
+
+            responses[:, k] *= intrinsic_efficiencies(
+                x[:, k], y[:, k], self._half[k], self._extension, self._sigma_det, cos, sin
+            )
+
+        return responses
+
+    def _record(self, prof, idx, t, calls):
+        # One vectorized expression for the group, so split the time evenly
+        dt = (time.perf_counter() - t) / len(idx)
+
+        for i in idx:
+            prof.detector(i, dt, calls=calls)
+
+    def compute_responses(self, I, R):
+        """
+        Responses of every detector to sources at R (N, 2), where I is the
+        (N, n_detectors) intensity seen by each detector (anything that
+        broadcasts to it works). Returns an (N, n_detectors) array.
+        """
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        I = np.broadcast_to(np.asarray(I, dtype=np.float64), (R.shape[0], len(self)))
+
+        responses = np.empty(I.shape)
+        prof = profiling.active
+
+        if len(self._point):
+            if prof is not None:
+                t = time.perf_counter()
+
+            dR = self.R[None, self._point] - R[:, None]
+            responses[:, self._point] = I[:, self._point] * self._coef / (dR ** 2).sum(axis=2)
+
+            if prof is not None:
+                self._record(prof, self._point, t, R.shape[0])
+
+        if len(self._prism):
+            if prof is not None:
+                t = time.perf_counter()
+
+            responses[:, self._prism] = I[:, self._prism] * self.prism_responses(R)
+
+            if prof is not None:
+                self._record(prof, self._prism, t, R.shape[0])
+
+        for (_, idx) in self._other_groups():
+            for i in idx:
+                if prof is not None:
+                    t = time.perf_counter()
+
+                responses[:, i] = self._fallback_responses(i, I[:, i], R)
+
+                if prof is not None:
+                    prof.detector(i, time.perf_counter() - t, calls=R.shape[0])
+
+        return responses
+
+    def compute_response_gradients(self, I, R):
+        # Gradients of compute_responses with respect to the source
+        # positions for fixed I, (N, n_detectors, 2)
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        I = np.broadcast_to(np.asarray(I, dtype=np.float64), (R.shape[0], len(self)))
+
+        grad = np.empty(I.shape + (2,))
+
+        if len(self._point):
+            dR = self.R[None, self._point] - R[:, None]
+            d2 = (dR ** 2).sum(axis=2)
+            response = I[:, self._point] * self._coef / d2
+
+            grad[:, self._point] = 2 * (response / d2)[..., None] * dR
+
+        for (name, idx) in self.groups.items():
+            if name == "Point":
+                continue
+
+            for i in idx:
+                grad[:, i] = self._fallback_gradients(i, I[:, i], R)
+
+        return grad
+
+    def _as_dict(self):
+        return [dict(d._as_dict(), type=name) for (name, d) in zip(self.types, self.detectors)]
+
+    @classmethod
+    def _from_dict(cls, data):
+        return cls([detectorRegistry[i["type"]]._from_dict(i) for i in data])
@@ -0,0 +1,195 @@
+import numpy as np
+
+# Uniform grid over the solid bounding boxes, used by Domain to cull the
+# solids a ray has to be tested against. Each solid is registered in every
+# cell its bounding box touches; a ray query walks the cells the segment
+# passes through (column by column) and returns the solids registered
+# there whose bounding box the segment actually crosses.
+
+__all__ = ["SolidGrid"]
+
+# Relative padding applied to cell ranges so rounding can only ever add
+# candidates, never drop them
+_EPS = 1e-9
+
+def segment_box_overlap(A, B, boxes):
+    # Liang-Barsky clip of the segments A -> B against boxes
+    # (xmin, ymin, xmax, ymax), all arrays broadcast against each other
+    D = B - A
+
+    t0 = np.zeros(np.broadcast(A[..., 0], boxes[..., 0]).shape)
+    t1 = np.ones_like(t0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for k in range(2):
+            lo = (boxes[..., k] - A[..., k]) / D[..., k]
+            hi = (boxes[..., k + 2] - A[..., k]) / D[..., k]
+
+            # Segments parallel to this axis must start inside the slab,
+            # otherwise (inf, inf) empties the interval
+            parallel = D[..., k] == 0
+            inside = (A[..., k] >= boxes[..., k]) & (A[..., k] <= boxes[..., k + 2])
+
+            lo = np.where(parallel, np.where(inside, -np.inf, np.inf), lo)
+            hi = np.where(parallel, np.inf, hi)
+
+            t0 = np.maximum(t0, np.minimum(lo, hi))
+            t1 = np.minimum(t1, np.maximum(lo, hi))
+
+    return t0 <= t1
+
+class SolidGrid(object):
+    def __init__(self, bounds, extent=None, solids_per_cell=1.0):
+        self.bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        n = self.bounds.shape[0]
+
+        if extent is None:
+            extent = np.hstack((self.bounds[:, :2].min(axis=0, initial=0.0), self.bounds[:, 2:].max(axis=0, initial=1.0)))
+
+        x0, y0, x1, y1 = extent
+        self.origin = np.array([x0, y0])
+
+        # Aim for roughly solids_per_cell solids per cell with square-ish cells
+        w, h = max(x1 - x0, _EPS), max(y1 - y0, _EPS)
+        n_cells = max(1.0, n / solids_per_cell)
+
+        self.nx = int(np.clip(np.ceil(np.sqrt(n_cells * w / h)), 1, n_cells))
+        self.ny = int(np.clip(np.ceil(n_cells / self.nx), 1, n_cells))
+        self.cell = np.array([w / self.nx, h / self.ny])
+        self._last_cell = np.array([self.nx - 1, self.ny - 1])
+
+        # Cells covered by each solid, stored CSR style: the solids in cell c
+        # are self.cell_solids[self.cell_start[c]:self.cell_start[c + 1]]
+        self._store(*self._solid_cells(self.bounds, np.arange(n)))
+
+    def _solid_cells(self, bounds, ids):
+        # (cell, solid) entries for solids ids with the given bounds
+        lo = self._cell_index(bounds[:, :2], -1)
+        hi = self._cell_index(bounds[:, 2:], 1)
+
+        cells, owners = [], []
+        for (i, l, h) in zip(ids, lo, hi):
+            ix, iy = np.meshgrid(
+                np.arange(l[0], h[0] + 1),
+                np.arange(l[1], h[1] + 1),
+            )
+
+            cells.append((ix * self.ny + iy).ravel())
+            owners.append(np.full(ix.size, i))
+
+        cells = np.concatenate(cells + [np.zeros(0, dtype=np.intp)]).astype(np.intp)
+        owners = np.concatenate(owners + [np.zeros(0, dtype=np.intp)]).astype(np.intp)
+
+        return cells, owners
+
+    def _entries(self):
+        # Inverse of _store
+        cells = np.repeat(np.arange(self.nx * self.ny), np.diff(self.cell_start))
+
+        return cells, self.cell_solids
+
+    def _store(self, cells, owners):
+        order = np.lexsort((owners, cells))
+        self.cell_solids = owners[order]
+        self.cell_start = np.searchsorted(cells[order], np.arange(self.nx * self.ny + 1))
+
+    # Incremental updates. The grid itself stays fixed, only the cell
+    # lists change, so it's a good idea to rebuild after many edits.
+
+    def add(self, bounds):
+        # Register a new solid with the given bounds as the last one
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(1, 4)
+        cells, owners = self._entries()
+        new_cells, new_owners = self._solid_cells(bounds, [len(self)])
+
+        self.bounds = np.vstack((self.bounds, bounds))
+        self._store(np.concatenate((cells, new_cells)), np.concatenate((owners, new_owners)))
+
+    def remove(self, i):
+        # Drop solid i, later solids move down by one like a list
+        cells, owners = self._entries()
+        keep = owners != i
+
+        self.bounds = np.delete(self.bounds, i, axis=0)
+        self._store(cells[keep], owners[keep] - (owners[keep] > i))
+
+    def replace(self, i, bounds):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(1, 4)
+        cells, owners = self._entries()
+        keep = owners != i
+        new_cells, new_owners = self._solid_cells(bounds, [i])
+
+        self.bounds[i] = bounds
+        self._store(np.concatenate((cells[keep], new_cells)), np.concatenate((owners[keep], new_owners)))
+
+    def __len__(self):
+        return self.bounds.shape[0]
+
+    def _cell_index(self, X, direction):
+        # Cell containing each point, nudged in direction so that points
+        # on a cell boundary land on both sides
+        f = (X - self.origin) / self.cell + direction * _EPS * np.maximum(1.0, np.abs(X / self.cell))
+        i = np.floor(f).astype(np.intp)
+
+        return np.maximum(np.minimum(i, self._last_cell), 0)
+
+    def query(self, a, b):
+        # Candidate solids for a single segment, in ascending order
+        return self.query_batch(np.atleast_2d(a), np.atleast_2d(b))[1]
+
+    def query_batch(self, A, B):
+        """
+        Candidate (segment, solid) pairs for the segments A[i] -> B[i].
+        Returns two index arrays, sorted by segment and then by solid.
+        """
+        A = np.asarray(A, dtype=np.float64).reshape(-1, 2)
+        B = np.asarray(B, dtype=np.float64).reshape(-1, 2)
+
+        empty = np.zeros(0, dtype=np.intp)
+        if A.shape[0] == 0 or len(self) == 0:
+            return empty, empty
+
+        # Columns spanned by each segment
+        c_lo = self._cell_index(np.minimum(A, B), -1)[:, 0]
+        c_hi = self._cell_index(np.maximum(A, B), 1)[:, 0]
+
+        n_cols = c_hi - c_lo + 1
+        seg = np.repeat(np.arange(A.shape[0]), n_cols)
+        col = c_lo[seg] + np.arange(seg.size) - np.repeat(np.cumsum(n_cols) - n_cols, n_cols)
+
+        # y extent of each segment within each of its columns
+        a, b = A[seg], B[seg]
+        x_lo = np.maximum(self.origin[0] + col * self.cell[0], np.minimum(a[:, 0], b[:, 0]))
+        x_hi = np.minimum(self.origin[0] + (col + 1) * self.cell[0], np.maximum(a[:, 0], b[:, 0]))
+
+        dx = b[:, 0] - a[:, 0]
+        slope = np.divide(b[:, 1] - a[:, 1], dx, out=np.zeros_like(dx), where=dx != 0)
+
+        y_at_lo = np.where(dx != 0, a[:, 1] + slope * (x_lo - a[:, 0]), a[:, 1])
+        y_at_hi = np.where(dx != 0, a[:, 1] + slope * (x_hi - a[:, 0]), b[:, 1])
+
+        y = np.vstack((y_at_lo, y_at_hi))
+        r_lo = self._cell_index(np.column_stack((x_lo, y.min(axis=0))), -1)[:, 1]
+        r_hi = self._cell_index(np.column_stack((x_lo, y.max(axis=0))), 1)[:, 1]
+
+        # Expand to every (segment, cell) pair
+        n_rows = r_hi - r_lo + 1
+        k = np.repeat(np.arange(seg.size), n_rows)
+        row = r_lo[k] + np.arange(k.size) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+        cell = col[k] * self.ny + row
+        seg = seg[k]
+
+        # ... and then to every (segment, solid) pair
+        n_solids = self.cell_start[cell + 1] - self.cell_start[cell]
+        k = np.repeat(np.arange(cell.size), n_solids)
+        offset = np.arange(k.size) - np.repeat(np.cumsum(n_solids) - n_solids, n_solids)
+        solid = self.cell_solids[self.cell_start[cell[k]] + offset]
+        seg = seg[k]
+
+        # Solids spanning several cells show up more than once
+        key = np.unique(seg * len(self) + solid)
+        seg, solid = key // len(self), key % len(self)
+
+        hit = segment_box_overlap(A[seg], B[seg], self.bounds[solid])
+
+        return seg[hit], solid[hit]
@@ -0,0 +1,117 @@
+import numpy as np
+import json
+import hashlib
+
+import shapely.wkb
+
+from gefry3.parallel import pack_problem, unpack_problem
+from gefry3.problem import read_input_problem
+
+# Compiled input decks. Reading a YAML deck means parsing it, resolving the
+# material references and then building every polygon, the union of all
+# solids and the interstitial region, which adds up for big decks and
+# short-lived worker processes. compile_deck writes the already-resolved
+# problem to a single .npz file: vertex, material and detector data as
+# arrays plus the derived geometry as WKB, so load_compiled doesn't parse
+# any YAML or recompute any geometry.
+
+__all__ = ["compile_deck", "load_compiled", "deck_hash"]
+
+FORMAT_VERSION = 1
+
+class CompiledDeckError(Exception): pass
+
+def _jsonable(x):
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+
+    raise TypeError("Can't serialize {}".format(type(x).__name__))
+
+def _split_state(state):
+    # Separate the array part of a packed problem from the small stuff
+    # that goes into the JSON header
+    arrays = {k: v for (k, v) in state.items() if isinstance(v, np.ndarray)}
+    meta = {k: v for (k, v) in state.items() if k not in arrays}
+
+    return arrays, meta
+
+def _coordinate_dtypes(problem):
+    # dtypes of the deck's coordinates before pack_problem made them
+    # float64, e.g. integers from a YAML deck
+    vertices = [np.asarray(S.vertices) for S in problem.domain.solids]
+
+    return {
+        "vertices": np.result_type(*vertices).name if vertices else "float64",
+        "bbox": np.asarray(problem.domain.bbox_verts).dtype.name,
+        "source": np.asarray(problem.source.R).dtype.name,
+    }
+
+def deck_hash(problem):
+    """
+    SHA-256 of the packed problem (geometry, materials, detectors and
+    source). Anything derived from a deck can record this to detect that
+    it's stale.
+    """
+    arrays, meta = _split_state(pack_problem(problem))
+
+    # Storage precision doesn't change what the deck describes
+    meta.pop("precision", None)
+
+    h = hashlib.sha256()
+    h.update(json.dumps(meta, default=_jsonable, sort_keys=True).encode())
+
+    for k in sorted(arrays):
+        h.update(k.encode())
+        h.update(np.ascontiguousarray(arrays[k], dtype=np.float64).tobytes())
+
+    return h.hexdigest()
+
+def compile_deck(problem, fname, problem_type=None):
+    """
+    Write problem (a problem object, or the file name of a YAML deck which
+    is read with read_input_problem) to fname as a compiled deck.
+    """
+    if isinstance(problem, str):
+        problem = read_input_problem(problem, problem_type=problem_type)
+
+    arrays, meta = _split_state(pack_problem(problem))
+
+    meta["format_version"] = FORMAT_VERSION
+    meta["deck_hash"] = deck_hash(problem)
+    meta["dtypes"] = _coordinate_dtypes(problem)
+
+    domain = problem.domain
+    arrays["union_wkb"] = np.frombuffer(shapely.wkb.dumps(domain.all), dtype=np.uint8)
+    arrays["empty_wkb"] = np.frombuffer(shapely.wkb.dumps(domain.empty), dtype=np.uint8)
+
+    with open(fname, "wb") as f:
+        np.savez(f, meta=np.array(json.dumps(meta, default=_jsonable)), **arrays)
+
+def load_compiled(fname, engine="shapely"):
+    # Load a deck written by compile_deck
+    with np.load(fname) as data:
+        meta = json.loads(str(data["meta"]))
+
+        if meta.get("format_version") != FORMAT_VERSION:
+            raise CompiledDeckError("Compiled deck {} has format version {}, expected {}. Recompile it.".format(
+                fname,
+                meta.get("format_version"),
+                FORMAT_VERSION,
+            ))
+
+        state = dict(meta)
+        state.update({k: data[k] for k in data.files if k != "meta"})
+
+    # Coordinates come back with the dtypes the deck had. Solids are cast
+    # together, so a deck mixing integer and float solids gets all floats
+    # (the same values either way).
+    dtypes = state.pop("dtypes", {})
+    state["vertices"] = state["vertices"].astype(dtypes.get("vertices", "float64"))
+    state["bbox"] = state["bbox"].astype(dtypes.get("bbox", "float64"))
+    state["source"] = (np.array(state["source"][0], dtype=dtypes.get("source", "float64")), state["source"][1])
+    state["union"] = shapely.wkb.loads(state.pop("union_wkb").tobytes())
+    state["empty"] = shapely.wkb.loads(state.pop("empty_wkb").tobytes())
+
+    return unpack_problem(state, engine=engine)
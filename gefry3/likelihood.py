@@ -0,0 +1,109 @@
+import numpy as np
+from math import lgamma
+
+# Log-likelihoods of observed counts for batches of source proposals, built
+# on the batched problem API. A proposal is a row (x, y, I); the expected
+# counts at each detector are the problem response plus background * dwell.
+#
+#     L = gefry3.PoissonLikelihood(P, counts, background=300)
+#     L(X)                 # (N,) log-likelihoods for the (N, 3) proposals X
+#     L.gradient(X)        # ... and their (N, 3) gradients
+#
+# Extra arguments for the problem (e.g. the materials for a
+# PerturbableXSProblem) go in args.
+
+__all__ = ["PoissonLikelihood", "GaussianLikelihood"]
+
+class Likelihood(object):
+    def __init__(self, problem, counts, background=0.0, dwell=None, args=()):
+        """
+        counts are the observed counts per detector, background the
+        background rate (cps, scalar or per detector) and dwell the count
+        times, which default to the detector dwell times.
+        """
+        self.problem = problem
+        self.counts = np.asarray(counts, dtype=np.float64)
+        self.background = np.broadcast_to(np.asarray(background, dtype=np.float64), self.counts.shape)
+        self.args = tuple(args)
+
+        if dwell is None:
+            dwell = [d.dwell for d in problem.detectors]
+
+        self.dwell = np.broadcast_to(np.asarray(dwell, dtype=np.float64), self.counts.shape)
+        self.expected_background = self.background * self.dwell
+
+    def __call__(self, X):
+        return self.log_likelihood(X)
+
+    def _proposals(self, X):
+        X = np.asarray(X, dtype=np.float64)
+
+        return X.reshape(-1, 3), X.ndim == 1
+
+    def expected(self, X):
+        # (N, n_detectors) expected counts for the proposals X
+        X, _ = self._proposals(X)
+
+        return self.problem.evaluate_batch(X[:, :2], X[:, 2], *self.args) + self.expected_background
+
+    def log_likelihood(self, X):
+        X, single = self._proposals(X)
+        L = self._logpdf(self.expected(X))
+
+        return L[0] if single else L
+
+    def gradient(self, X):
+        """
+        Log-likelihoods and their gradients with respect to (x, y, I) for
+        the proposals X, (N,) and (N, 3).
+        """
+        X, single = self._proposals(X)
+
+        responses, jacobian = self.problem.evaluate_batch_with_gradient(X[:, :2], X[:, 2], *self.args)
+        mu = responses + self.expected_background
+
+        L = self._logpdf(mu)
+        dL = np.einsum("nd,ndk->nk", self._dlogpdf(mu), jacobian[..., :3])
+
+        return (L[0], dL[0]) if single else (L, dL)
+
+class PoissonLikelihood(Likelihood):
+    def __init__(self, problem, counts, background=0.0, dwell=None, args=()):
+        super().__init__(problem, counts, background=background, dwell=dwell, args=args)
+
+        # log(k!) doesn't depend on the proposal
+        self._log_factorial = sum(lgamma(k + 1) for k in self.counts)
+
+    def _logpdf(self, mu):
+        with np.errstate(divide="ignore"):
+            log_mu = np.log(mu)
+
+        # 0 log 0 = 0, detectors that can't see anything and saw nothing
+        terms = np.where(self.counts > 0, self.counts * log_mu, 0.0) - mu
+
+        return terms.sum(axis=1) - self._log_factorial
+
+    def _dlogpdf(self, mu):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.counts > 0, self.counts / mu, 0.0) - 1.0
+
+class GaussianLikelihood(Likelihood):
+    """
+    Independent Gaussian approximation to the counting statistics, with
+    variance per detector (the observed counts by default, floored at 1).
+    """
+
+    def __init__(self, problem, counts, background=0.0, dwell=None, variance=None, args=()):
+        super().__init__(problem, counts, background=background, dwell=dwell, args=args)
+
+        if variance is None:
+            variance = np.maximum(self.counts, 1.0)
+
+        self.variance = np.broadcast_to(np.asarray(variance, dtype=np.float64), self.counts.shape)
+        self._norm = -0.5 * np.log(2 * np.pi * self.variance).sum()
+
+    def _logpdf(self, mu):
+        return self._norm - 0.5 * ((mu - self.counts) ** 2 / self.variance).sum(axis=1)
+
+    def _dlogpdf(self, mu):
+        return -(mu - self.counts) / self.variance
@@ -0,0 +1,190 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
+
+from gefry3.classes import *
+from gefry3.classes.hardware import _detector_type
+from gefry3.problem import classRegistry
+
+# Multi-process evaluation of the batched problem API. Problems hold shapely
+# geometry, which is slow to pickle, so they are shipped to the workers in
+# a compact array form (pack_problem) and rebuilt there once, when the
+# worker starts. Each batch is then cut into (source chunk, detector block)
+# work items and the results are put back together into one matrix.
+
+__all__ = ["pack_problem", "unpack_problem", "ParallelEvaluator"]
+
+def pack_problem(problem):
+    """
+    Flatten a problem into a dict of NumPy arrays and plain Python values
+    that pickles quickly and doesn't contain any shapely objects.
+    """
+    types = [_detector_type(d) for d in problem.detectors]
+    if None in types:
+        d = problem.detectors[types.index(None)]
+        raise ValueError("Detector class {} isn't in detectorRegistry, so it can't be packed".format(type(d).__name__))
+
+    solids = problem.domain.solids
+    vertices = [np.asarray(S.vertices, dtype=np.float64).reshape(-1, 2) for S in solids]
+
+    state = {
+        "problem_type": problem.PROBLEM_TYPE,
+        "bbox": np.asarray(problem.domain.bbox_verts, dtype=np.float64),
+        "vertices": np.concatenate(vertices + [np.zeros((0, 2))]),
+        "offsets": np.cumsum([0] + [len(V) for V in vertices]),
+        "interstitial_material": np.array([
+            problem.interstitial_material.number_dens,
+            problem.interstitial_material.sigma_t,
+        ]),
+        "source": (np.asarray(problem.source.R, dtype=np.float64), problem.source.I0),
+        "detectors": [(name, d._as_dict()) for (name, d) in zip(types, problem.detectors)],
+        "precision": problem.precision,
+    }
+
+    if hasattr(problem, "materials"):
+        state["materials"] = np.array(
+            [[M.number_dens, M.sigma_t] for M in problem.materials]
+        ).reshape(-1, 2)
+
+    if hasattr(problem, "distance_threshold"):
+        state["distance_threshold"] = problem.distance_threshold
+
+    return state
+
+def unpack_problem(state, engine="numpy"):
+    # Inverse of pack_problem
+    offsets = state["offsets"]
+    vertices = state["vertices"]
+
+    domain = {
+        "bbox": state["bbox"].tolist(),
+        "solids": [
+            {"vertices": vertices[i:j].tolist()}
+            for (i, j) in zip(offsets[:-1], offsets[1:])
+        ],
+    }
+
+    # Precomputed derived geometry, if the state carries any
+    for k in ("union", "empty"):
+        if k in state:
+            domain[k] = state[k]
+
+    spec = {
+        "domain": domain,
+        "interstitial_material": dict(zip(["number_dens", "sigma_t"], state["interstitial_material"])),
+        "source": dict(zip(["R", "I0"], state["source"])),
+        "detectors": [dict(data, type=name) for (name, data) in state["detectors"]],
+    }
+
+    if "materials" in state:
+        spec["materials"] = [
+            {"number_dens": n, "sigma_t": s} for (n, s) in state["materials"]
+        ]
+
+    if "distance_threshold" in state:
+        spec["distance_threshold"] = state["distance_threshold"]
+
+    problem = classRegistry[state["problem_type"]]._from_dict(spec)
+    problem.domain.engine = engine
+    problem.set_precision(state.get("precision", "double"))
+
+    return problem
+
+# Per-process state, set up by _init_worker
+_worker_problem = None
+_worker_subproblems = {}
+
+def _init_worker(state, engine, table):
+    global _worker_problem
+
+    _worker_problem = unpack_problem(state, engine=engine)
+
+    if table is not None:
+        _worker_problem.open_table(table)
+    _worker_subproblems.clear()
+
+def _subproblem(detectors):
+    # Shallow copy of the resident problem restricted to some detectors
+    if detectors is None:
+        return _worker_problem
+
+    if detectors not in _worker_subproblems:
+        p = copy(_worker_problem)
+        p.detectors = [_worker_problem.detectors[i] for i in range(*detectors)]
+
+        # The table has a column per detector of the full problem
+        if p.table is not None:
+            p.table = None
+            p.use_table(_worker_problem.table.detector_block(*detectors, problem=p))
+
+        _worker_subproblems[detectors] = p
+
+    return _worker_subproblems[detectors]
+
+def _evaluate_chunk(method, detectors, R, I, args):
+    return getattr(_subproblem(detectors), method)(R, I, *args)
+
+class ParallelEvaluator(object):
+    """
+    Evaluate a problem's batched API across a pool of worker processes.
+
+        with ParallelEvaluator(P, max_workers=64) as E:
+            responses = E.evaluate_batch(R, I)
+
+    Sources are split into chunks of chunk_size and the detectors into
+    detector_blocks contiguous blocks. Workers rebuild the problem once at
+    startup using the given path length engine. If the problem uses a
+    memory mapped PathTable (see SimpleProblem.open_table) the workers
+    open the same file, so they share a single copy of it, and each
+    detector block looks up its own columns of it.
+    """
+
+    def __init__(self, problem, max_workers=None, chunk_size=256, detector_blocks=1, engine="numpy"):
+        self.n_detectors = len(problem.detectors)
+        self.dtype = problem.dtype
+        self.chunk_size = int(chunk_size)
+
+        edges = np.linspace(0, self.n_detectors, min(detector_blocks, self.n_detectors) + 1).astype(int)
+        if len(edges) > 2:
+            self.detector_blocks = [(int(i), int(j)) for (i, j) in zip(edges[:-1], edges[1:]) if j > i]
+        else:
+            self.detector_blocks = [None]
+
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(pack_problem(problem), engine, getattr(problem.table, "fname", None)),
+        )
+
+    def evaluate_batch(self, R, I, *args):
+        # Same as problem.evaluate_batch(R, I, *args)
+        return self._map("evaluate_batch", R, I, args)
+
+    def _map(self, method, R, I, args):
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        I = np.broadcast_to(np.asarray(I, dtype=np.float64), R.shape[:1])
+
+        out = np.empty((R.shape[0], self.n_detectors), dtype=self.dtype)
+        jobs = []
+
+        for i in range(0, R.shape[0], self.chunk_size):
+            rows = slice(i, i + self.chunk_size)
+
+            for block in self.detector_blocks:
+                cols = slice(None) if block is None else slice(*block)
+                future = self.executor.submit(_evaluate_chunk, method, block, R[rows], I[rows], args)
+                jobs.append((rows, cols, future))
+
+        for (rows, cols, future) in jobs:
+            out[rows, cols] = future.result()
+
+        return out
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,231 @@
+import numpy as np
+from copy import copy
+
+# Detector placement. Given a deck, a set of candidate detectors and samples
+# from a prior on the source, pick the network that's best at localizing
+# the source:
+#
+#     S = gefry3.Placement(P, candidates, prior, background=300)
+#     S.greedy(10)         # pick 10 candidates one at a time
+#     S.exchange()         # then improve by swapping in and out
+#     S.network()          # the chosen detectors
+#
+# Every candidate's response and its gradient at every prior sample are
+# computed once up front, all candidates in one batched ray trace. For
+# Poisson counts with mean mu, a detector adds the rank one matrix
+#
+#     grad(mu) grad(mu)^T / mu
+#
+# to the Fisher information about the source parameters (x, y, log I), so a
+# network's Fisher information at each prior sample is a sum over its
+# detectors and adding or removing one is a single update. The utility is
+# averaged over the prior, either the log determinant of the Fisher
+# information ("d_optimal") or minus the Cramer-Rao bound on the squared
+# localization error ("localization").
+
+__all__ = ["Placement"]
+
+# Maximum number of rays traced at once
+_CHUNK = 2 ** 16
+
+class Placement(object):
+    UTILITIES = ("d_optimal", "localization")
+
+    def __init__(self, problem, candidates, prior, weights=None, background=0.0, dwell=None, utility="d_optimal", ridge=1e-9, args=()):
+        """
+        candidates are detector objects, prior an (M, 3) array of (x, y, I)
+        source samples with optional weights, background the background
+        rate (cps, scalar or per candidate) and dwell the count times (the
+        candidate dwell times by default). Extra arguments for the problem
+        go in args, like for the likelihoods. ridge is added to the
+        diagonal of the Fisher information so that networks too small to
+        pin down all three parameters still compare sensibly.
+        """
+        if utility not in self.UTILITIES:
+            raise ValueError("Unknown utility [{}], expected one of {}".format(utility, self.UTILITIES))
+
+        self.problem = problem
+        self.prior = np.asarray(prior, dtype=np.float64).reshape(-1, 3)
+        self.args = tuple(args)
+        self.utility_name = utility
+        self.ridge = ridge
+
+        if weights is None:
+            weights = np.ones(len(self.prior))
+
+        self.weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+
+        self.candidates = []
+        self.background = np.zeros(0)
+        self.dwell = np.zeros(0)
+
+        # Per candidate Fisher information at each prior sample, (M, C, 3, 3)
+        self.fisher_terms = np.zeros((len(self.prior), 0, 3, 3))
+
+        self.selected = []
+        self.fisher = np.zeros((len(self.prior), 3, 3))
+
+        self.add_candidates(candidates, background=background, dwell=dwell)
+
+    def _fields(self, detectors):
+        # Responses and (x, y, log I) Jacobians of detectors at the prior
+        # samples, (M, n) and (M, n, 3)
+        sub = copy(self.problem)
+        sub.table = None
+        sub.detectors = list(detectors)
+
+        R, I = self.prior[:, :2], self.prior[:, 2]
+        responses = np.empty((len(R), len(detectors)))
+        jacobian = np.empty((len(R), len(detectors), 3))
+
+        chunk = max(1, _CHUNK // max(len(detectors), 1))
+        for i in range(0, len(R), chunk):
+            s = slice(i, i + chunk)
+            responses[s], J = sub.evaluate_batch_with_gradient(R[s], I[s], *self.args)
+            jacobian[s] = J[..., :3]
+
+        # d/d(log I) = I d/dI, which keeps the Fisher information well
+        # scaled whatever the source strength
+        jacobian[..., 2] *= I[:, None]
+
+        return responses, jacobian
+
+    def add_candidates(self, candidates, background=0.0, dwell=None):
+        # Add candidate detectors, computing only their response fields
+        candidates = list(candidates)
+        n = len(candidates)
+
+        if dwell is None:
+            dwell = [d.dwell for d in candidates]
+
+        background = np.broadcast_to(np.asarray(background, dtype=np.float64), (n,))
+        dwell = np.broadcast_to(np.asarray(dwell, dtype=np.float64), (n,))
+
+        responses, jacobian = self._fields(candidates)
+        mu = responses + background * dwell
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = np.where(mu > 0, 1 / mu, 0.0)
+
+        terms = np.einsum("mci,mcj,mc->mcij", jacobian, jacobian, scale)
+
+        self.candidates += candidates
+        self.background = np.concatenate((self.background, background))
+        self.dwell = np.concatenate((self.dwell, dwell))
+        self.fisher_terms = np.concatenate((self.fisher_terms, terms), axis=1)
+
+        return list(range(len(self.candidates) - n, len(self.candidates)))
+
+    def remove_candidate(self, c):
+        # Drop candidate c (taking it out of the network first if needed),
+        # later candidates shift down by one
+        if c in self.selected:
+            self.remove(c)
+
+        del self.candidates[c]
+        self.background = np.delete(self.background, c)
+        self.dwell = np.delete(self.dwell, c)
+        self.fisher_terms = np.delete(self.fisher_terms, c, axis=1)
+
+        self.selected = [i - (i > c) for i in self.selected]
+
+    # Network updates
+
+    def add(self, c):
+        if c in self.selected:
+            raise ValueError("Candidate {} is already in the network".format(c))
+
+        self.selected.append(c)
+        self.fisher += self.fisher_terms[:, c]
+
+    def remove(self, c):
+        self.selected.remove(c)
+        self.fisher -= self.fisher_terms[:, c]
+
+    def reset(self):
+        self.selected = []
+        self.fisher = np.zeros((len(self.prior), 3, 3))
+
+    # Utilities
+
+    def utility(self, fisher=None):
+        """
+        Prior averaged utility of the Fisher information fisher (M, ..., 3,
+        3), the current network's by default. Leading axes after the first
+        are kept, so a stack of networks is scored at once.
+        """
+        if fisher is None:
+            fisher = self.fisher
+
+        F = fisher + self.ridge * np.eye(3)
+
+        if self.utility_name == "d_optimal":
+            u = np.linalg.slogdet(F)[1]
+        else:
+            # Cramer-Rao bound on E|r - r_true|^2
+            u = -np.trace(np.linalg.inv(F)[..., :2, :2], axis1=-2, axis2=-1)
+
+        return np.tensordot(self.weights, u, axes=1)
+
+    def gains(self):
+        # Utility of the network plus each candidate, -inf for candidates
+        # already in it
+        u = self.utility(self.fisher[:, None] + self.fisher_terms)
+        u[self.selected] = -np.inf
+
+        return u
+
+    def greedy(self, k):
+        """
+        Add candidates one at a time, each time the one that improves the
+        utility the most, until the network has k detectors. Returns the
+        network (candidate indices).
+        """
+        if k > len(self.candidates):
+            raise ValueError("Can't pick {} detectors from {} candidates".format(k, len(self.candidates)))
+
+        while len(self.selected) < k:
+            self.add(int(np.argmax(self.gains())))
+
+        return list(self.selected)
+
+    def exchange(self, max_iter=100):
+        """
+        Improve the network by swapping a member for a candidate outside
+        it, taking the best swap each time, until no swap helps (or after
+        max_iter swaps). Returns the network.
+        """
+        for _ in range(max_iter):
+            current = self.utility()
+            best = (current, None, None)
+
+            for i in self.selected:
+                F = self.fisher - self.fisher_terms[:, i]
+
+                u = self.utility(F[:, None] + self.fisher_terms)
+                u[self.selected] = -np.inf
+                c = int(np.argmax(u))
+
+                # Strictly better, so round off can't make it cycle
+                if u[c] > best[0] + 1e-12 * abs(best[0]):
+                    best = (u[c], i, c)
+
+            if best[1] is None:
+                break
+
+            self.remove(best[1])
+            self.add(best[2])
+
+        return list(self.selected)
+
+    def network(self):
+        # The selected detector objects
+        return [self.candidates[c] for c in self.selected]
+
+    def to_problem(self):
+        # A copy of the problem with the selected network as its detectors
+        problem = copy(self.problem)
+        problem.table = None
+        problem.detectors = self.network()
+
+        return problem
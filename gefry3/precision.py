@@ -0,0 +1,107 @@
+import numpy as np
+
+# Precision policy. Problems default to double precision throughout; with
+# P.set_precision("single") the big arrays (path lengths from the ray
+# tracer and the cache, path tables, response and Jacobian matrices) are
+# stored in float32, which halves the memory of large batched scans. Sums
+# that can lose digits are still done in float64: the optical depth
+# paths . Sigma_T, the interstitial path length (bounding box chord minus
+# the solid chords) and likelihoods.
+#
+# Path lengths are only ever rounded once, so the optical depth is off by
+# at most eps / 2 * tau and responses by about eps / 2 * (1 + tau) relative,
+# eps = 1.2e-7. measure_precision checks this on a given problem.
+
+__all__ = ["PRECISIONS", "measure_precision"]
+
+PRECISIONS = {
+    "double": np.dtype(np.float64),
+    "single": np.dtype(np.float32),
+}
+
+# Rows of paths cast to float64 at once in optical_depth
+_CHUNK = 2 ** 16
+
+def storage_dtype(precision):
+    # dtype for a precision name (or a float32/float64 dtype)
+    if precision in PRECISIONS:
+        return PRECISIONS[precision]
+
+    try:
+        dtype = np.dtype(precision)
+    except TypeError:
+        dtype = None
+
+    if dtype not in PRECISIONS.values():
+        raise ValueError("Unknown precision [{}], expected one of {}".format(precision, tuple(PRECISIONS)))
+
+    return dtype
+
+def precision_name(precision):
+    # "single" or "double" for a precision name or dtype
+    dtype = storage_dtype(precision)
+
+    return next(k for (k, v) in PRECISIONS.items() if v == dtype)
+
+def optical_depth(paths, Sigma_T):
+    # paths . Sigma_T accumulated in float64, a chunk at a time so a float32
+    # paths array is never copied to float64 all at once
+    Sigma_T = np.asarray(Sigma_T, dtype=np.float64)
+
+    if paths.dtype == np.float64:
+        return paths.dot(Sigma_T)
+
+    flat = paths.reshape(-1, paths.shape[-1])
+    tau = np.empty(flat.shape[0])
+
+    for i in range(0, flat.shape[0], _CHUNK):
+        tau[i:i + _CHUNK] = flat[i:i + _CHUNK].astype(np.float64).dot(Sigma_T)
+
+    return tau.reshape(paths.shape[:-1])
+
+def measure_precision(problem, precision="single", n=1000, seed=0, I=1.0):
+    """
+    Error of the given precision against the float64 reference for problem,
+    at n random source positions in the domain. Both go through the same
+    ray trace (no table or cache), so this is the rounding error alone.
+
+    Returns the max and RMS relative error of the responses, the max
+    absolute error of the optical depth, the a priori bound on the relative
+    response error eps / 2 * (1 + tau) at the worst sample, and the bytes
+    stored per (source, detector) pair for the paths.
+    """
+    dtype = storage_dtype(precision)
+    eps = np.finfo(dtype).eps
+
+    rng = np.random.RandomState(seed)
+    x0, y0, x1, y1 = problem.domain.bbox.bounds
+    R = rng.uniform([x0, y0], [x1, y1], size=(n, 2))
+    I = np.broadcast_to(np.asarray(I, dtype=np.float64), (n,))
+
+    # domain.dtype only decides how the (float64) chords are stored, so the
+    # reduced precision paths are the rounded reference paths
+    previous, problem.domain.dtype = problem.domain.dtype, PRECISIONS["double"]
+    try:
+        paths = problem.domain.construct_paths(*problem._batch_rays(R)).reshape(n, len(problem.detectors), -1)
+    finally:
+        problem.domain.dtype = previous
+
+    tau = optical_depth(paths, problem.Sigma_T)
+    tau_low = optical_depth(paths.astype(dtype), problem.Sigma_T)
+
+    array = problem.detector_array
+    reference = array.compute_responses(I[:, None] * np.exp(-tau), R)
+    low = array.compute_responses(I[:, None] * np.exp(-tau_low), R).astype(dtype).astype(np.float64)
+
+    nonzero = reference != 0
+    rel = np.abs(low[nonzero] / reference[nonzero] - 1)
+
+    return {
+        "precision": precision_name(dtype),
+        "n": n,
+        "max_rel": float(rel.max()) if rel.size else 0.0,
+        "rms_rel": float(np.sqrt((rel ** 2).mean())) if rel.size else 0.0,
+        "max_optical_depth": float(np.abs(tau_low - tau).max()),
+        "bound_rel": float(eps / 2 * (1 + tau.max())),
+        "bytes_per_pair": dtype.itemsize * paths.shape[-1],
+    }
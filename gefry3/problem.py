@@ -1,7 +1,11 @@
 import numpy as np
 import yaml
+import time
 from gefry3.classes import *
 from gefry3.classes.meta import Dictable
+from gefry3.tables import PathTable, VisibilityMap
+from gefry3 import profiling
+from gefry3.precision import PRECISIONS, precision_name, optical_depth
 from copy import deepcopy
 
 import warnings
@@ -21,6 +25,13 @@ __all__ = [
 
 class AmbiguousProblemSelectionError(Exception): pass
 
+def stack_sigmas(interstitial_material, materials):
+    # Macroscopic cross sections in construct_path order
+    return np.array(
+        [interstitial_material.Sigma_T] \
+            + [M.Sigma_T for M in materials]
+    )
+
 class BaseProblem(Dictable):
     @classmethod
     def get_loader(cls, name):
@@ -38,6 +49,14 @@ class SimpleProblem(BaseProblem):
     PROBLEM_TYPE = "Simple_Problem"
     HAS_REFERENCES = True
 
+    # Optional PathTable used instead of ray tracing, see use_table
+    table = None
+
+    _detector_array = None
+
+    # Storage precision of batched results, see set_precision
+    precision = "double"
+
     # Single source, fixed materials
     def __init__(self, domain, interstitial_material, materials, source, detectors):
         self.domain = domain
@@ -47,14 +66,34 @@ class SimpleProblem(BaseProblem):
         self.detectors = detectors
 
         # cache sigmas
-        self.Sigma_T = np.array(
-            [self.interstitial_material.Sigma_T] \
-                + [M.Sigma_T for M in self.materials]
-        )
+        self.Sigma_T = stack_sigmas(self.interstitial_material, self.materials)
+
+    @property
+    def detectors(self):
+        return self._detectors
+
+    @detectors.setter
+    def detectors(self, detectors):
+        self._detectors = detectors
+        self._detector_array = None
+
+    @property
+    def detector_array(self):
+        # Struct of arrays view of the detectors for the batched code. This
+        # is rebuilt when self.detectors is reassigned, but not if the list
+        # is modified in place.
+        if self._detector_array is None:
+            self._detector_array = DetectorArray(self.detectors)
+
+        return self._detector_array
 
     def __call__(self, r, I):
         # Compute response to a source at (r,I)
 
+        # The batched path is faster unless we're stuck with shapely
+        if self.table is not None or self.domain.engine != "shapely":
+            return self.evaluate_batch(r, I)[0]
+
         r = np.array(r)
         I = np.float64(I)
 
@@ -69,19 +108,205 @@ class SimpleProblem(BaseProblem):
 
             # responses[i] = detector.compute_response(I * alpha / (4. * np.pi * (dr ** 2))) 
 
-            responses[i] = self.compute_single_response(detector, r, I)
+            if profiling.active is None:
+                responses[i] = self.compute_single_response(detector, r, I)
+            else:
+                t = time.perf_counter()
+                responses[i] = self.compute_single_response(detector, r, I)
+                profiling.active.detector(i, time.perf_counter() - t)
 
         return responses.astype(np.float64)
 
+    def evaluate_batch(self, R, I):
+        # Compute responses to N sources at once, R is (N, 2) and I is (N,)
+        # (or a scalar), returns an (N, n_detectors) array
+        return self._attenuated_batch(R, I, self.Sigma_T)
+
     def compute_jacobian(self, r, I):
         return np.array([self.compute_single_jacobian(d, r, I) for d in self.detectors])
 
+    def evaluate_with_gradient(self, r, I):
+        # Responses at (r, I) and their (n_detectors, 3 + n_regions)
+        # Jacobian, see evaluate_batch_with_gradient
+        responses, jacobian = self.evaluate_batch_with_gradient(r, I)
+
+        return responses[0], jacobian[0]
+
+    def evaluate_batch_with_gradient(self, R, I):
+        """
+        Responses to N sources plus the analytic derivatives of every
+        response, in a single ray trace. Returns the (N, n_detectors)
+        responses and an (N, n_detectors, 3 + n_regions) Jacobian whose last
+        axis is d/dx, d/dy, d/dI and then d/dSigma_T for each region in
+        construct_path order (interstitial first).
+
+        Position derivatives include both the inverse square (solid angle)
+        term and the change of the path lengths through every region. Path
+        lengths are kinked where a ray grazes a vertex, the derivative
+        there is one of the one-sided values. Always ray traces, even if
+        a table is in use.
+        """
+        return self._attenuated_batch_with_gradient(R, I, self.Sigma_T)
+
+    @property
+    def dtype(self):
+        return PRECISIONS[self.precision]
+
+    def set_precision(self, precision):
+        """
+        Store batched responses, Jacobians, path lengths (including the
+        domain's path cache) and tables built from now on in "single"
+        (float32) or "double" (float64) precision. Optical depths and
+        likelihoods are always accumulated in double precision. See
+        gefry3.precision.measure_precision for the resulting error.
+        """
+        self.precision = precision_name(precision)
+        self.domain.dtype = self.dtype
+
+    def use_table(self, table):
+        # Answer evaluations from a PathTable instead of ray tracing, pass
+        # None to go back to ray tracing
+        if table is not None:
+            table.check_compatible(self)
+
+        self.table = table
+
+    def tabulate(self, shape=(101, 101), mode="attenuation", **kwargs):
+        # Build a PathTable for this problem and switch to it
+        kwargs.setdefault("dtype", self.dtype)
+
+        self.use_table(PathTable.build(self, shape=shape, mode=mode, **kwargs))
+
+        return self.table
+
+    def load_table(self, fname):
+        self.use_table(PathTable.load(fname))
+
+        return self.table
+
+    def tabulate_file(self, fname, shape=(101, 101), mode="paths", **kwargs):
+        # Build a memory mapped PathTable in fname and switch to it
+        kwargs.setdefault("dtype", self.dtype)
+
+        self.use_table(PathTable.build_file(self, fname, shape=shape, mode=mode, **kwargs))
+
+        return self.table
+
+    def open_table(self, fname):
+        # Switch to a memory mapped PathTable, shared with every other
+        # process that has it open
+        self.use_table(PathTable.open(fname, self))
+
+        return self.table
+
+    # Scenario editing. These go through the Domain edit methods and then
+    # update the materials, cross sections and table to match, only
+    # recomputing what the edit can have changed. The domain goes first so
+    # a rejected edit leaves the materials alone.
+
+    def add_solid(self, solid, material):
+        edit = self.domain.add_solid(solid)
+        self.materials.append(material)
+
+        return self._edited(edit)
+
+    def remove_solid(self, i):
+        edit = self.domain.remove_solid(i)
+        del self.materials[i]
+
+        return self._edited(edit)
+
+    def replace_solid(self, i, solid, material=None):
+        edit = self.domain.replace_solid(i, solid)
+        if material is not None:
+            self.materials[i] = material
+
+        return self._edited(edit)
+
+    def set_material(self, i, material):
+        bounds = self.domain.edges.bounds[i]
+        self.materials[i] = material
+
+        return self._edited(DomainEdit("material", i, bounds))
+
+    def _edited(self, edit):
+        self.Sigma_T = stack_sigmas(self.interstitial_material, self.materials)
+
+        if self.table is not None:
+            self.table.apply_edit(self, edit)
+
+        return edit
+
+    def compute_paths(self, r):
+        # (n_detectors, n_regions) path lengths from a source at r to
+        # every detector
+        r = np.asarray(r, dtype=np.float64).reshape(1, 2)
+
+        if self.table is not None and self.table.mode == "paths":
+            return self.table.lookup(r)[0]
+
+        return self.domain.construct_paths(*self._batch_rays(r), cached=True)
+
+    def _batch_args(self, R, I):
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        I = np.broadcast_to(np.asarray(I, dtype=np.float64), R.shape[:1])
+
+        return R, I
+
+    def _batch_rays(self, R):
+        # Every (source, detector) pair as flat arrays of ray end points
+        B = self.detector_array.R
+
+        return np.repeat(R, len(B), axis=0), np.tile(B, (R.shape[0], 1))
+
+    def _batch_detector_responses(self, I, R):
+        # I is the (N, n_detectors) attenuated intensity seen by each detector
+        return self.detector_array.compute_responses(I, R)
+
+    def _attenuated_batch(self, R, I, Sigma_T):
+        R, I = self._batch_args(R, I)
+
+        with profiling.phase("problem.attenuation"):
+            if self.table is not None:
+                alpha = np.exp(-self.table.optical_depth(R, Sigma_T))
+            else:
+                paths = self.domain.construct_paths(*self._batch_rays(R), cached=True) \
+                    .reshape(R.shape[0], len(self.detectors), -1)
+                alpha = np.exp(-optical_depth(paths, Sigma_T))
+
+        with profiling.phase("problem.detector_response"):
+            return self._batch_detector_responses(I[:, None] * alpha, R).astype(self.dtype, copy=False)
+
+    def _attenuated_batch_with_gradient(self, R, I, Sigma_T):
+        R, I = self._batch_args(R, I)
+        n, n_det = R.shape[0], len(self.detectors)
+
+        paths, dpaths = self.domain.construct_paths_with_gradient(*self._batch_rays(R))
+        paths = paths.reshape(n, n_det, -1)
+        dpaths = dpaths.reshape(n, n_det, -1, 2)
+
+        alpha = np.exp(-paths.dot(Sigma_T))
+        unit = self._batch_detector_responses(alpha, R)
+        responses = I[:, None] * unit
+
+        jacobian = np.empty((n, n_det, 3 + len(Sigma_T)), dtype=self.dtype)
+
+        # Position: inverse square term plus the change in optical depth
+        jacobian[..., :2] = self.detector_array.compute_response_gradients(I[:, None] * alpha, R)
+
+        jacobian[..., :2] -= responses[..., None] * np.einsum("ndrk,r->ndk", dpaths, Sigma_T)
+
+        jacobian[..., 2] = unit
+        jacobian[..., 3:] = -responses[..., None] * paths
+
+        return responses.astype(self.dtype, copy=False), jacobian
+
     def compute_single_response(self, detector, r, I):
         #dr = np.linalg.norm(np.asarray(detector.R) - np.asarray(r))
         r = np.array(r)
         I = np.float64(I) 
 
-        paths = self.domain.construct_path(r, detector.R)
+        paths = self.domain.construct_path(r, detector.R, cached=True)
         alpha = np.exp(-(paths * self.Sigma_T).sum())
 
         #response = detector.compute_response(I * alpha / (4. * np.pi * (dr ** 2.)))
@@ -93,7 +318,7 @@ class SimpleProblem(BaseProblem):
         r = np.array(r)
         I = np.float64(I)  
 
-        paths = self.domain.construct_path(r, detector.R) # Memoize this?
+        paths = self.domain.construct_path(r, detector.R, cached=True)
         alpha = np.exp(-(paths * self.Sigma_T)) 
 
         d = self.compute_single_response(detector, r, I)
@@ -125,22 +350,83 @@ class PerturbableXSProblem(SimpleProblem):
     PROBLEM_TYPE = "Perturbable_XS_Problem"
     HAS_REFERENCES = True
 
+    # Path lengths don't depend on the cross sections, so the path matrix
+    # for the last source position is kept and reused. Resampling cross
+    # sections at a fixed position costs one matrix product.
+    _last_paths = (None, None)
+
     def __call__(self, r, I, interstitial_material, materials):
         # MATERIALS MUST BE IN SAME ORDER AS SOLIDS
 
-        # Allocate a temporary fixed problem and evaluate
-        return SimpleProblem(
-            self.domain,
-            interstitial_material,
-            materials,
-            self.source,
-            self.detectors
-        )(r, I)
+        Sigma_T = stack_sigmas(interstitial_material, materials)
+
+        return self.evaluate_xs_batch(r, I, Sigma_T[None, :])[0]
+
+    def evaluate_xs_batch(self, r, I, Sigma_T):
+        # Responses to a single source at (r, I) for K sets of cross
+        # sections, Sigma_T is (K, n_regions) in construct_path order
+        # (interstitial first), returns a (K, n_detectors) array
+        r = np.asarray(r, dtype=np.float64).reshape(1, 2)
+        I = np.float64(I)
+        Sigma_T = np.atleast_2d(np.asarray(Sigma_T, dtype=np.float64))
+
+        paths = self.compute_paths(r)
+
+        # Detector responses are linear in the intensity, so the geometry
+        # part is computed once for unit intensity
+        unattenuated = self._batch_detector_responses(np.ones((1, len(self.detectors))), r)
+
+        # Optical depths in float64 whatever the precision, paths is only
+        # one row per detector
+        tau = Sigma_T.dot(paths.astype(np.float64).T)
+
+        return (I * unattenuated * np.exp(-tau)).astype(self.dtype, copy=False)
+
+    def compute_paths(self, r):
+        r = np.asarray(r, dtype=np.float64).reshape(1, 2)
+        last_r, last_paths = self._last_paths
+
+        if last_r is not None and np.array_equal(last_r, r):
+            return last_paths
+
+        paths = super().compute_paths(r)
+        self._last_paths = (r, paths)
+
+        return paths
+
+    def use_table(self, table):
+        self._last_paths = (None, None)
+
+        super().use_table(table)
+
+    def _edited(self, edit):
+        self._last_paths = (None, None)
+
+        return super()._edited(edit)
+
+    def evaluate_batch(self, R, I, interstitial_material, materials):
+        Sigma_T = stack_sigmas(interstitial_material, materials)
+
+        return self._attenuated_batch(R, I, Sigma_T)
+
+    def evaluate_with_gradient(self, r, I, interstitial_material, materials):
+        responses, jacobian = self.evaluate_batch_with_gradient(r, I, interstitial_material, materials)
+
+        return responses[0], jacobian[0]
+
+    def evaluate_batch_with_gradient(self, R, I, interstitial_material, materials):
+        Sigma_T = stack_sigmas(interstitial_material, materials)
+
+        return self._attenuated_batch_with_gradient(R, I, Sigma_T)
 
 class BinaryDomainProblem(SimpleProblem):
     PROBLEM_TYPE = "Binary_Domain_Problem"
     HAS_REFERENCES = False
 
+    # Optional VisibilityMap used instead of visibility queries, see
+    # use_visibility_map
+    visibility_map = None
+
     def __init__(self, domain, interstitial_material, distance_threshold, source, detectors):
         self.domain = domain
 
@@ -149,6 +435,12 @@ class BinaryDomainProblem(SimpleProblem):
         self.detectors = detectors
         self.distance_threshold = distance_threshold
 
+    def __call__(self, r, I):
+        if self.visibility_map is not None:
+            return self.evaluate_batch(r, I)[0]
+
+        return super().__call__(r, I)
+
     def compute_single_response(self, detector, r, I):
         r = np.array(r)
         I = np.float64(I)
@@ -163,6 +455,73 @@ class BinaryDomainProblem(SimpleProblem):
 
         else: return np.int64(0.0)
 
+    def evaluate_batch_with_gradient(self, R, I):
+        # Responses here jump between zero and free space attenuation, there
+        # is no useful derivative
+        raise TypeError("Binary_Domain_Problem responses are not differentiable")
+
+    def add_solid(self, solid):
+        return self._edited(self.domain.add_solid(solid))
+
+    def remove_solid(self, i):
+        return self._edited(self.domain.remove_solid(i))
+
+    def replace_solid(self, i, solid):
+        return self._edited(self.domain.replace_solid(i, solid))
+
+    def set_material(self, i, material):
+        raise TypeError("Binary_Domain_Problem solids have no materials")
+
+    def _edited(self, edit):
+        if self.visibility_map is not None:
+            self.visibility_map.apply_edit(self, edit)
+
+        return edit
+
+    def use_visibility_map(self, vmap):
+        # Answer line of sight queries from a VisibilityMap, pass None to go
+        # back to querying the domain
+        if vmap is not None:
+            vmap.check_compatible(self)
+
+        self.visibility_map = vmap
+
+    def tabulate_visibility(self, shape=(256, 256), **kwargs):
+        # Build a VisibilityMap for this problem and switch to it
+        self.use_visibility_map(VisibilityMap.build(self, shape=shape, **kwargs))
+
+        return self.visibility_map
+
+    def load_visibility_map(self, fname):
+        self.use_visibility_map(VisibilityMap.load(fname))
+
+        return self.visibility_map
+
+    def visibility_matrix(self, R):
+        # (n_sources, n_detectors) boolean matrix, True where the detector
+        # has line of sight to a source at that row of R
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+
+        if self.visibility_map is not None:
+            return self.visibility_map.lookup(R, self.domain)
+
+        return self.domain.visibility(*self._batch_rays(R), self.distance_threshold) \
+            .reshape(R.shape[0], len(self.detectors))
+
+    def evaluate_batch(self, R, I):
+        R, I = self._batch_args(R, I)
+        A, B = self._batch_rays(R)
+
+        visible = self.visibility_matrix(R).ravel()
+
+        dr = np.linalg.norm(A - B, axis=1)
+        alpha = visible * np.exp(-dr * self.interstitial_material.Sigma_T)
+
+        return self._batch_detector_responses(
+            I[:, None] * alpha.reshape(R.shape[0], -1),
+            R,
+        ).astype(self.dtype, copy=False)
+
     def _as_dict(self):
         return {
              "domain": self.domain._as_dict(),
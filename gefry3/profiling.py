@@ -0,0 +1,106 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+# Opt-in instrumentation of the hot paths. Nothing is recorded unless a
+# Profiler is active:
+#
+#     with gefry3.instrument() as prof:
+#         P(r, I)
+#
+#     print(prof.to_json())
+#
+# Instrumented code reads the module level `active` profiler once and
+# skips all bookkeeping when it's None, so the disabled cost is a global
+# lookup and a comparison.
+
+__all__ = ["Profiler", "instrument"]
+
+active = None
+
+def _new_stats():
+    return {"calls": 0, "seconds": 0.0}
+
+class Profiler(object):
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(_new_stats)
+        self.solids = defaultdict(lambda: {"tested": 0, "hit": 0, "seconds": 0.0})
+        self.detectors = defaultdict(_new_stats)
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    def add_time(self, name, seconds, calls=1):
+        t = self.timings[name]
+        t["calls"] += calls
+        t["seconds"] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t)
+
+    def solid(self, i, tested=1, hit=0, seconds=0.0):
+        s = self.solids[int(i)]
+        s["tested"] += int(tested)
+        s["hit"] += int(hit)
+        s["seconds"] += seconds
+
+    def detector(self, i, seconds, calls=1):
+        d = self.detectors[int(i)]
+        d["calls"] += calls
+        d["seconds"] += seconds
+
+    def reset(self):
+        self.__init__()
+
+    def report(self):
+        """
+        Everything recorded so far as plain dicts: counters, cumulative
+        timings per phase, and per solid / per detector breakdowns keyed
+        by index.
+        """
+        return {
+            "counters": dict(self.counters),
+            "timings": {k: dict(v) for (k, v) in self.timings.items()},
+            "solids": {k: dict(v) for (k, v) in sorted(self.solids.items())},
+            "detectors": {k: dict(v) for (k, v) in sorted(self.detectors.items())},
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.report(), **kwargs)
+
+# Shared do nothing context for phase() when profiling is off
+_NULL_PHASE = nullcontext()
+
+def phase(name):
+    # Time a block against the active profiler, if any
+    if active is None:
+        return _NULL_PHASE
+    else:
+        return active.phase(name)
+
+@contextmanager
+def instrument(profiler=None):
+    """
+    Record counters and timings from everything run inside the block into
+    profiler (a new Profiler if not given), which is returned. Blocks can
+    be nested, the previous profiler is restored on exit.
+    """
+    global active
+
+    if profiler is None:
+        profiler = Profiler()
+
+    previous = active
+    active = profiler
+
+    try:
+        yield profiler
+    finally:
+        active = previous
@@ -0,0 +1,337 @@
+import numpy as np
+import json
+from shapely.geometry.polygon import orient
+
+from gefry3.compiled import deck_hash, _jsonable
+from gefry3.classes.spatial import segment_box_overlap
+
+# Adaptive maps of the response (or anything else, e.g. a likelihood) over
+# the domain. Responses are smooth in the open and only change quickly near
+# the detectors and along shadow edges, so instead of a uniform grid the
+# extent is split into a quadtree: a cell is split in four wherever the
+# value at its center is more than a tolerance away from the bilinear
+# interpolation of its corners, for any detector. A shadow edge can slip
+# between the center and the corners, so cells crossed by a solid edge or
+# by a detector's shadow edge are split regardless.
+#
+#     Q = gefry3.QuadtreeMap.build(P, I=1e9, tol=1e-2)
+#     Q(R)                      # interpolated (N, n_detectors) responses
+#     Q.integrate()             # integral over the extent, per detector
+#     Q.to_raster((512, 512))   # sampled on a regular grid
+#
+# Only the leaves are stored (a linear quadtree): their level, integer
+# position and corner values. Every round of refinement is a single batched
+# evaluation, and corners shared between cells are only evaluated once.
+
+__all__ = ["QuadtreeMap"]
+
+def _level_offset(level):
+    # Number of cells in all levels above level, so that offset + i * 2^l + j
+    # is a unique key for cell (i, j) of level l
+    return ((1 << (2 * np.asarray(level, dtype=np.int64))) - 1) // 3
+
+def _solid_rings(problem):
+    # Closed exterior rings of the solids, counterclockwise
+    return [
+        np.asarray(orient(S.geom).exterior.coords, dtype=np.float64)
+        for S in problem.domain.solids
+    ]
+
+def _shadow_segments(rings, D, reach, facing=True):
+    # End points (A, B) of the segments across which the set of solids the
+    # ray from a source to D crosses changes: the shadow edge cast by each
+    # silhouette vertex away from D, out to reach, and with facing the
+    # solid edges facing D
+    A, B = [np.zeros((0, 2))], [np.zeros((0, 2))]
+
+    for V in rings:
+        v, prev, succ = V[:-1], np.roll(V[:-1], 1, axis=0), V[1:]
+        out = v - D
+        side = lambda W: out[:, 0] * (W - v)[:, 1] - out[:, 1] * (W - v)[:, 0]
+
+        # Both neighbours on the same side of the ray through v
+        silhouette = side(prev) * side(succ) >= 0
+        u = out[silhouette] / np.linalg.norm(out[silhouette], axis=1)[:, None]
+
+        A.append(v[silhouette])
+        B.append(v[silhouette] + reach * u)
+
+        if facing:
+            # Outward normal (dy, -dx) of a counterclockwise ring
+            d = succ - v
+            front = d[:, 1] * (D - v)[:, 0] - d[:, 0] * (D - v)[:, 1] > 0
+
+            A.append(v[front])
+            B.append(succ[front])
+
+    return np.concatenate(A), np.concatenate(B)
+
+def _edge_segments(problem, reach):
+    # End points (A, B) of every solid edge, plus the shadow edges of every
+    # detector. The response can have a kink or a jump across any of them.
+    rings = _solid_rings(problem)
+
+    A = [V[:-1] for V in rings] + [np.zeros((0, 2))]
+    B = [V[1:] for V in rings] + [np.zeros((0, 2))]
+
+    for d in problem.detectors:
+        a, b = _shadow_segments(rings, np.asarray(d.R, dtype=np.float64), reach, facing=False)
+        A.append(a)
+        B.append(b)
+
+    return np.concatenate(A), np.concatenate(B)
+
+class QuadtreeMap(object):
+    def __init__(self, extent, level, index, values, n_evaluations=0, meta=None):
+        """
+        extent is the (x0, y0, x1, y1) box covered by the tree, level (n,)
+        and index (n, 2) the level and integer position of every leaf, and
+        values the (n, 4, ...) values at the leaf corners, in the order
+        (x0, y0), (x1, y0), (x0, y1), (x1, y1).
+        """
+        self.extent = np.asarray(extent, dtype=np.float64)
+        self.level = np.asarray(level, dtype=np.int64)
+        self.index = np.asarray(index, dtype=np.int64).reshape(-1, 2)
+        # float32 values (from a single precision problem) are kept as is
+        values = np.asarray(values)
+        self.values = values.astype(np.result_type(values, np.float32), copy=False)
+        self.n_evaluations = n_evaluations
+        self.meta = {} if meta is None else dict(meta)
+
+        keys = _level_offset(self.level) + (self.index[:, 0] << self.level) + self.index[:, 1]
+        self._order = np.argsort(keys, kind="stable")
+        self._keys = keys[self._order]
+        self._levels = np.unique(self.level)
+
+    @classmethod
+    def build(cls, problem, I=1.0, extent=None, tol=1e-2, atol=0.0, min_depth=3, max_depth=8, args=(), func=None, edges=True):
+        """
+        Build a map of problem.evaluate_batch(R, I, *args) over extent (the
+        domain bounding box by default), or of func(R) if given, which
+        should return an (N,) or (N, ...) array for N source positions.
+
+        Cells start at min_depth levels deep and are split, up to
+        max_depth, while the value at the center misses the interpolation
+        of the corners by more than tol * |value| + atol anywhere. With
+        edges=True (and a problem to take the geometry from) cells crossed
+        by a solid edge or a detector shadow edge are split to max_depth
+        too.
+        """
+        if func is None:
+            func = lambda R: problem.evaluate_batch(R, I, *args)
+
+        if extent is None:
+            extent = problem.domain.bbox.bounds
+
+        extent = np.asarray(extent, dtype=np.float64)
+        size = extent[2:] - extent[:2]
+
+        # Corners are kept on an integer lattice one level finer than the
+        # deepest cells, so cell centers are lattice points too
+        n = 1 << (max_depth + 1)
+        cache_keys = np.zeros(0, dtype=np.int64)
+        cache_values = None
+        n_evaluations = 0
+
+        def evaluate(points):
+            # Values at the lattice points (N, 2), evaluating new ones only
+            nonlocal cache_keys, cache_values, n_evaluations
+
+            keys = points[:, 0] * (n + 1) + points[:, 1]
+            new, first = np.unique(keys, return_index=True)
+
+            if cache_values is not None:
+                pos = np.minimum(np.searchsorted(cache_keys, new), len(cache_keys) - 1)
+                missing = cache_keys[pos] != new
+                new, first = new[missing], first[missing]
+
+            if len(new):
+                values = np.asarray(func(extent[:2] + points[first] * size / n))
+                n_evaluations += len(new)
+
+                if cache_values is None:
+                    cache_keys, cache_values = new, values
+                else:
+                    cache_keys = np.concatenate((cache_keys, new))
+                    cache_values = np.concatenate((cache_values, values))
+                    order = np.argsort(cache_keys, kind="stable")
+                    cache_keys, cache_values = cache_keys[order], cache_values[order]
+
+            return cache_values[np.searchsorted(cache_keys, keys)]
+
+        corner_offsets = np.array([[0, 0], [1, 0], [0, 1], [1, 1]], dtype=np.int64)
+
+        i, j = np.meshgrid(np.arange(1 << min_depth), np.arange(1 << min_depth), indexing="ij")
+        cells = np.column_stack((i.ravel(), j.ravel())).astype(np.int64)
+
+        # (cell, segment) pairs for the edges crossing each cell. A cell can
+        # only be crossed by the segments crossing its parent, so the pairs
+        # are carried down the tree and re-tested against the children.
+        if edges and problem is not None:
+            A, B = _edge_segments(problem, np.hypot(*size))
+        else:
+            A, B = np.zeros((0, 2)), np.zeros((0, 2))
+
+        pair_cell = np.repeat(np.arange(len(cells)), len(A))
+        pair_seg = np.tile(np.arange(len(A)), len(cells))
+
+        leaves_level, leaves_index, leaves_values = [], [], []
+
+        for level in range(min_depth, max_depth + 1):
+            step = 1 << (max_depth + 1 - level)
+
+            corners = (cells[:, None] + corner_offsets) * step
+            centers = cells * step + step // 2
+
+            both = evaluate(np.concatenate((corners.reshape(-1, 2), centers)))
+            corner_values = both[:4 * len(cells)].reshape((len(cells), 4) + both.shape[1:])
+            center_values = both[4 * len(cells):]
+
+            err = np.abs(center_values - corner_values.mean(axis=1))
+            split = (err > tol * np.abs(center_values) + atol).reshape(len(cells), -1).any(axis=1)
+
+            cell_size = size / (1 << level)
+            lo = extent[:2] + cells[pair_cell] * cell_size
+            crossed = segment_box_overlap(A[pair_seg], B[pair_seg], np.hstack((lo, lo + cell_size)))
+            pair_cell, pair_seg = pair_cell[crossed], pair_seg[crossed]
+            split[pair_cell] = True
+
+            if level == max_depth:
+                split[:] = False
+
+            leaves_level.append(np.full((~split).sum(), level))
+            leaves_index.append(cells[~split])
+            leaves_values.append(corner_values[~split])
+
+            # Children of split cell k are 4 * (number of split cells
+            # before k) + 0..3 in the next level
+            rank = np.cumsum(split) - 1
+            pair_cell = (4 * rank[pair_cell][:, None] + np.arange(4)).ravel()
+            pair_seg = np.repeat(pair_seg, 4)
+
+            cells = (2 * cells[split][:, None] + corner_offsets).reshape(-1, 2)
+
+            if not len(cells):
+                break
+
+        meta = {}
+        if problem is not None:
+            meta["deck_hash"] = deck_hash(problem)
+
+        return cls(
+            extent,
+            np.concatenate(leaves_level),
+            np.concatenate(leaves_index),
+            np.concatenate(leaves_values),
+            n_evaluations=n_evaluations,
+            meta=meta,
+        )
+
+    @property
+    def n_leaves(self):
+        return len(self.level)
+
+    @property
+    def depth(self):
+        return int(self.level.max())
+
+    def cells(self):
+        # (n_leaves, 4) boxes (x0, y0, x1, y1) of the leaves
+        size = (self.extent[2:] - self.extent[:2]) / (1 << self.level)[:, None]
+        lo = self.extent[:2] + self.index * size
+
+        return np.hstack((lo, lo + size))
+
+    def find(self, R):
+        # Index of the leaf containing each of the points R (N, 2), and the
+        # position of the point within it (N, 2) in [0, 1]
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+
+        f = np.clip((R - self.extent[:2]) / (self.extent[2:] - self.extent[:2]), 0, 1)
+        leaf = np.full(R.shape[0], -1, dtype=np.intp)
+        w = np.zeros_like(f)
+
+        for level in self._levels:
+            todo = np.flatnonzero(leaf < 0)
+            if not len(todo):
+                break
+
+            g = f[todo] * (1 << level)
+            ij = np.minimum(np.floor(g).astype(np.int64), (1 << level) - 1)
+
+            keys = _level_offset(level) + (ij[:, 0] << level) + ij[:, 1]
+            pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+            hit = self._keys[pos] == keys
+
+            leaf[todo[hit]] = self._order[pos[hit]]
+            w[todo[hit]] = g[hit] - ij[hit]
+
+        return leaf, w
+
+    def __call__(self, R):
+        """
+        Values at the points R (N, 2), interpolated bilinearly within the
+        leaf containing each point. Points outside the extent are clamped to
+        its edge.
+        """
+        leaf, w = self.find(R)
+        v = self.values[leaf]
+
+        shape = (-1,) + (1,) * (v.ndim - 2)
+        wx, wy = w[:, 0].reshape(shape), w[:, 1].reshape(shape)
+
+        return (1 - wx) * (1 - wy) * v[:, 0] + wx * (1 - wy) * v[:, 1] \
+            + (1 - wx) * wy * v[:, 2] + wx * wy * v[:, 3]
+
+    def integrate(self):
+        # Integral of the interpolated map over the extent
+        area = np.prod(self.extent[2:] - self.extent[:2]) / (1 << (2 * self.level))
+        area = area.reshape((-1,) + (1,) * (self.values.ndim - 2))
+
+        return (area * self.values.mean(axis=1, dtype=np.float64)).sum(axis=0)
+
+    def to_raster(self, shape=(256, 256)):
+        """
+        Sample the map at the centers of a shape[0] x shape[1] grid of
+        pixels over the extent. Returns an (nx, ny, ...) array, indexed
+        [x, y] like the PathTable grids.
+        """
+        x0, y0, x1, y1 = self.extent
+        nx, ny = shape
+
+        X, Y = np.meshgrid(
+            x0 + (np.arange(nx) + 0.5) * (x1 - x0) / nx,
+            y0 + (np.arange(ny) + 0.5) * (y1 - y0) / ny,
+            indexing="ij",
+        )
+
+        values = self(np.column_stack((X.ravel(), Y.ravel())))
+
+        return values.reshape(tuple(shape) + values.shape[1:])
+
+    def save(self, fname):
+        meta = dict(self.meta, n_evaluations=self.n_evaluations)
+
+        np.savez(
+            fname,
+            extent=self.extent,
+            level=self.level,
+            index=self.index,
+            values=self.values,
+            meta=np.array(json.dumps(meta, default=_jsonable)),
+        )
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            meta = json.loads(str(data["meta"]))
+            n_evaluations = meta.pop("n_evaluations", 0)
+
+            return cls(
+                data["extent"],
+                data["level"],
+                data["index"],
+                data["values"],
+                n_evaluations=n_evaluations,
+                meta=meta,
+            )
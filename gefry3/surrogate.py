@@ -0,0 +1,387 @@
+import numpy as np
+import json
+
+from gefry3.classes import *
+from gefry3.tables import PathTable
+from gefry3.compiled import deck_hash, _jsonable
+from gefry3.quadtree import _solid_rings, _shadow_segments
+from gefry3.classes.spatial import segment_box_overlap
+
+# Surrogate model of a problem's response field. The response of detector d
+# to a source (r, I) factors into
+#
+#     I * g_d(r) * exp(-tau_d(r))
+#
+# where g_d is the unattenuated detector response, which is cheap and known
+# exactly, and tau_d is the optical depth along the ray, which is what
+# costs a ray trace. So the emulator only fits tau_d, i.e. the log-response
+# minus its analytic part, with piecewise bilinear interpolation on a grid.
+# tau is continuous but has kinks along building edges and shadow
+# boundaries, and near a grazing ray it can be very steep. So every cell
+# where a detector's shadow changes, or where the grid misses tau for a
+# detector at random probe points in the cell, gets a finer patch of its own
+# for that detector. The patch is doubled in resolution until it gets the
+# probes right as well. The probes are split into folds and the refinement
+# is replayed without each fold in turn, which gives a cross validated
+# estimate of the error.
+
+__all__ = ["Surrogate"]
+
+# Maximum number of rays traced at once while building
+_BUILD_CHUNK = 2 ** 16
+
+def _optical_depth(problem, R, which=None):
+    # Exact (N, n_detectors) optical depth for sources at R, or with which
+    # given the (N,) optical depth from R[i] to detector which[i] only
+    B = np.array([d.R for d in problem.detectors], dtype=np.float64)
+
+    if which is None:
+        n = len(B)
+        which = np.tile(np.arange(n), R.shape[0])
+        R = np.repeat(R, n, axis=0)
+    else:
+        n = None
+
+    tau = np.empty(R.shape[0])
+
+    for i in range(0, R.shape[0], _BUILD_CHUNK):
+        s = slice(i, i + _BUILD_CHUNK)
+        tau[s] = problem.domain.construct_paths(R[s], B[which[s]]).dot(problem.Sigma_T)
+
+    return tau if n is None else tau.reshape(-1, n)
+
+def _bilinear(v00, v10, v01, v11, wx, wy):
+    # Bilinear interpolation between the corner values of a cell, and its
+    # derivatives with respect to the cell coordinates wx, wy
+    value = (1 - wx) * (1 - wy) * v00 + wx * (1 - wy) * v10 + (1 - wx) * wy * v01 + wx * wy * v11
+    dx = (1 - wy) * (v10 - v00) + wy * (v11 - v01)
+    dy = (1 - wx) * (v01 - v00) + wx * (v11 - v10)
+
+    return value, dx, dy
+
+def _patch_lookup(values, start, k, q, w, return_gradient=False):
+    # Bilinear interpolation in patches q at cell coordinates w (N, 2), the
+    # patches being (k + 1) x (k + 1) node grids stored from values[start]
+    k = k[q]
+    g = w * k[:, None]
+    j = np.minimum(np.floor(g).astype(np.intp), k[:, None] - 1)
+    v = g - j
+
+    base = start[q] + j[:, 0] * (k + 1) + j[:, 1]
+    tau, dx, dy = _bilinear(values[base], values[base + k + 1], values[base + 1], values[base + k + 2], v[:, 0], v[:, 1])
+
+    if return_gradient:
+        return tau, dx * k, dy * k
+
+    return tau
+
+def _shadow_cells(problem, lo, size, reach):
+    # (n_cells, n_detectors) cells with lower corners lo where the set of
+    # solids the ray to each detector crosses changes
+    rings = _solid_rings(problem)
+    boxes = np.hstack((lo, lo + size))
+    shadow = np.zeros((len(lo), len(problem.detectors)), dtype=bool)
+
+    for (i, d) in enumerate(problem.detectors):
+        A, B = _shadow_segments(rings, np.asarray(d.R, dtype=np.float64), reach)
+
+        for s in range(0, len(A), 64):
+            shadow[:, i] |= segment_box_overlap(A[s:s + 64, None], B[s:s + 64, None], boxes[None]).any(axis=0)
+
+    return shadow
+
+def _cross_validate(edges, coarse_err, cell, det, levels, fold, folds, tol):
+    # Replay the refinement decisions of Surrogate.build without the probes
+    # of each fold in turn, and collect the error at the left out probes
+    n_cells, n_probe, n_det = coarse_err.shape
+    fold_max = np.zeros((folds, n_det))
+    fold_rms = np.zeros((folds, n_det))
+    sq = np.zeros(n_det)
+
+    for f in range(folds):
+        train = fold != f
+
+        # Refined cells and the patch level each one stops at, from the
+        # training probes only. Every cell refined here was refined with
+        # all the probes too, with at least as fine a patch.
+        refined = edges | ((coarse_err > tol) & train[..., None]).any(axis=1)
+        refined = refined[cell, det]
+
+        level = np.full(len(cell), len(levels) - 1)
+        for (i, level_err) in reversed(list(enumerate(levels))):
+            level[~((level_err > tol) & train[cell]).any(axis=1)] = i
+
+        err = coarse_err.copy()
+        n = np.nonzero(refined)[0]
+        if len(n):
+            err[cell[n], :, det[n]] = np.stack(levels)[level[n], n]
+
+        held_out = err[~train]
+        fold_max[f] = held_out.max(axis=0)
+        fold_rms[f] = np.sqrt((held_out ** 2).mean(axis=0))
+        sq += (held_out ** 2).sum(axis=0)
+
+    return {
+        "n": n_cells * n_probe,
+        "folds": folds,
+        "max": fold_max.max(axis=0),
+        "rms": np.sqrt(sq / (n_cells * n_probe)),
+        "fold_max": fold_max,
+        "fold_rms": fold_rms,
+    }
+
+class Surrogate(object):
+    def __init__(self, extent, coarse, cell_patch, patch_k, patch_start, patch_values, detectors, source=None, error=None, deck_hash=None):
+        """
+        coarse is the (nx, ny, n_detectors) optical depth at the grid nodes
+        over extent and cell_patch the (nx - 1, ny - 1, n_detectors) index
+        of the refined patch for each cell and detector (-1 if it isn't
+        refined). The patches are stored CSR style: patch q is a
+        (patch_k[q] + 1) x (patch_k[q] + 1) grid of optical depths, flattened
+        into patch_values from patch_start[q].
+        """
+        self.extent = np.asarray(extent, dtype=np.float64)
+        self.coarse = np.asarray(coarse, dtype=np.float64)
+        self.cell_patch = np.asarray(cell_patch, dtype=np.intp)
+        self.patch_k = np.asarray(patch_k, dtype=np.intp)
+        self.patch_start = np.asarray(patch_start, dtype=np.intp)
+        self.patch_values = np.asarray(patch_values, dtype=np.float64)
+        self.detectors = list(detectors)
+        self.detector_array = DetectorArray(self.detectors)
+        self.source = source
+        self.error = {} if error is None else dict(error)
+        self.deck_hash = deck_hash
+
+        self.shape = self.coarse.shape[:2]
+
+        x0, y0, x1, y1 = self.extent
+        self.spacing = np.array([(x1 - x0) / (self.shape[0] - 1), (y1 - y0) / (self.shape[1] - 1)])
+
+    @classmethod
+    def build(cls, problem, shape=(65, 65), refine=4, max_refine=32, tol=1e-2, extent=None, refine_edges=True, n_probe=8, folds=4, seed=0):
+        """
+        Fit a surrogate to problem on a shape[0] x shape[1] grid over extent
+        (the domain bounding box by default).
+
+        Each cell gets n_probe random probe points. A cell is refined for a
+        detector if the grid misses the optical depth at one of them by more
+        than tol, or with refine_edges if the detector's shadow changes in
+        the cell. A refined cell gets a patch refine times finer in each
+        direction, which is doubled, up to max_refine, until it's within
+        tol at the probes too.
+
+        The probes are split into folds, and self.error gets the max/RMS
+        error per detector at each fold's probes of the surrogate refined
+        using the other folds only (and over all the folds).
+        """
+        table = PathTable.build(problem, shape=shape, mode="attenuation", extent=extent, n_check=0)
+        extent = table.extent
+        nx, ny = table.shape
+        n_det = table.values.shape[-1]
+        rng = np.random.RandomState(seed)
+
+        lo = table.nodes[:-1, :-1].reshape(-1, 2)
+        n_cells = len(lo)
+
+        # Probe points and the coarse grid's error there, (n_cells, n_probe, n_det)
+        w = rng.uniform(size=(n_cells, n_probe, 2))
+        probes = (lo[:, None] + w * table.spacing).reshape(-1, 2)
+
+        exact = _optical_depth(problem, probes).reshape(n_cells, n_probe, n_det)
+        coarse_err = np.abs(table.lookup(probes).reshape(exact.shape) - exact)
+
+        if refine_edges:
+            edges = _shadow_cells(problem, lo, table.spacing, np.hypot(*(extent[2:] - extent[:2])))
+        else:
+            edges = np.zeros((n_cells, n_det), dtype=bool)
+
+        cell, det = np.nonzero(edges | (coarse_err > tol).any(axis=1))
+
+        # Patch error at the probes for each doubling, nan where a patch
+        # was already good enough (or at max_refine) at a coarser level
+        levels = []
+        patches = [None] * len(cell)
+        patch_k = np.full(len(cell), refine, dtype=np.intp)
+        active = np.arange(len(cell))
+        k = refine
+
+        while len(active):
+            u = np.linspace(0, 1, k + 1)
+            U, V = np.meshgrid(u, u, indexing="ij")
+            nodes = lo[cell[active], None, None] + np.stack((U, V), axis=-1) * table.spacing
+
+            values = _optical_depth(problem, nodes.reshape(-1, 2), np.repeat(det[active], (k + 1) ** 2)) \
+                .reshape(len(active), -1)
+
+            for (p, v) in zip(active, values):
+                patches[p] = v
+            patch_k[active] = k
+
+            q = np.repeat(np.arange(len(active)), n_probe)
+            err = np.full((len(cell), n_probe), np.nan)
+            err[active] = np.abs(
+                _patch_lookup(values.ravel(), np.arange(len(active)) * (k + 1) ** 2, np.full(len(active), k), q, w[cell[active]].reshape(-1, 2))
+                - exact[cell[active], :, det[active]].ravel()
+            ).reshape(-1, n_probe)
+
+            levels.append(err)
+
+            if 2 * k > max_refine:
+                break
+
+            active = active[(err[active] > tol).any(axis=1)]
+            k *= 2
+
+        patch_start = np.cumsum([0] + [len(v) for v in patches])[:-1]
+
+        cell_patch = np.full((n_cells, n_det), -1, dtype=np.intp)
+        cell_patch[cell, det] = np.arange(len(cell))
+
+        surrogate = cls(
+            extent,
+            table.values,
+            cell_patch.reshape(nx - 1, ny - 1, n_det),
+            patch_k,
+            patch_start,
+            np.concatenate([np.zeros(0)] + patches),
+            problem.detectors,
+            source=problem.source,
+            deck_hash=deck_hash(problem),
+        )
+
+        if folds:
+            fold = rng.randint(folds, size=(n_cells, n_probe))
+            surrogate.error = _cross_validate(edges, coarse_err, cell, det, levels, fold, folds, tol)
+
+        return surrogate
+
+    @property
+    def refined_fraction(self):
+        return np.mean(self.cell_patch >= 0)
+
+    def optical_depth(self, R, return_gradient=False):
+        """
+        Interpolated (N, n_detectors) optical depth for sources at R, and
+        with return_gradient=True its (N, n_detectors, 2) gradient. Points
+        outside the extent are clamped to its edge.
+        """
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        last = np.array(self.shape) - 2
+
+        f = np.clip((R - self.extent[:2]) / self.spacing, 0, np.array(self.shape) - 1)
+        i = np.minimum(np.floor(f).astype(np.intp), last)
+        w = f - i
+
+        C = self.coarse
+        ix, iy = i[:, 0], i[:, 1]
+
+        tau, dx, dy = _bilinear(C[ix, iy], C[ix + 1, iy], C[ix, iy + 1], C[ix + 1, iy + 1], w[:, :1], w[:, 1:])
+
+        # Points in refined cells interpolate in their patch instead
+        p = self.cell_patch[ix, iy]
+        n, d = np.nonzero(p >= 0)
+
+        if len(n):
+            tau[n, d], dx[n, d], dy[n, d] = _patch_lookup(
+                self.patch_values, self.patch_start, self.patch_k, p[n, d], w[n], return_gradient=True,
+            )
+
+        if not return_gradient:
+            return tau
+
+        return tau, np.stack((dx, dy), axis=-1) / self.spacing
+
+    # Same interface as SimpleProblem
+
+    def __call__(self, r, I):
+        return self.evaluate_batch(r, I)[0]
+
+    def evaluate_batch(self, R, I):
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        I = np.broadcast_to(np.asarray(I, dtype=np.float64), R.shape[:1])
+
+        return self.detector_array.compute_responses(I[:, None] * np.exp(-self.optical_depth(R)), R)
+
+    def evaluate_with_gradient(self, r, I):
+        responses, jacobian = self.evaluate_batch_with_gradient(r, I)
+
+        return responses[0], jacobian[0]
+
+    def evaluate_batch_with_gradient(self, R, I):
+        # Responses and their (N, n_detectors, 3) Jacobian with respect to
+        # (x, y, I)
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        I = np.broadcast_to(np.asarray(I, dtype=np.float64), R.shape[:1])
+
+        tau, dtau = self.optical_depth(R, return_gradient=True)
+        alpha = np.exp(-tau)
+
+        unit = self.detector_array.compute_responses(alpha, R)
+        responses = I[:, None] * unit
+
+        jacobian = np.empty(responses.shape + (3,))
+        jacobian[..., :2] = self.detector_array.compute_response_gradients(I[:, None] * alpha, R)
+        jacobian[..., :2] -= responses[..., None] * dtau
+        jacobian[..., 2] = unit
+
+        return responses, jacobian
+
+    def validate(self, problem, n=1000, seed=0):
+        """
+        Compare against the model at n random source positions and return
+        the max/RMS error of the log-response (equivalently the optical
+        depth) per detector. build leaves a cross validated estimate of the
+        same in self.error.
+        """
+        rng = np.random.RandomState(seed)
+        x0, y0, x1, y1 = self.extent
+        R = rng.uniform([x0, y0], [x1, y1], size=(n, 2))
+
+        err = np.abs(self.optical_depth(R) - _optical_depth(problem, R))
+
+        return {
+            "n": n,
+            "max": err.max(axis=0),
+            "rms": np.sqrt((err ** 2).mean(axis=0)),
+        }
+
+    def save(self, fname):
+        meta = {
+            "detectors": self.detector_array._as_dict(),
+            "source": None if self.source is None else self.source._as_dict(),
+            "deck_hash": self.deck_hash,
+        }
+
+        arrays = {
+            "extent": self.extent,
+            "coarse": self.coarse,
+            "cell_patch": self.cell_patch,
+            "patch_k": self.patch_k,
+            "patch_start": self.patch_start,
+            "patch_values": self.patch_values,
+            "meta": np.array(json.dumps(meta, default=_jsonable)),
+        }
+
+        for (k, v) in self.error.items():
+            arrays["error_" + k] = np.asarray(v)
+
+        np.savez(fname, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            meta = json.loads(str(data["meta"]))
+            error = {k[len("error_"):]: data[k] for k in data.files if k.startswith("error_")}
+
+            return cls(
+                data["extent"],
+                data["coarse"],
+                data["cell_patch"],
+                data["patch_k"],
+                data["patch_start"],
+                data["patch_values"],
+                DetectorArray._from_dict(meta["detectors"]).detectors,
+                source=None if meta["source"] is None else Source._from_dict(meta["source"]),
+                error=error,
+                deck_hash=meta["deck_hash"],
+            )
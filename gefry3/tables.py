@@ -0,0 +1,613 @@
+import numpy as np
+import shapely
+import json
+import os
+
+from gefry3.precision import optical_depth
+
+# Precomputed path length tables. The geometry of a deck never changes, so
+# the path length vector from a source to each detector is a fixed function
+# of the source position. A PathTable samples it on a regular grid of
+# source positions and answers queries by bilinear interpolation.
+#
+# Tables come in two flavors:
+#
+# * "attenuation" stores the optical depth (paths . Sigma_T) for each
+#   detector, so it's tied to one set of cross sections but tiny.
+# * "paths" stores the full path length vector for each detector and works
+#   with any cross sections (e.g. for PerturbableXSProblem).
+#
+# Tables can also live in a memory mapped .npy file (see build_file and
+# open), built a chunk at a time and opened read only, so any number of
+# processes on a node share one copy through the page cache.
+#
+# VisibilityMap does the same for BinaryDomainProblem, where all a detector
+# needs is a line of sight bit.
+
+__all__ = ["PathTable", "VisibilityMap"]
+
+# Maximum number of rays traced at once while building a table
+_BUILD_CHUNK = 2 ** 16
+
+class TableMismatchError(Exception): pass
+
+def _header_name(fname):
+    # JSON header that goes with the memory mapped table fname
+    return os.path.splitext(fname)[0] + ".json"
+
+class PathTable(object):
+    MODES = ("attenuation", "paths")
+
+    def __init__(self, extent, values, detectors_R, mode="attenuation", Sigma_T=None, error=None, deck_hash=None, fname=None):
+        if mode not in self.MODES:
+            raise ValueError("Unknown table mode [{}], expected one of {}".format(mode, self.MODES))
+
+        self.extent = np.asarray(extent, dtype=np.float64)
+        self.values = values
+        self.detectors_R = np.asarray(detectors_R, dtype=np.float64)
+        self.mode = mode
+        self.Sigma_T = None if Sigma_T is None else np.asarray(Sigma_T, dtype=np.float64)
+        self.error = {} if error is None else dict(error)
+        self.deck_hash = deck_hash
+
+        # File the values are memory mapped from, if any
+        self.fname = fname
+
+        self.shape = self.values.shape[:2]
+
+        x0, y0, x1, y1 = self.extent
+        self.spacing = np.array([
+            (x1 - x0) / max(self.shape[0] - 1, 1),
+            (y1 - y0) / max(self.shape[1] - 1, 1),
+        ])
+
+    @property
+    def nodes(self):
+        # The (nx, ny, 2) grid of source positions
+        x0, y0, x1, y1 = self.extent
+        X, Y = np.meshgrid(
+            np.linspace(x0, x1, self.shape[0]),
+            np.linspace(y0, y1, self.shape[1]),
+            indexing="ij",
+        )
+
+        return np.stack((X, Y), axis=-1)
+
+    @classmethod
+    def build(cls, problem, shape=(101, 101), mode="attenuation", extent=None, n_check=1000, seed=0, dtype=np.float64):
+        """
+        Tabulate problem on a shape[0] x shape[1] grid of source positions
+        covering extent (the domain bounding box by default), storing the
+        values as dtype. The interpolation error is estimated afterwards at
+        n_check random points, see estimate_error.
+        """
+        table = cls._empty(problem, shape, mode, extent, dtype, np.empty)
+        table._fill(problem)
+
+        if n_check:
+            table.estimate_error(problem, n=n_check, seed=seed)
+
+        return table
+
+    @classmethod
+    def build_file(cls, problem, fname, shape=(101, 101), mode="paths", extent=None, n_check=1000, seed=0, dtype=np.float64):
+        """
+        Same as build, but the values are written straight to the .npy file
+        fname a chunk at a time, so the table never has to fit in memory.
+        The rest of the table goes in a JSON file next to it. Returns the
+        table opened read only, see open.
+        """
+        def create(shape, dtype):
+            return np.lib.format.open_memmap(fname + ".partial", mode="w+", dtype=dtype, shape=shape)
+
+        table = cls._empty(problem, shape, mode, extent, dtype, create)
+        table._fill(problem)
+
+        if n_check:
+            table.estimate_error(problem, n=n_check, seed=seed)
+
+        # Readers never see a half written file. The header goes first, so
+        # a reader racing us gets the new header with the old values at
+        # worst, and open catches that
+        table.values.flush()
+        table._write_header(fname)
+        del table.values
+
+        os.replace(fname + ".partial", fname)
+
+        return cls.open(fname, problem)
+
+    @classmethod
+    def _empty(cls, problem, shape, mode, extent, dtype, create):
+        # Table for problem with values allocated by create(shape, dtype)
+        # but not filled in yet
+        from gefry3.compiled import deck_hash
+
+        if extent is None:
+            extent = problem.domain.bbox.bounds
+
+        detectors_R = np.array([d.R for d in problem.detectors], dtype=np.float64)
+        shape = tuple(shape) + (len(detectors_R),)
+
+        if mode == "paths":
+            shape += (1 + len(problem.domain.solids),)
+
+        return cls(
+            extent,
+            create(shape, dtype),
+            detectors_R,
+            mode=mode,
+            Sigma_T=None if mode == "paths" else problem.Sigma_T,
+            deck_hash=deck_hash(problem),
+        )
+
+    def _fill(self, problem):
+        # Ray trace every (node, detector) pair into self.values, a chunk of
+        # nodes at a time
+        nodes = self.nodes.reshape(-1, 2)
+        n_det = len(self.detectors_R)
+        values = self.values.reshape((-1,) + self.values.shape[2:])
+
+        chunk = max(1, _BUILD_CHUNK // n_det)
+        for i in range(0, nodes.shape[0], chunk):
+            R = nodes[i:i + chunk]
+            paths = problem.domain.construct_paths(
+                np.repeat(R, n_det, axis=0),
+                np.tile(self.detectors_R, (R.shape[0], 1)),
+            ).reshape(R.shape[0], n_det, -1)
+
+            values[i:i + chunk] = paths if self.mode == "paths" else optical_depth(paths, problem.Sigma_T)
+
+    def lookup(self, R, return_error=False):
+        """
+        Interpolated table values at the source positions R (N, 2), shaped
+        (N, n_detectors) for attenuation tables and (N, n_detectors,
+        n_regions) for path tables. Points outside the table are clamped
+        to its edge.
+
+        With return_error=True also returns the spread of the four
+        surrounding grid values. That's only a heuristic indicator of where
+        the interpolation is rough, not a bound; see estimate_error for the
+        measured error against the exact ray trace.
+        """
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+
+        f = (R - self.extent[:2]) / self.spacing
+        f = np.clip(f, 0, np.array(self.shape) - 1)
+
+        i = np.minimum(np.floor(f).astype(np.intp), np.maximum(np.array(self.shape) - 2, 0))
+        w = f - i
+
+        ix, iy = i[:, 0], i[:, 1]
+        jx = np.minimum(ix + 1, self.shape[0] - 1)
+        jy = np.minimum(iy + 1, self.shape[1] - 1)
+
+        corners = np.stack((
+            self.values[ix, iy],
+            self.values[jx, iy],
+            self.values[ix, jy],
+            self.values[jx, jy],
+        ))
+
+        wx = w[:, 0].reshape((-1,) + (1,) * (corners.ndim - 2))
+        wy = w[:, 1].reshape((-1,) + (1,) * (corners.ndim - 2))
+
+        values = (1 - wx) * (1 - wy) * corners[0] \
+            + wx * (1 - wy) * corners[1] \
+            + (1 - wx) * wy * corners[2] \
+            + wx * wy * corners[3]
+
+        if return_error:
+            return values, corners.max(axis=0) - corners.min(axis=0)
+        else:
+            return values
+
+    def optical_depth(self, R, Sigma_T):
+        # (N, n_detectors) optical depth paths . Sigma_T
+        if self.mode == "paths":
+            return optical_depth(self.lookup(R), Sigma_T)
+
+        if not np.array_equal(self.Sigma_T, Sigma_T):
+            raise TableMismatchError("Attenuation table was built for different cross sections, use a paths table instead")
+
+        return self.lookup(R)
+
+    def estimate_error(self, problem, n=1000, seed=0):
+        """
+        Compare the table against the exact ray trace at n random source
+        positions and record the max/RMS error of the optical depth per
+        detector in self.error.
+        """
+        rng = np.random.RandomState(seed)
+        x0, y0, x1, y1 = self.extent
+        R = rng.uniform([x0, y0], [x1, y1], size=(n, 2))
+
+        n_det = len(self.detectors_R)
+        paths = problem.domain.construct_paths(
+            np.repeat(R, n_det, axis=0),
+            np.tile(self.detectors_R, (n, 1)),
+        ).reshape(n, n_det, -1)
+
+        Sigma_T = problem.Sigma_T if self.Sigma_T is None else self.Sigma_T
+        err = np.abs(self.optical_depth(R, Sigma_T) - optical_depth(paths, Sigma_T))
+
+        self.error = {
+            "n": n,
+            "max": err.max(axis=0),
+            "rms": np.sqrt((err ** 2).mean(axis=0)),
+        }
+
+        return self.error
+
+    def detector_block(self, start, stop, problem=None):
+        """
+        Table for detectors start to stop only, a view of this one's values
+        (a memory mapped table stays mapped). The deck hash is recomputed
+        for problem, the problem restricted to the same detectors, if given.
+        """
+        from gefry3.compiled import deck_hash
+
+        error = dict(self.error)
+        for k in ("max", "rms"):
+            if k in error:
+                error[k] = np.asarray(error[k])[start:stop]
+
+        return PathTable(
+            self.extent,
+            self.values[:, :, start:stop],
+            self.detectors_R[start:stop],
+            mode=self.mode,
+            Sigma_T=self.Sigma_T,
+            error=error,
+            deck_hash=None if problem is None else deck_hash(problem),
+            fname=self.fname,
+        )
+
+    def apply_edit(self, problem, edit):
+        """
+        Update the table after a DomainEdit to problem, retracing only the
+        (node, detector) rays that cross the edited region.
+        """
+        from gefry3.compiled import deck_hash
+
+        n_det = len(self.detectors_R)
+        values = self.values.reshape((-1, n_det) + self.values.shape[3:])
+
+        # A memory mapped table is shared, an edit gets a private copy
+        if not values.flags.writeable:
+            values = np.array(values)
+            self.fname = None
+
+        if self.mode == "paths":
+            values = edit.remap(values)
+        else:
+            self.Sigma_T = problem.Sigma_T
+
+        nodes = self.nodes.reshape(-1, 2)
+        m, d = np.nonzero(edit.touches(nodes[:, None], self.detectors_R[None]))
+
+        for i in range(0, len(m), _BUILD_CHUNK):
+            mi, di = m[i:i + _BUILD_CHUNK], d[i:i + _BUILD_CHUNK]
+            paths = problem.domain.construct_paths(nodes[mi], self.detectors_R[di])
+
+            values[mi, di] = paths if self.mode == "paths" else optical_depth(paths, problem.Sigma_T)
+
+        self.values = values.reshape(tuple(self.shape) + values.shape[1:])
+        self.deck_hash = deck_hash(problem)
+
+        if self.error:
+            self.estimate_error(problem, n=int(self.error["n"]))
+
+        return len(m)
+
+    def check_compatible(self, problem):
+        from gefry3.compiled import deck_hash
+
+        detectors_R = np.array([d.R for d in problem.detectors], dtype=np.float64)
+
+        if not np.array_equal(detectors_R, self.detectors_R):
+            raise TableMismatchError("Table detectors don't match the problem")
+
+        if self.mode == "paths" and self.values.shape[-1] != 1 + len(problem.domain.solids):
+            raise TableMismatchError("Table has the wrong number of regions for the problem")
+
+        if self.deck_hash is not None and self.deck_hash != deck_hash(problem):
+            raise TableMismatchError("Table was built for a different deck")
+
+    def save(self, fname):
+        arrays = {
+            "extent": self.extent,
+            "values": self.values,
+            "detectors_R": self.detectors_R,
+            "mode": np.array(self.mode),
+        }
+
+        if self.Sigma_T is not None:
+            arrays["Sigma_T"] = self.Sigma_T
+
+        if self.deck_hash is not None:
+            arrays["deck_hash"] = np.array(self.deck_hash)
+
+        for (k, v) in self.error.items():
+            arrays["error_" + k] = np.asarray(v)
+
+        np.savez(fname, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            error = {k[len("error_"):]: data[k] for k in data.files if k.startswith("error_")}
+
+            return cls(
+                data["extent"],
+                data["values"],
+                data["detectors_R"],
+                mode=str(data["mode"]),
+                Sigma_T=data["Sigma_T"] if "Sigma_T" in data.files else None,
+                error=error,
+                deck_hash=str(data["deck_hash"]) if "deck_hash" in data.files else None,
+            )
+
+    def _write_header(self, fname):
+        # Everything but the values, next to the .npy file fname
+        from gefry3.compiled import _jsonable
+
+        header = {
+            "extent": self.extent,
+            "detectors_R": self.detectors_R,
+            "mode": self.mode,
+            "Sigma_T": self.Sigma_T,
+            "error": self.error,
+            "deck_hash": self.deck_hash,
+            "shape": self.values.shape,
+            "dtype": self.values.dtype.str,
+        }
+
+        with open(_header_name(fname) + ".partial", "w") as f:
+            json.dump(header, f, default=_jsonable)
+
+        os.replace(_header_name(fname) + ".partial", _header_name(fname))
+
+    @classmethod
+    def open(cls, fname, problem=None):
+        """
+        Open a table written by build_file with its values memory mapped
+        read only. If problem is given the table is checked against it,
+        and a table built for a different deck raises TableMismatchError,
+        as does a header that doesn't match the values.
+        """
+        with open(_header_name(fname)) as f:
+            header = json.load(f)
+
+        values = np.load(fname, mmap_mode="r")
+
+        if tuple(header["shape"]) != values.shape or np.dtype(header["dtype"]) != values.dtype:
+            raise TableMismatchError("Table header doesn't match {}, it was probably rebuilt while opening".format(fname))
+
+        table = cls(
+            header["extent"],
+            values,
+            header["detectors_R"],
+            mode=header["mode"],
+            Sigma_T=header["Sigma_T"],
+            error={k: np.asarray(v) for (k, v) in header["error"].items()},
+            deck_hash=header["deck_hash"],
+            fname=fname,
+        )
+
+        if problem is not None:
+            table.check_compatible(problem)
+
+        return table
+
+def _shadow(geoms, D, reach):
+    # Region of source positions whose ray to D touches one of the polygons
+    # geoms: the polygons themselves plus the quadrilateral every edge
+    # sweeps out going away from D, out to reach from D
+    coords, ring = shapely.get_coordinates(shapely.get_rings(shapely.get_parts(geoms)), return_index=True)
+    edge = ring[1:] == ring[:-1]
+    a, b = coords[:-1][edge], coords[1:][edge]
+
+    def far(X):
+        V = X - D
+        return D + V * (reach / np.hypot(*V.T))[:, None]
+
+    quads = shapely.polygons(np.stack((a, b, far(b), far(a), a), axis=1))
+    quads = quads[shapely.area(quads) > 0]
+
+    region = shapely.union_all(np.concatenate((geoms, quads)))
+    shapely.prepare(region)
+
+    return region
+
+class VisibilityMap(object):
+    """
+    Per detector line of sight rasters for BinaryDomainProblem. The extent
+    is split into shape[0] x shape[1] cells and each cell is marked
+    visible, shadow or mixed for every detector. A cell is only marked
+    visible or shadow if that holds for every source position in it, so
+    lookups are exact; mixed cells fall back to an exact query.
+
+    A cell is visible if no ray from it to the detector touches a solid.
+    It's in shadow if every ray from it crosses a solid eroded by half the
+    distance threshold: a ray through a point that deep in a solid has a
+    chord longer than the threshold, as long as the source and detector
+    are outside the solid. Cells overlapping a solid need it eroded by the
+    whole threshold instead. Detectors inside a solid get no visible or
+    shadow cells at all.
+    """
+
+    SHADOW, VISIBLE, MIXED = 0, 1, 2
+
+    def __init__(self, extent, states, detectors_R, distance_threshold, deck_hash=None):
+        self.extent = np.asarray(extent, dtype=np.float64)
+        self.states = np.asarray(states, dtype=np.uint8)
+        self.detectors_R = np.asarray(detectors_R, dtype=np.float64)
+        self.distance_threshold = np.float64(distance_threshold)
+        self.deck_hash = deck_hash
+
+        self.shape = self.states.shape[:2]
+
+        x0, y0, x1, y1 = self.extent
+        self.spacing = np.array([(x1 - x0) / self.shape[0], (y1 - y0) / self.shape[1]])
+
+    @classmethod
+    def build(cls, problem, shape=(256, 256), extent=None):
+        from gefry3.compiled import deck_hash
+
+        if extent is None:
+            extent = problem.domain.bbox.bounds
+
+        extent = np.asarray(extent, dtype=np.float64)
+        x0, y0, x1, y1 = extent
+        nx, ny = shape
+
+        X, Y = np.meshgrid(np.linspace(x0, x1, nx + 1), np.linspace(y0, y1, ny + 1), indexing="ij")
+        boxes = shapely.box(X[:-1, :-1], Y[:-1, :-1], X[1:, 1:], Y[1:, 1:]).ravel()
+
+        geoms = problem.domain.geoms
+
+        # Cells with sources inside a solid
+        overlaps = np.zeros(len(boxes), dtype=bool)
+        overlaps[shapely.STRtree(geoms).query(boxes, predicate="intersects")[0]] = True
+
+        # Solids eroded by half the threshold (for sources outside them)
+        # and by the whole threshold (for sources that may be inside), plus
+        # a little so that touching the eroded solid still means a long
+        # enough chord. Round joins are polygons inside the true arcs,
+        # hence the 1 / cos.
+        quad_segs = 2
+        eps = 1e-9 * np.max(extent[2:] - extent[:2])
+
+        def erode(r):
+            cores = shapely.buffer(geoms, -(r + eps) / np.cos(np.pi / 4 / quad_segs), quad_segs=quad_segs)
+            return cores[~shapely.is_empty(cores)]
+
+        threshold = problem.distance_threshold
+        cores = erode(threshold / 2), erode(threshold)
+
+        detectors_R = np.array([d.R for d in problem.detectors], dtype=np.float64)
+        corners = np.array([[x0, y0], [x0, y1], [x1, y0], [x1, y1]])
+
+        states = np.full((len(boxes), len(detectors_R)), cls.MIXED, dtype=np.uint8)
+
+        for (d, D) in enumerate(detectors_R):
+            if shapely.intersects(geoms, shapely.points(D)).any():
+                continue
+
+            reach = 2 * np.hypot(*(corners - D).T).max() + 1
+
+            visible = ~shapely.intersects(_shadow(geoms, D, reach), boxes)
+            shadow = shapely.contains(_shadow(cores[0], D, reach), boxes)
+
+            if threshold > 0:
+                shadow = (shadow & ~overlaps) | shapely.contains(_shadow(cores[1], D, reach), boxes)
+
+            states[visible, d] = cls.VISIBLE
+            states[shadow, d] = cls.SHADOW
+
+        states = states.reshape(nx, ny, len(detectors_R))
+
+        return cls(extent, states, detectors_R, problem.distance_threshold, deck_hash=deck_hash(problem))
+
+    def cells(self, R):
+        # Cell indices of the source positions R (N, 2), and whether each
+        # one is inside the map at all
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        i = np.floor((R - self.extent[:2]) / self.spacing).astype(np.intp)
+
+        # The far edges belong to the last cells
+        x0, y0, x1, y1 = self.extent
+        i[R[:, 0] == x1, 0] = self.shape[0] - 1
+        i[R[:, 1] == y1, 1] = self.shape[1] - 1
+
+        inside = ((i >= 0) & (i < np.array(self.shape))).all(axis=1)
+
+        return np.where(inside[:, None], i, 0), inside
+
+    def lookup(self, R, domain=None):
+        """
+        (N, n_detectors) visibility of the detectors from sources at R.
+        Mixed cells and points outside the map are resolved with exact
+        queries against domain; without a domain they come back as MIXED,
+        so the result is the raw uint8 state instead of a boolean.
+        """
+        R = np.asarray(R, dtype=np.float64).reshape(-1, 2)
+        i, inside = self.cells(R)
+
+        states = self.states[i[:, 0], i[:, 1]]
+        states[~inside] = self.MIXED
+
+        if domain is None:
+            return states
+
+        n, k = np.nonzero(states == self.MIXED)
+        visible = states == self.VISIBLE
+
+        if len(n):
+            visible[n, k] = domain.visibility(R[n], self.detectors_R[k], self.distance_threshold)
+
+        return visible
+
+    def apply_edit(self, problem, edit):
+        # Mark every cell with a ray to some detector that might cross the
+        # edited region as mixed. Padding the region by half a cell
+        # diagonal covers rays from anywhere in the cell, not just its
+        # center.
+        from gefry3.compiled import deck_hash
+
+        x0, y0 = self.extent[:2]
+        X, Y = np.meshgrid(
+            x0 + (np.arange(self.shape[0]) + 0.5) * self.spacing[0],
+            y0 + (np.arange(self.shape[1]) + 0.5) * self.spacing[1],
+            indexing="ij",
+        )
+        centers = np.stack((X, Y), axis=-1)[:, :, None]
+
+        touched = edit.touches(centers, self.detectors_R, pad=np.hypot(*self.spacing) / 2)
+        self.states[touched] = self.MIXED
+        self.deck_hash = deck_hash(problem)
+
+        return touched.sum()
+
+    @property
+    def mixed_fraction(self):
+        return np.mean(self.states == self.MIXED)
+
+    def check_compatible(self, problem):
+        from gefry3.compiled import deck_hash
+
+        detectors_R = np.array([d.R for d in problem.detectors], dtype=np.float64)
+
+        if not np.array_equal(detectors_R, self.detectors_R):
+            raise TableMismatchError("Visibility map detectors don't match the problem")
+
+        if self.distance_threshold != problem.distance_threshold:
+            raise TableMismatchError("Visibility map was built for a different distance threshold")
+
+        if self.deck_hash is not None and self.deck_hash != deck_hash(problem):
+            raise TableMismatchError("Visibility map was built for a different deck")
+
+    def save(self, fname):
+        arrays = {
+            "extent": self.extent,
+            "states": self.states,
+            "detectors_R": self.detectors_R,
+            "distance_threshold": self.distance_threshold,
+        }
+
+        if self.deck_hash is not None:
+            arrays["deck_hash"] = np.array(self.deck_hash)
+
+        np.savez(fname, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            return cls(
+                data["extent"],
+                data["states"],
+                data["detectors_R"],
+                data["distance_threshold"],
+                deck_hash=str(data["deck_hash"]) if "deck_hash" in data.files else None,
+            )
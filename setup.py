@@ -5,10 +5,10 @@ setup(
     version="3.5.3",
     author="Jason M. Hite",
     packages=["gefry3", "gefry3.classes"],
-    install_requires=['pyyaml', 'shapely', 'numpy'],
+    install_requires=['pyyaml', 'shapely>=2.0', 'numpy'],
     license="2-clause BSD (FreeBSD)",
     extras_require={
         "plots": ["matplotlib", "seaborn"],
-        "OrientedPrismDetector": ["pyst"],
+        "OrientedPrismDetector": [],
     },
 )                     
@@ -0,0 +1,17 @@
+import os
+import warnings
+
+import pytest
+
+import gefry3
+
+EXAMPLE_DECK = os.path.join(os.path.dirname(__file__), "..", "examples", "g3_deck.yml")
+
+def read_example(problem_type=None):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return gefry3.read_input_problem(EXAMPLE_DECK, problem_type=problem_type)
+
+@pytest.fixture
+def problem():
+    return read_example()
@@ -0,0 +1,79 @@
+import numpy as np
+
+from gefry3.classes.cache import PathCache, _ENTRY_OVERHEAD
+
+def test_lru_eviction():
+    value = np.zeros(4)
+    cache = PathCache(resolution=1.0, max_bytes=3 * (value.nbytes + _ENTRY_OVERHEAD))
+
+    for k in range(3):
+        cache.put(k, value + k)
+
+    assert len(cache) == 3
+    assert cache.get(0)[0] == 0  # 0 is now the most recently used
+
+    cache.put(3, value + 3)
+    assert len(cache) == 3
+    assert cache.nbytes <= cache.max_bytes
+    assert cache.get(1) is None
+    assert all(cache.get(k) is not None for k in (0, 2, 3))
+
+    stats = cache.stats
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (4, 1, 1)
+    assert stats["hit_rate"] == 0.8
+    assert stats["entries"] == 3
+    assert stats["nbytes"] == 3 * (value.nbytes + _ENTRY_OVERHEAD)
+
+def test_cached_paths(problem):
+    D = problem.domain
+    D.engine = "numpy"
+    cache = D.enable_cache(resolution=0.5)
+
+    A = np.random.RandomState(0).uniform(D.bbox.bounds[:2], D.bbox.bounds[2:], size=(200, 2))
+    A, B = problem._batch_rays(A)
+
+    first = D.construct_paths(A, B, cached=True)
+    assert (cache.hits, cache.misses) == (0, len(A))
+
+    # Nearby sources snap to the same cells
+    second = D.construct_paths(A + 0.1, B, cached=True)
+    assert cache.hits + cache.misses == 2 * len(A)
+    assert cache.hits > 0.5 * len(A)
+
+    snapped = D.construct_paths(cache.snap(A + 0.1), B)
+    assert np.array_equal(second, snapped)
+    assert np.array_equal(first, D.construct_paths(cache.snap(A), B))
+
+def test_cache_budget(problem):
+    D = problem.domain
+    D.engine = "numpy"
+    cache = D.enable_cache(resolution=1e-6, max_bytes=2 ** 14)
+
+    A = np.random.RandomState(1).uniform(D.bbox.bounds[:2], D.bbox.bounds[2:], size=(500, 2))
+    D.construct_paths(*problem._batch_rays(A), cached=True)
+
+    assert 0 < cache.nbytes <= cache.max_bytes
+    assert cache.evictions == 500 * len(problem.detectors) - len(cache)
+
+def test_cache_edit(problem):
+    D = problem.domain
+    D.engine = "numpy"
+    cache = D.enable_cache(resolution=1e-6)
+
+    A = np.random.RandomState(2).uniform(D.bbox.bounds[:2], D.bbox.bounds[2:], size=(300, 2))
+    A, B = problem._batch_rays(A)
+    D.construct_paths(A, B, cached=True)
+
+    V = np.asarray(D.solids[0].vertices, dtype=np.float64)
+    edit = problem.remove_solid(3)
+    problem.replace_solid(0, (V + V.mean(axis=0)) / 2)
+
+    touched = edit.touches(A, B)
+    assert 0 < cache.invalidations < len(A)
+    assert len(cache) <= len(A) - touched.sum()
+
+    # Whatever survived has been renumbered for the new solid list, and
+    # only the dropped rays are traced again
+    kept, misses = len(cache), cache.misses
+    assert np.array_equal(D.construct_paths(A, B, cached=True), D.construct_paths(cache.snap(A), B))
+    assert cache.misses - misses == len(A) - kept
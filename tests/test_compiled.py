@@ -0,0 +1,42 @@
+import numpy as np
+import warnings
+import yaml
+
+import gefry3
+
+from conftest import EXAMPLE_DECK
+
+def _dump(problem):
+    return yaml.dump(gefry3.dump_dict(problem), Dumper=gefry3.problem.MyDumper)
+
+def test_round_trip(problem, tmp_path):
+    fname = str(tmp_path / "deck.npz")
+    gefry3.compile_deck(problem, fname)
+    loaded = gefry3.load_compiled(fname)
+
+    assert _dump(loaded) == _dump(problem)
+    assert gefry3.deck_hash(loaded) == gefry3.deck_hash(problem)
+    assert loaded.domain.empty.equals(problem.domain.empty)
+
+def test_round_trip_integer_coordinates(tmp_path):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        data = gefry3.read_input_problem(EXAMPLE_DECK, debug=True)
+
+    # Whole numbers in the YAML, as people tend to write them
+    domain = data["data"]["domain"]
+    domain["bbox"] = [[0, 0], [250, 0], [250, 180], [0, 180]]
+    for S in domain["solids"]:
+        S["vertices"] = np.round(S["vertices"]).astype(int).tolist()
+    data["data"]["source"]["R"] = [158, 98]
+
+    deck = str(tmp_path / "deck.yml")
+    with open(deck, "w") as f:
+        yaml.dump(data, f)
+
+    problem = gefry3.read_input_problem(deck)
+    gefry3.compile_deck(problem, str(tmp_path / "deck.npz"))
+    loaded = gefry3.load_compiled(str(tmp_path / "deck.npz"))
+
+    assert _dump(loaded) == _dump(problem)
+    assert type(loaded.domain.solids[0].vertices[0][0]) is int
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+def _rays(problem, n=300, seed=0):
+    rng = np.random.RandomState(seed)
+    x0, y0, x1, y1 = problem.domain.bbox.bounds
+    R = rng.uniform([x0, y0], [x1, y1], size=(n, 2))
+
+    return problem._batch_rays(R)
+
+def test_shapely2_after_edits(problem):
+    domain = problem.domain
+    A, B = _rays(problem)
+
+    domain.engine = "shapely2"
+    domain.construct_paths(A, B)
+
+    domain.remove_solid(3)
+    V = np.asarray(domain.solids[0].vertices, dtype=np.float64)
+    domain.replace_solid(0, (V + V.mean(axis=0)) / 2)
+
+    got = domain.construct_paths(A, B)
+    domain.engine = "numpy"
+
+    assert np.allclose(got, domain.construct_paths(A, B), atol=1e-8)
+
+@pytest.mark.parametrize("engine", ["numpy", "shapely2"])
+def test_engines_agree(problem, engine):
+    domain = problem.domain
+    assert domain.engine == "shapely"
+
+    A, B = _rays(problem)
+
+    # Rays from every solid vertex too, which graze edges and corners
+    V = np.concatenate([np.asarray(S.vertices, dtype=np.float64).reshape(-1, 2) for S in domain.solids])
+    A = np.vstack((A, np.repeat(V, 2, axis=0)))
+    B = np.vstack((B, np.tile(np.array([d.R for d in problem.detectors[:2]]), (len(V), 1))))
+
+    expected = domain.construct_paths(A, B)
+
+    domain.engine = engine
+    got = domain.construct_paths(A, B)
+
+    assert got.shape == expected.shape
+    assert np.abs(got - expected).max() < 1e-8 * np.abs(expected).max()
+
+@pytest.mark.parametrize("engine", ["numpy", "shapely2"])
+def test_engines_visibility(problem, engine):
+    domain = problem.domain
+    A, B = _rays(problem)
+
+    expected = domain.visibility(A, B, 1.0)
+
+    domain.engine = engine
+    assert np.array_equal(domain.visibility(A, B, 1.0), expected)
+
+def test_segment_box_overlap():
+    import shapely
+    from gefry3.classes.spatial import segment_box_overlap
+
+    rng = np.random.RandomState(0)
+    A = rng.randint(0, 10, (400, 2)).astype(float)
+    B = rng.randint(0, 10, (400, 2)).astype(float)
+
+    # Plenty of horizontal and vertical segments too
+    B[:100, 0] = A[:100, 0]
+    B[100:200, 1] = A[100:200, 1]
+
+    box = np.array([3.0, 4.0, 6.0, 7.0])
+    expected = shapely.intersects(shapely.linestrings(np.stack((A, B), axis=1)), shapely.box(*box))
+
+    assert np.array_equal(segment_box_overlap(A, B, box), expected)
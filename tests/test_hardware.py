@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+import gefry3
+from gefry3.classes.hardware import DetectorArray, OrientedPrismDetectorIntrinsic, prism_solid_angles
+
+class HalfDetector(gefry3.Detector):
+    # Only overrides compute_response, and isn't registered
+    def compute_response(self, I, r):
+        return super().compute_response(I, r) / 2
+
+def test_unregistered_detector(problem):
+    d = problem.detectors[0]
+    problem.detectors[0] = HalfDetector(d.R, d.epsilon, d.area, d.dwell)
+
+    R = np.random.RandomState(0).uniform(10, 150, (20, 2))
+    I = 1e9
+
+    responses = problem.evaluate_batch(R, I)
+    for (r, row) in zip(R, responses):
+        assert np.allclose(row, problem(r, I), rtol=1e-10)
+
+def test_unregistered_detector_gradient():
+    d = HalfDetector([10.0, 20.0], 0.5, 1e-3, 60.0)
+    array = DetectorArray([d, gefry3.Detector(d.R, d.epsilon, d.area, d.dwell)])
+
+    R = np.array([[0.0, 0.0], [30.0, 5.0]])
+    grad = array.compute_response_gradients(np.ones((2, 2)), R)
+
+    assert np.allclose(grad[:, 0], grad[:, 1] / 2, rtol=1e-6)
+
+def test_unregistered_detector_pack(problem):
+    d = problem.detectors[0]
+    problem.detectors[0] = HalfDetector(d.R, d.epsilon, d.area, d.dwell)
+
+    with pytest.raises(ValueError):
+        gefry3.pack_problem(problem)
+
+# Prism solid angles from 2D Gauss-Legendre quadrature of d / r^3 over the
+# facets facing the point, (x, y, half dimensions, omega)
+PRISM_SOLID_ANGLES = [
+    (0.0, 10.0, (1.0, 0.5, 0.75), 0.03295618376225501),
+    (3.0, 2.0, (1.0, 0.5, 0.75), 0.2633012492580675),
+    (-2.5, -4.0, (1.0, 0.5, 0.75), 0.16122852718873248),
+    (1.2, 0.6, (1.0, 0.5, 0.75), 2.298614990852091),
+    (0.0, -0.6, (1.0, 0.5, 0.75), 5.620518411456994),
+    (25.0, 0.0, (0.2, 0.1, 0.05), 3.2517879753908e-05),
+    (-7.0, 9.0, (0.2, 0.1, 0.05), 0.00034002127777623374),
+]
+
+@pytest.mark.parametrize("x, y, half, omega", PRISM_SOLID_ANGLES)
+def test_prism_solid_angle(x, y, half, omega):
+    assert np.isclose(prism_solid_angles(np.array(x), np.array(y), np.array(half)), omega, rtol=1e-12, atol=0)
+
+def test_prism_solid_angle_on_axis():
+    # Square facet of side 2a seen on axis from d is 4 asin(a^2 / (a^2 + d^2))
+    d = np.linspace(0.1, 50, 100)
+    omega = prism_solid_angles(np.zeros_like(d), 0.5 + d, np.array([1.0, 0.5, 1.0]))
+
+    assert np.allclose(omega, 4 * np.arcsin(1 / (1 + d ** 2)), rtol=1e-12, atol=0)
+
+def test_prism_detector_rotation():
+    # Rotating the detector and the source together doesn't change anything
+    d0 = gefry3.OrientedPrismDetector([10.0, 20.0], [2.0, 1.0, 1.5], 0.0, 0.3, 60.0)
+    d1 = gefry3.OrientedPrismDetector([10.0, 20.0], [2.0, 1.0, 1.5], np.pi / 2, 0.3, 60.0)
+
+    R = np.array([[13.0, 22.0], [4.0, 15.0]])
+    R_rot = d0.R + (R - d0.R).dot([[0.0, 1.0], [-1.0, 0.0]])
+
+    assert np.allclose(d0.compute_responses(1.0, R), d1.compute_responses(1.0, R_rot), rtol=1e-12)
+
+def _baseline_intrinsic(d, r):
+    # The original shapely chord: the ray from r towards the center,
+    # extended past it, intersected with the detector footprint
+    from shapely.geometry import LineString, Polygon
+
+    profile = Polygon(d.vertices[:4, :2])
+    dR = d.center[:2] - r
+    theta = np.arctan2(dR[1], dR[0])
+    extension = d._length_extension * np.array([np.cos(theta), np.sin(theta)])
+
+    L = profile.intersection(LineString([r, d.center[:2] + extension]))
+
+    return 1.0 - np.exp(-d.sigma_det * L.length)
+
+@pytest.mark.parametrize("theta", [0.0, 0.3, np.pi / 2])
+def test_intrinsic_efficiency(theta):
+    d = OrientedPrismDetectorIntrinsic([10.0, 20.0], [2.0, 1.0, 1.5], theta, 0.7, 60.0)
+    c, s = np.cos(theta), np.sin(theta)
+
+    # Detector frame offsets: at the center, inside, on the faces and
+    # corners, beside the detector, grazing a face, and behind it
+    offsets = np.array([
+        [0.0, 0.0], [0.3, -0.2], [1.0, 0.0], [0.0, 0.5], [1.0, 0.5], [-1.0, -0.5],
+        [1.5, 0.0], [0.0, -3.0], [4.0, 0.5], [-4.0, -0.5], [-6.0, 0.0], [-5.0, 3.0],
+        [20.0, 1.0], [0.5, 12.0],
+    ])
+    R = d.center[:2] + offsets.dot([[c, s], [-s, c]])
+
+    expected = np.array([_baseline_intrinsic(d, r) for r in R])
+
+    assert np.allclose(d.compute_intrinsics(R), expected, rtol=1e-10, atol=1e-12)
+    assert np.allclose([d.compute_intrinsic(r) for r in R], expected, rtol=1e-10, atol=1e-12)
+
+    # And through DetectorArray, which batches the chords separately
+    array = DetectorArray([d, gefry3.Detector([0.0, 0.0], 0.5, 1e-3, 60.0)])
+    omega = np.array([d.omega(r) for r in R])
+
+    responses = array.compute_responses(np.ones((len(R), 2)), R)
+    assert np.allclose(responses[:, 0], omega / (4 * np.pi) * d.dwell * expected, rtol=1e-10, atol=1e-12)
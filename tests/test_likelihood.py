@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from math import lgamma
+
+import gefry3
+
+from test_problem import _central_differences
+
+BACKGROUND = 2.0
+
+def _counts(problem):
+    rng = np.random.RandomState(0)
+    counts = rng.poisson(problem(problem.source.R, problem.source.I0) + BACKGROUND * 5.0).astype(float)
+
+    # A detector that saw nothing, for the 0 log 0 terms
+    counts[2] = 0
+
+    return counts
+
+def _proposals(problem, n=15):
+    rng = np.random.RandomState(1)
+    R = rng.uniform(20, 150, (n, 2))
+    I = problem.source.I0 * rng.uniform(0.5, 2.0, n)
+
+    return np.column_stack((R, I))
+
+def _expected(problem, X):
+    # Expected counts one proposal at a time, through __call__
+    dwell = np.array([d.dwell for d in problem.detectors])
+
+    return np.array([problem(x[:2], x[2]) for x in X]) + BACKGROUND * dwell
+
+def test_poisson(problem):
+    counts = _counts(problem)
+    X = _proposals(problem)
+    L = gefry3.PoissonLikelihood(problem, counts, background=BACKGROUND)
+
+    expected = [
+        sum(k * np.log(m) - m - lgamma(k + 1) for (k, m) in zip(counts, mu))
+        for mu in _expected(problem, X)
+    ]
+
+    assert np.allclose(L(X), expected, rtol=1e-10)
+    assert np.isclose(L(X[0]), expected[0], rtol=1e-10)
+
+def test_gaussian(problem):
+    counts = _counts(problem)
+    X = _proposals(problem)
+    L = gefry3.GaussianLikelihood(problem, counts, background=BACKGROUND)
+
+    var = np.maximum(counts, 1.0)
+    expected = [
+        sum(-0.5 * np.log(2 * np.pi * v) - (m - k) ** 2 / (2 * v) for (k, m, v) in zip(counts, mu, var))
+        for mu in _expected(problem, X)
+    ]
+
+    assert np.allclose(L(X), expected, rtol=1e-10)
+    assert np.isclose(L(X[0]), expected[0], rtol=1e-10)
+
+@pytest.mark.parametrize("kind", ["PoissonLikelihood", "GaussianLikelihood"])
+def test_gradient(problem, kind):
+    problem.domain.engine = "numpy"
+
+    X = _proposals(problem)
+    L = getattr(gefry3, kind)(problem, _counts(problem), background=BACKGROUND)
+
+    values, grad = L.gradient(X)
+    assert np.allclose(values, L(X), rtol=1e-12)
+
+    dX = _central_differences(lambda Y: L(Y)[:, None], X, [1e-5, 1e-5, 1e-4 * problem.source.I0])[:, 0]
+    assert np.allclose(grad, dX, rtol=1e-5, atol=1e-8 * np.abs(dX).max(axis=0))
+
+    single = L.gradient(X[0])
+    assert np.isclose(single[0], values[0]) and np.allclose(single[1], grad[0])
@@ -0,0 +1,23 @@
+import numpy as np
+
+import gefry3
+
+def test_detector_blocks(problem):
+    R = np.random.RandomState(0).uniform(10, 150, (200, 2))
+    expected = problem.evaluate_batch(R, 1e9)
+
+    with gefry3.ParallelEvaluator(problem, max_workers=2, chunk_size=64, detector_blocks=3) as E:
+        got = E.evaluate_batch(R, 1e9)
+
+    assert np.allclose(got, expected, rtol=1e-12)
+
+def test_detector_blocks_with_table(problem, tmp_path):
+    problem.tabulate_file(str(tmp_path / "table.npy"), shape=(21, 21), n_check=10)
+
+    R = np.random.RandomState(0).uniform(10, 150, (200, 2))
+    expected = problem.evaluate_batch(R, 1e9)
+
+    with gefry3.ParallelEvaluator(problem, max_workers=2, chunk_size=64, detector_blocks=3) as E:
+        got = E.evaluate_batch(R, 1e9)
+
+    assert np.allclose(got, expected, rtol=1e-12)
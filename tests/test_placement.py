@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+import gefry3
+
+def _placement(problem, n=6):
+    problem.domain.engine = "numpy"
+    rng = np.random.RandomState(0)
+
+    d = problem.detectors[0]
+    candidates = [gefry3.Detector(R, d.epsilon, d.area, d.dwell) for R in rng.uniform(20, 150, (n, 2))]
+    prior = np.column_stack((rng.uniform(20, 150, (50, 2)), np.full(50, 1e9)))
+
+    return gefry3.Placement(problem, candidates, prior, background=300)
+
+def test_greedy(problem):
+    S = _placement(problem)
+    network = S.greedy(3)
+
+    assert len(set(network)) == 3
+    assert np.allclose(S.fisher, S.fisher_terms[:, network].sum(axis=1))
+
+def test_greedy_too_many(problem):
+    S = _placement(problem)
+
+    with pytest.raises(ValueError):
+        S.greedy(7)
+
+    assert S.selected == []
@@ -0,0 +1,20 @@
+import numpy as np
+
+from conftest import read_example
+
+def test_single_precision_outputs():
+    P = read_example("Perturbable_XS_Problem")
+    R = np.random.RandomState(0).uniform(10, 150, (50, 2))
+    Sigma_T = np.tile(P.Sigma_T, (3, 1)) * np.array([[1.0], [0.9], [1.1]])
+
+    reference = P.evaluate_xs_batch(R[0], 1e9, Sigma_T)
+    assert reference.dtype == np.float64
+
+    P.set_precision("single")
+
+    xs = P.evaluate_xs_batch(R[0], 1e9, Sigma_T)
+    assert xs.dtype == np.float32
+    assert np.allclose(xs, reference, rtol=1e-5)
+
+    args = (P.interstitial_material, P.materials)
+    assert P.evaluate_batch(R, 1e9, *args).dtype == np.float32
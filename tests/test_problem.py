@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from test_tables import _binary_problem
+
+def test_binary_gradient():
+    P = _binary_problem(1.0)
+
+    with pytest.raises(TypeError):
+        P.evaluate_batch_with_gradient(np.array([[50.0, 50.0]]), 1e9)
+
+def test_binary_set_material():
+    P = _binary_problem(1.0)
+
+    with pytest.raises(TypeError):
+        P.set_material(0, None)
+
+def _central_differences(f, x, h):
+    # Derivatives of f (N, n) with respect to each column of x (N, k)
+    grad = []
+
+    for k in range(x.shape[1]):
+        step = np.zeros_like(x)
+        step[:, k] = h[k]
+        grad.append((f(x + step) - f(x - step)) / (2 * h[k]))
+
+    return np.stack(grad, axis=-1)
+
+@pytest.mark.parametrize("engine", ["shapely", "numpy"])
+def test_gradient(problem, engine):
+    problem.domain.engine = engine
+
+    R = np.random.RandomState(0).uniform(20, 150, (20, 2))
+    I = np.full(len(R), 1e9)
+
+    responses, jacobian = problem.evaluate_batch_with_gradient(R, I)
+    assert np.allclose(responses, problem.evaluate_batch(R, I), rtol=1e-12)
+
+    def close(a, b):
+        return np.abs(a - b).max() <= 1e-6 * np.abs(b).max()
+
+    # Position
+    dR = _central_differences(lambda X: problem.evaluate_batch(X, I), R, [1e-5, 1e-5])
+    assert close(jacobian[..., :2], dR)
+
+    # Intensity, responses are linear in it
+    assert np.allclose(jacobian[..., 2] * I[:, None], responses, rtol=1e-12)
+
+    # Cross sections, one region at a time, the paths don't change
+    problem.domain.enable_cache(resolution=1e-12)
+    Sigma_T = problem.Sigma_T
+    h = 1e-4 * np.maximum(Sigma_T, 1e-3)
+    dS = np.stack([
+        (problem._attenuated_batch(R, I, Sigma_T + h[k] * e) - problem._attenuated_batch(R, I, Sigma_T - h[k] * e)) / (2 * h[k])
+        for (k, e) in enumerate(np.eye(len(Sigma_T)))
+    ], axis=-1)
+    assert close(jacobian[..., 3:], dS)
+
+def test_rejected_edits(problem):
+    n = len(problem.materials)
+    Sigma_T = problem.Sigma_T.copy()
+
+    # Sticks out of the bounding box
+    with pytest.raises(ValueError):
+        problem.add_solid([[-10, -10], [10, -10], [10, 10], [-10, 10]], problem.materials[0])
+
+    with pytest.raises(IndexError):
+        problem.remove_solid(n + 5)
+
+    with pytest.raises(IndexError):
+        problem.replace_solid(n + 5, problem.domain.solids[0], problem.materials[0])
+
+    assert len(problem.materials) == len(problem.domain.solids) == n
+    assert np.array_equal(problem.Sigma_T, Sigma_T)
+
+    problem.remove_solid(0)
+    assert len(problem.materials) == len(problem.domain.solids) == n - 1
+    assert len(problem.Sigma_T) == n
@@ -0,0 +1,17 @@
+from gefry3 import profiling
+
+def test_phase_without_profiler():
+    assert profiling.active is None
+    assert profiling.phase("a") is profiling.phase("b")
+
+    with profiling.phase("a"):
+        pass
+
+def test_phase_timings():
+    with profiling.instrument() as P:
+        with profiling.phase("outer"):
+            with profiling.phase("inner"):
+                pass
+
+    assert P.report()["timings"]["inner"]["calls"] == 1
+    assert profiling.active is None
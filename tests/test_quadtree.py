@@ -0,0 +1,94 @@
+import numpy as np
+import shapely
+
+import gefry3
+
+EXTENT = (-1.0, 2.0, 3.0, 4.0)
+
+def _bilinear(R):
+    # Interpolated exactly by every leaf, two columns to check the shapes
+    x, y = R[:, 0], R[:, 1]
+    return np.column_stack((1 + 2 * x - 3 * y + x * y, x - y))
+
+def _bump(R):
+    return np.exp(-((R[:, 0] - 1.0) ** 2 + (R[:, 1] - 3.0) ** 2) / 0.1)
+
+def test_find():
+    Q = gefry3.QuadtreeMap.build(None, extent=EXTENT, func=_bump, tol=1e-3, min_depth=2, max_depth=7)
+    assert 2 < Q.depth <= 7 and Q.n_leaves > 16
+
+    R = np.random.RandomState(0).uniform(EXTENT[:2], EXTENT[2:], (2000, 2))
+    leaf, w = Q.find(R)
+    boxes = Q.cells()[leaf]
+
+    assert (leaf >= 0).all()
+    assert ((boxes[:, :2] <= R) & (R <= boxes[:, 2:])).all()
+    assert np.allclose(boxes[:, :2] + w * (boxes[:, 2:] - boxes[:, :2]), R)
+
+    # Leaves tile the extent
+    cells = Q.cells()
+    assert np.isclose(np.prod(cells[:, 2:] - cells[:, :2], axis=1).sum(), 8.0)
+
+def test_integrate():
+    Q = gefry3.QuadtreeMap.build(None, extent=EXTENT, func=_bilinear, min_depth=1, max_depth=4)
+    assert Q.n_leaves == 4
+
+    # x from -1 to 3 and y from 2 to 4: the integrals of 1, x, y, xy are
+    # 8, 8, 24 and 24
+    assert np.allclose(Q.integrate(), [8 + 2 * 8 - 3 * 24 + 24, 8 - 24], rtol=1e-12)
+
+    # A Gaussian bump well inside the extent integrates to pi * 0.1
+    Q = gefry3.QuadtreeMap.build(None, extent=EXTENT, func=_bump, tol=1e-4, min_depth=3, max_depth=9)
+    assert np.isclose(Q.integrate(), np.pi * 0.1, rtol=1e-3)
+
+def test_to_raster():
+    Q = gefry3.QuadtreeMap.build(None, extent=EXTENT, func=_bilinear, min_depth=2, max_depth=4)
+    raster = Q.to_raster((8, 5))
+
+    X, Y = np.meshgrid(-1 + (np.arange(8) + 0.5) * 0.5, 2 + (np.arange(5) + 0.5) * 0.4, indexing="ij")
+    assert raster.shape == (8, 5, 2)
+    assert np.allclose(raster, _bilinear(np.column_stack((X.ravel(), Y.ravel()))).reshape(8, 5, 2))
+
+def _square_problem(detectors=([20.0, 50.0],)):
+    # One square solid in the middle of the box, by default with one
+    # detector left of it
+    return gefry3.load_dict({
+        "problem_type": "Simple_Problem",
+        "data": {
+            "domain": {
+                "bbox": [[0.0, 0.0], [100.0, 0.0], [100.0, 100.0], [0.0, 100.0]],
+                "solids": [{"material": 0, "vertices": [[40.0, 40.0], [60.0, 40.0], [60.0, 60.0], [40.0, 60.0], [40.0, 40.0]]}],
+            },
+            "materials": [{"number_dens": 1.0, "sigma_t": 0.05}],
+            "interstitial_material": {"number_dens": 1.0, "sigma_t": 0.01},
+            "source": {"R": [80.0, 20.0], "I0": 1e9},
+            "detectors": [{"type": "Point", "R": list(R), "area": 1e-3, "dwell": 1.0, "epsilon": 0.5} for R in detectors],
+        },
+    })
+
+def test_edge_refinement():
+    P = _square_problem()
+
+    # A constant never fails the interpolation test, so only the geometry
+    # refines the tree
+    flat = lambda R: np.ones(len(R))
+
+    Q = gefry3.QuadtreeMap.build(P, func=flat, min_depth=2, max_depth=6, edges=False)
+    assert Q.depth == 2
+
+    Q = gefry3.QuadtreeMap.build(P, func=flat, min_depth=2, max_depth=6)
+    boxes = shapely.box(*Q.cells().T)
+
+    # Everything along the square's edges, and along the shadow it casts
+    # from (40, 40) and (40, 60) away from the detector
+    edges = shapely.union_all([
+        P.domain.solids[0].geom.boundary,
+        shapely.linestrings([[40.0, 60.0], [100.0, 90.0]]),
+        shapely.linestrings([[40.0, 40.0], [100.0, 10.0]]),
+    ])
+    crossed = shapely.intersects(boxes, edges)
+
+    assert (Q.level[crossed] == 6).all()
+
+    # ... and nothing well away from them
+    assert (Q.level[Q.find([[5.0, 95.0], [5.0, 5.0], [90.0, 50.0]])[0]] == 2).all()
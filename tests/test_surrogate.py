@@ -0,0 +1,119 @@
+import numpy as np
+import shapely
+
+import gefry3
+from gefry3.surrogate import _optical_depth
+
+from test_quadtree import _square_problem
+
+def _problem(detectors=([20.0, 47.0], [53.0, 90.0])):
+    P = _square_problem(detectors=detectors)
+    P.domain.engine = "numpy"
+
+    return P
+
+def _random_points(problem, n, seed=0):
+    x0, y0, x1, y1 = problem.domain.bbox.bounds
+    return np.random.RandomState(seed).uniform([x0, y0], [x1, y1], (n, 2))
+
+def test_nodes_exact():
+    P = _problem()
+    S = gefry3.Surrogate.build(P, shape=(9, 9), refine=2, max_refine=8, tol=1e-3)
+    assert len(np.unique(S.patch_k)) > 1
+
+    # Every coarse and patch node is a ray trace
+    X, Y = np.meshgrid(np.linspace(0, 100, 9), np.linspace(0, 100, 9), indexing="ij")
+    R = np.column_stack((X.ravel(), Y.ravel()))
+    assert np.allclose(S.optical_depth(R), _optical_depth(P, R), rtol=1e-12, atol=1e-12)
+
+    for (ix, iy, d) in np.argwhere(S.cell_patch >= 0):
+        # Nodes on the far edges belong to the next cell
+        u = np.linspace(0, 1, S.patch_k[S.cell_patch[ix, iy, d]] + 1)[:-1]
+        U, V = np.meshgrid(u, u, indexing="ij")
+        R = (np.array([ix, iy]) + np.column_stack((U.ravel(), V.ravel()))) * 12.5
+
+        assert np.allclose(S.optical_depth(R)[:, d], _optical_depth(P, R)[:, d], rtol=1e-12, atol=1e-12)
+
+def test_edges_per_detector():
+    # Only the shadow edges of each detector refine, with no error test
+    detectors = ([20.0, 47.0], [53.0, 90.0])
+    P = _problem(detectors)
+    S = gefry3.Surrogate.build(P, shape=(11, 11), tol=np.inf, folds=0)
+
+    x = np.linspace(0, 100, 11)
+    X, Y = np.meshgrid(x[:-1], x[:-1], indexing="ij")
+    cells = shapely.box(X, Y, X + 10, Y + 10)
+
+    def shadow(D, face, corners):
+        # The face of the square towards D and the rays past its corners
+        D = np.array(D)
+        rays = [[v, v + 10 * (v - D)] for v in np.array(corners)]
+
+        return shapely.union_all(shapely.linestrings([face] + rays))
+
+    shadows = [
+        shadow(detectors[0], [[40.0, 40.0], [40.0, 60.0]], [[40.0, 40.0], [40.0, 60.0]]),
+        shadow(detectors[1], [[40.0, 60.0], [60.0, 60.0]], [[40.0, 60.0], [60.0, 60.0]]),
+    ]
+
+    for (d, region) in enumerate(shadows):
+        assert np.array_equal(S.cell_patch[..., d] >= 0, shapely.intersects(cells, region))
+
+    # The back of the square isn't an edge
+    square = P.domain.solids[0].geom
+    assert square.boundary.intersects(cells[6, 4]) and S.cell_patch[6, 4, 0] < 0
+    assert square.boundary.intersects(cells[4, 3]) and S.cell_patch[4, 3, 1] < 0
+
+def test_refinement_error():
+    P = _problem()
+    R = _random_points(P, 2000, seed=1)
+
+    loose = gefry3.Surrogate.build(P, shape=(9, 9), refine_edges=False, tol=1e-1)
+    tight = gefry3.Surrogate.build(P, shape=(9, 9), refine_edges=False, tol=1e-3, max_refine=64)
+
+    assert tight.refined_fraction > loose.refined_fraction
+    assert (tight.patch_k > 4).any()
+
+    # R are the validation points
+    measured = [S.validate(P, n=2000, seed=1) for S in (loose, tight)]
+    assert (measured[1]["max"] < measured[0]["max"]).all()
+    assert (measured[1]["rms"] < 0.2 * measured[0]["rms"]).all()
+    assert (measured[1]["rms"] < 5e-3).all()
+
+    # Responses are exact apart from the optical depth
+    log_ratio = np.log(tight.evaluate_batch(R, 1e9) / P.evaluate_batch(R, 1e9))
+    assert (np.abs(log_ratio) <= measured[1]["max"] + 1e-9).all()
+
+def test_cross_validation(problem):
+    problem.domain.engine = "numpy"
+    S = gefry3.Surrogate.build(problem, shape=(17, 17), refine=2, max_refine=8, tol=3e-2, folds=5)
+
+    n_det = len(problem.detectors)
+    assert S.error["folds"] == 5 and S.error["n"] == 16 * 16 * 8
+    assert S.error["fold_max"].shape == S.error["fold_rms"].shape == (5, n_det)
+    assert np.array_equal(S.error["max"], S.error["fold_max"].max(axis=0))
+    assert (S.error["fold_rms"].min(axis=0) <= S.error["rms"]).all()
+    assert (S.error["rms"] <= S.error["fold_rms"].max(axis=0)).all()
+
+    # The cross validated error is an honest estimate of the real one
+    measured = S.validate(problem, n=4000, seed=3)
+    assert np.allclose(measured["rms"], S.error["rms"], rtol=0.5)
+
+def test_save_load(tmp_path):
+    P = _problem()
+    S = gefry3.Surrogate.build(P, shape=(9, 9), refine=2, tol=1e-2)
+
+    fname = str(tmp_path / "surrogate.npz")
+    S.save(fname)
+    T = gefry3.Surrogate.load(fname)
+
+    for k in ("extent", "coarse", "cell_patch", "patch_k", "patch_start", "patch_values"):
+        assert np.array_equal(getattr(T, k), getattr(S, k))
+
+    assert T.deck_hash == S.deck_hash
+    assert np.array_equal(T.source.R, S.source.R)
+    assert all(np.array_equal(T.error[k], S.error[k]) for k in S.error)
+
+    R = _random_points(P, 500)
+    assert np.array_equal(T.evaluate_batch(R, 1e9), S.evaluate_batch(R, 1e9))
+    assert np.array_equal(T.evaluate_batch_with_gradient(R, 1e9)[1], S.evaluate_batch_with_gradient(R, 1e9)[1])
@@ -0,0 +1,210 @@
+import numpy as np
+import pytest
+import warnings
+
+import gefry3
+
+from conftest import EXAMPLE_DECK, read_example
+
+def _binary_problem(threshold):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        data = gefry3.read_input_problem(EXAMPLE_DECK, debug=True)
+
+    data["problem_type"] = "Binary_Domain_Problem"
+    data["data"]["distance_threshold"] = threshold
+    data["data"]["domain"]["solids"] = [{"vertices": S["vertices"]} for S in data["data"]["domain"]["solids"]]
+    del data["data"]["materials"]
+
+    return gefry3.load_dict(data)
+
+@pytest.mark.parametrize("threshold", [0.0, 1.0])
+@pytest.mark.parametrize("shape", [(16, 16), (64, 48)])
+def test_visibility_map_exact(threshold, shape):
+    P = _binary_problem(threshold)
+    P.domain.engine = "numpy"
+
+    x0, y0, x1, y1 = P.domain.bbox.bounds
+    R = np.random.RandomState(0).uniform([x0, y0], [x1, y1], size=(5000, 2))
+
+    # Points on cell edges and corners as well
+    X, Y = np.meshgrid(np.linspace(x0, x1, shape[0] + 1), np.linspace(y0, y1, shape[1] + 1), indexing="ij")
+    R = np.vstack((R, np.column_stack((X.ravel(), Y.ravel()))))
+
+    vmap = P.tabulate_visibility(shape)
+    exact = P.domain.visibility(*P._batch_rays(R), threshold).reshape(len(R), -1)
+
+    states = vmap.lookup(R)
+    assert not (exact & (states == vmap.SHADOW)).any()
+    assert not (~exact & (states == vmap.VISIBLE)).any()
+
+    assert np.array_equal(vmap.lookup(R, P.domain), exact)
+    assert vmap.mixed_fraction < 0.5
+
+def test_visibility_map_edit():
+    P = _binary_problem(1.0)
+    P.domain.engine = "numpy"
+    vmap = P.tabulate_visibility((32, 32))
+
+    V = np.asarray(P.domain.solids[0].vertices, dtype=np.float64)
+    P.remove_solid(5)
+    P.replace_solid(0, (V + V.mean(axis=0)) / 2)
+
+    x0, y0, x1, y1 = P.domain.bbox.bounds
+    R = np.random.RandomState(1).uniform([x0, y0], [x1, y1], size=(5000, 2))
+    exact = P.domain.visibility(*P._batch_rays(R), 1.0).reshape(len(R), -1)
+
+    states = vmap.lookup(R)
+    assert not (exact & (states == vmap.SHADOW)).any()
+    assert not (~exact & (states == vmap.VISIBLE)).any()
+
+def _bilinear_reference(P, T, R):
+    # Bilinear interpolation of exactly traced paths at the corners of the
+    # cells holding R, worked out independently of PathTable.lookup
+    f = (R - T.extent[:2]) / T.spacing
+    i = np.minimum(np.floor(f).astype(int), np.array(T.shape) - 2)
+    w = f - i
+
+    n_det = len(T.detectors_R)
+    out = 0
+
+    for (dx, dy) in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+        C = T.extent[:2] + (i + [dx, dy]) * T.spacing
+        paths = P.domain.construct_paths(
+            np.repeat(C, n_det, axis=0),
+            np.tile(T.detectors_R, (len(C), 1)),
+        ).reshape(len(C), n_det, -1)
+
+        wx = w[:, 0] if dx else 1 - w[:, 0]
+        wy = w[:, 1] if dy else 1 - w[:, 1]
+        out = out + (wx * wy)[:, None, None] * paths
+
+    return out
+
+@pytest.mark.parametrize("mode", ["attenuation", "paths"])
+def test_path_table_lookup(problem, mode):
+    problem.domain.engine = "numpy"
+    T = problem.tabulate((21, 17), mode=mode, n_check=0)
+    I0 = problem.source.I0
+
+    # On grid nodes the table is the ray trace
+    nodes = T.nodes.reshape(-1, 2)[::5]
+    tabulated = problem.evaluate_batch(nodes, I0)
+
+    problem.use_table(None)
+    assert np.allclose(tabulated, problem.evaluate_batch(nodes, I0), rtol=1e-10, atol=0)
+
+    # Off the nodes it's bilinear in each cell
+    R = np.random.RandomState(0).uniform(T.extent[:2], T.extent[2:], size=(300, 2))
+    paths = _bilinear_reference(problem, T, R)
+    expected = paths if mode == "paths" else paths.dot(problem.Sigma_T)
+
+    assert np.allclose(T.lookup(R), expected, rtol=1e-10, atol=1e-10)
+
+    problem.use_table(T)
+    alpha = np.exp(-paths.dot(problem.Sigma_T))
+    expected = problem.detector_array.compute_responses(I0 * alpha, R)
+
+    assert np.allclose(problem.evaluate_batch(R, I0), expected, rtol=1e-10, atol=0)
+
+def test_path_table_build(problem):
+    problem.domain.engine = "numpy"
+    T = gefry3.PathTable.build(problem, shape=(9, 7), mode="paths", n_check=50, dtype=np.float32)
+
+    n_det, n_regions = len(problem.detectors), 1 + len(problem.domain.solids)
+    assert T.values.shape == (9, 7, n_det, n_regions)
+    assert T.values.dtype == np.float32
+    assert np.allclose(T.nodes[-1, -1], problem.domain.bbox.bounds[2:])
+
+    assert T.error["n"] == 50
+    assert T.error["max"].shape == T.error["rms"].shape == (n_det,)
+    assert (T.error["rms"] <= T.error["max"]).all()
+
+@pytest.mark.parametrize("mode", ["attenuation", "paths"])
+def test_path_table_save_load(problem, mode, tmp_path):
+    problem.domain.engine = "numpy"
+    T = problem.tabulate((11, 9), mode=mode, n_check=20)
+
+    fname = str(tmp_path / "table.npz")
+    T.save(fname)
+    U = gefry3.PathTable.load(fname)
+
+    assert U.mode == T.mode
+    assert U.deck_hash == T.deck_hash
+    assert np.array_equal(U.values, T.values)
+    assert np.array_equal(U.extent, T.extent)
+    assert np.array_equal(U.detectors_R, T.detectors_R)
+    assert (U.Sigma_T is None) == (T.Sigma_T is None)
+    assert all(np.array_equal(U.error[k], T.error[k]) for k in T.error)
+
+    problem.use_table(U)
+    R = np.random.RandomState(0).uniform(T.extent[:2], T.extent[2:], size=(50, 2))
+    assert np.array_equal(U.lookup(R), T.lookup(R))
+
+def test_path_table_check_compatible(problem):
+    from gefry3.tables import TableMismatchError
+
+    problem.domain.engine = "numpy"
+    T = problem.tabulate((5, 5), mode="attenuation", n_check=0)
+    T.check_compatible(problem)
+
+    # Attenuation tables are tied to the cross sections
+    with pytest.raises(TableMismatchError):
+        T.optical_depth(np.zeros((1, 2)), 2 * problem.Sigma_T)
+
+    moved = read_example()
+    moved.detectors[0].R = np.asarray(moved.detectors[0].R) + 1.0
+    with pytest.raises(TableMismatchError):
+        T.check_compatible(moved)
+
+    fewer = read_example()
+    fewer.remove_solid(0)
+    with pytest.raises(TableMismatchError):
+        T.check_compatible(fewer)
+
+    P = gefry3.PathTable.build(problem, shape=(5, 5), mode="paths", n_check=0)
+    with pytest.raises(TableMismatchError):
+        P.check_compatible(fewer)
+
+@pytest.mark.parametrize("mode", ["attenuation", "paths"])
+def test_path_table_edit(problem, mode):
+    problem.domain.engine = "numpy"
+    T = problem.tabulate((13, 11), mode=mode, n_check=0)
+
+    V = np.asarray(problem.domain.solids[0].vertices, dtype=np.float64)
+    problem.remove_solid(5)
+    problem.replace_solid(0, (V + V.mean(axis=0)) / 2)
+    problem.add_solid(V[:3] + [1.0, 0.0], problem.materials[1])
+    problem.set_material(2, problem.materials[3])
+
+    assert problem.table is T
+    T.check_compatible(problem)
+
+    fresh = gefry3.PathTable.build(problem, shape=(13, 11), mode=mode, n_check=0)
+    assert np.allclose(T.values, fresh.values, rtol=1e-12, atol=1e-12)
+
+def test_path_table_file(problem, tmp_path):
+    from gefry3.tables import TableMismatchError
+
+    problem.domain.engine = "numpy"
+    fname = str(tmp_path / "table.npy")
+    T = problem.tabulate_file(fname, shape=(9, 7), n_check=0)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["table.json", "table.npy"]
+    assert not T.values.flags.writeable
+    assert np.array_equal(T.values, gefry3.PathTable.build(problem, shape=(9, 7), mode="paths", n_check=0).values)
+
+    U = gefry3.PathTable.open(fname, problem)
+    assert np.array_equal(U.values, T.values)
+
+    shape = T.values.shape
+    del T, U
+
+    # Values from a different build under the old header
+    np.save(fname, np.zeros((9, 8) + shape[2:]))
+    with pytest.raises(TableMismatchError):
+        gefry3.PathTable.open(fname)
+
+    np.save(fname, np.zeros(shape, dtype=np.float32))
+    with pytest.raises(TableMismatchError):
+        gefry3.PathTable.open(fname)